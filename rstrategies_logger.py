@@ -41,10 +41,17 @@ class Logger(object):
     def print_aggregated_log(self):
         if not self.aggregate:
             return
+        # Number of objects that ended up in each strategy (switched in minus switched out)
+        absorbed = {}
         for key, entry in self.logs.items():
             cause, old_strategy, new_strategy, typename = key
             slots, objects, element_typenames = entry.slots, entry.objects, entry.classnames()
             self.output(cause, old_strategy, new_strategy, typename, slots, objects, element_typenames)
+            absorbed[new_strategy] = absorbed.get(new_strategy, 0) + objects
+            if old_strategy:
+                absorbed[old_strategy] = absorbed.get(old_strategy, 0) - objects
+        for strategy, objects in absorbed.items():
+            print "%s absorbs %d objects" % (strategy, objects)
     
     def output(self, cause, old_strategy, new_strategy, typename, slots, objects, element_typenames):
         old_strategy_string = "%s -> " % old_strategy if old_strategy else ""
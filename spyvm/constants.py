@@ -24,6 +24,10 @@ METHODDICT_TALLY_INDEX = 0
 METHODDICT_VALUES_INDEX = 1
 METHODDICT_NAMES_INDEX  = 2
 
+# Association (and other variable bindings)
+ASSOCIATION_KEY_INDEX = 0
+ASSOCIATION_VALUE_INDEX = 1
+
 # Message
 MESSAGE_SELECTOR_INDEX = 0
 MESSAGE_ARGUMENTS_INDEX = 1
@@ -195,5 +199,16 @@ def decode_compiled_method_header(header):
 # Interpreter constants
 #
 
-INTERRUPT_COUNTER_SIZE = 10000
+INTERRUPT_TIMER_PERIOD = 2 # Milliseconds between checks for interrupts
+CACHED_OBJECT_CHANGE_LIMIT = 8 # Stores into a global or class variable before its value is no longer constant-folded
+CACHED_OBJECT_QUIET_PERIOD = 1.0 # Seconds without stores after which earlier stores no longer count towards the limit
+MAX_STACK_DEPTH = 10000 # Nested stack_frame calls before execution continues from Interpreter.loop
+METHOD_CACHE_SIZE = 1024 # Must be a power of two
+CLASS_CHANGES_QUIET_LOOKUPS = 1000 # Lookups without method changes before traces stop checking for them
+POLYMORPHIC_CACHE_SIZE = 4 # Receiver classes per send site, before it is megamorphic
+INSTRUCTION_SIZE = 5 # Fields of a pre-decoded instruction: bytecode, 3 operands, next pc
+CONTEXT_POOL_STACK_SIZE = 128 # Contexts with more temps and stack slots are not pooled
+CONTEXT_POOL_CAPACITY = 1024 # Pooled contexts of all stack sizes together, enough to unwind deep recursions
+STRATEGY_PREDICTION_THRESHOLD = 4 # Instances switching to the same strategy before new instances start in it
+STRATEGY_PREDICTION_DECAY = 1024 # Instances created from a prediction before it is learned again
 CompileTime = time.time()
@@ -1,4 +1,3 @@
-import os
 import sys
 
 sys.setrecursionlimit(1000000)
@@ -16,13 +15,13 @@ class ReturnFromTopLevel(Exception):
         self.object = object
 
 class Return(Exception):
-    _attrs_ = ["value", "s_target_context", "is_local", "arrived_at_target"]
-    _immutable_fields_ = ["value", "s_target_context", "is_local"]
+    """Non-local return to s_target_context. Local returns to the direct
+    sender do not raise, their value is returned from loop_bytecodes."""
+    _attrs_ = ["value", "s_target_context"]
+    _immutable_fields_ = ["value", "s_target_context"]
     def __init__(self, s_target_context, w_result):
         self.value = w_result
         self.s_target_context = s_target_context
-        self.arrived_at_target = False
-        self.is_local = s_target_context is None
 
 class NonVirtualReturn(Exception):
     _attrs_ = ["s_target_context", "s_current_context", "value"]
@@ -34,6 +33,17 @@ class NonVirtualReturn(Exception):
     def print_trace(self):
         print "\n====== Sender Chain Manipulation, contexts forced to heap at: %s" % self.s_current_context.short_str()
 
+class ActiveSenderReturn(Exception):
+    """Local return from a context whose sender was changed to a context that is
+    still active further down the stack. Only the frames in between are unwound.
+    They were cut out of the sender chain and are abandoned, so the contexts
+    of the sender chain stay virtual."""
+    _attrs_ = ["value", "s_target_context"]
+    _immutable_fields_ = ["value", "s_target_context"]
+    def __init__(self, s_target_context, w_result):
+        self.value = w_result
+        self.s_target_context = s_target_context
+
 class ContextSwitchException(Exception):
     """General Exception that causes the interpreter to leave
     the current context."""
@@ -47,8 +57,10 @@ class ContextSwitchException(Exception):
 
 class StackOverflow(ContextSwitchException):
     """This causes the current jit-loop to be left, dumping all virtualized objects to the heap.
-    This breaks performance, so it should rarely happen.
-    In case of severe performance problems, execute with -t and check if this occurrs."""
+    Raised when the nesting of interpreted stack_frame calls reaches max_stack_depth,
+    or when the native stack runs out in jitted code. The context
+    then continues from Interpreter.loop. This breaks performance, so it should rarely happen.
+    In case of severe performance problems, execute with -T or --stats and check if this occurrs."""
     type = "Stack Overflow"
 
 class ProcessSwitch(ContextSwitchException):
@@ -56,7 +68,16 @@ class ProcessSwitch(ContextSwitchException):
     Triggered when switching the process."""
     type = "Process Switch"
 
-UNROLLING_BYTECODE_RANGES = unroll.unrolling_iterable(interpreter_bytecodes.BYTECODE_RANGES)
+class BytecodeDispatchTable(object):
+    """Immutable holder for the bytecode handlers, so that the jit can
+    constant-fold the lookup of the handler of a constant bytecode and
+    inline the call to it."""
+    _attrs_ = ["handlers"]
+    _immutable_fields_ = ["handlers[*]"]
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+BYTECODE_DISPATCH_TABLE = BytecodeDispatchTable(interpreter_bytecodes.BYTECODE_HANDLERS)
 
 def get_printable_location(pc, self, method):
     bc = ord(method.bytes[pc])
@@ -64,8 +85,7 @@ def get_printable_location(pc, self, method):
     return '(%s) [%d]: <%s>%s' % (name, pc, hex(bc), interpreter_bytecodes.BYTECODE_NAMES[bc])
 
 class Interpreter(object):
-    _immutable_fields_ = ["space", "image",
-                          "interrupt_counter_size", "trace_important",
+    _immutable_fields_ = ["space", "image", "trace_important", "trace_bytecodes", "max_stack_depth",
                           "startup_time", "evented", "interrupts"]
 
     jit_driver = jit.JitDriver(
@@ -76,7 +96,8 @@ class Interpreter(object):
     )
 
     def __init__(self, space, image=None, trace_important=False,
-                trace=False, evented=True, interrupts=True):
+                trace=False, trace_bytecodes=False, evented=True, interrupts=True,
+                max_stack_depth=constants.MAX_STACK_DEPTH):
         # === Initialize immutable variables
         self.space = space
         self.image = image
@@ -87,33 +108,43 @@ class Interpreter(object):
         self.evented = evented
         self.interrupts = interrupts
         self.trace_important = trace_important
-        try:
-            self.interrupt_counter_size = int(os.environ["SPY_ICS"])
-        except KeyError:
-            self.interrupt_counter_size = constants.INTERRUPT_COUNTER_SIZE
+        self.trace_bytecodes = trace_bytecodes
+        assert max_stack_depth > 1
+        self.max_stack_depth = max_stack_depth
 
         # === Initialize mutable variables
-        self.interrupt_check_counter = self.interrupt_counter_size
+        self.remaining_stack_depth = max_stack_depth
         self.next_wakeup_tick = 0
-        self.trace = trace
+        self.trace = trace or trace_bytecodes
         self.trace_proxy = objspace.ConstantFlag()
         self.stack_depth = 0
 
     def loop(self, w_active_context):
-        # This is the top-level loop and is not invoked recursively.
+        # This is the top-level loop. It is only invoked recursively to run a
+        # process on top of the suspended frames of another process.
         s_context = w_active_context.as_context_get_shadow(self.space)
         while True:
+            if s_context.state is not InactiveContext:
+                # Suspended further down the Python stack, continue it there.
+                raise ProcessSwitch(s_context)
             s_sender = s_context.s_sender()
             try:
-                self.stack_frame(s_context, None)
-                raise Exception("loop_bytecodes left without raising...")
+                w_result = self.stack_frame(s_context, None)
+                # Local return from the context to its (heap) sender
+                s_context = self.unwind_context_chain(s_sender, s_sender, w_result)
             except ContextSwitchException, e:
                 if self.is_tracing() or self.trace_important:
                     e.print_trace()
+                if isinstance(e, ProcessSwitch):
+                    if e.s_new_context.state is InactiveContext:
+                        # Otherwise the switch is counted when the context is
+                        # continued further down the Python stack.
+                        self.space.context_switches.finish()
+                elif isinstance(e, StackOverflow):
+                    self.space.context_switches.stack_overflow()
                 s_context = e.s_new_context
             except Return, ret:
-                target = s_sender if ret.arrived_at_target else ret.s_target_context
-                s_context = self.unwind_context_chain(s_sender, target, ret.value)
+                s_context = self.unwind_context_chain(s_sender, ret.s_target_context, ret.value)
             except NonVirtualReturn, ret:
                 if self.is_tracing() or self.trace_important:
                     ret.print_trace()
@@ -121,34 +152,103 @@ class Interpreter(object):
 
     # This is a wrapper around loop_bytecodes that cleanly enters/leaves the frame,
     # handles the stack overflow protection mechanism and handles/dispatches Returns.
+    # The result of the frame is pushed onto s_sender. If s_sender is None,
+    # the result is returned to the caller instead.
+    # The depth of nested calls is bounded by max_stack_depth. A frame that
+    # would exceed it raises StackOverflow, which unwinds the stack. The frame
+    # is then continued from loop, which returns to its sender through the heap.
+    # Only frames entered outside of jitted code are counted, jitted code
+    # relies on rstackovf instead.
     def stack_frame(self, s_frame, s_sender, may_context_switch=True):
+        if s_frame._s_sender is None and s_sender is not None:
+            s_frame.store_s_sender(s_sender)
+        counted = not jit.we_are_jitted()
+        if counted:
+            if s_sender is not None and self.remaining_stack_depth <= 1:
+                raise StackOverflow(s_frame)
+            self.remaining_stack_depth -= 1
         try:
             if self.is_tracing():
                 self.stack_depth += 1
-            if s_frame._s_sender is None and s_sender is not None:
-                s_frame.store_s_sender(s_sender)
             # Now (continue to) execute the context bytecodes
             # assert s_frame.state is InactiveContext
             s_frame.state = ActiveContext
-            self.loop_bytecodes(s_frame, may_context_switch)
-        except rstackovf.StackOverflow:
-            rstackovf.check_stack_overflow()
-            raise StackOverflow(s_frame)
-        except Return, ret:
+            s_target_context = None # Local return to the direct sender
+            try:
+                try:
+                    w_result = self.loop_bytecodes(s_frame, may_context_switch)
+                except ProcessSwitch, e:
+                    w_result = self.switch_process_on_stack(s_frame, e, may_context_switch)
+            except rstackovf.StackOverflow:
+                rstackovf.check_stack_overflow()
+                raise StackOverflow(s_frame)
+            except Return, ret:
+                s_target_context = ret.s_target_context
+                w_result = ret.value
+            except ActiveSenderReturn, ret:
+                if s_sender is None or ret.s_target_context is not s_sender:
+                    raise ret
+                # This context was cut out of the sender chain.
+                s_sender.push(ret.value)
+                return None
             if s_frame.state is DirtyContext:
-                s_sender = s_frame.s_sender() # The sender has changed!
+                s_new_sender = s_frame.s_sender() # The sender has changed!
                 s_frame._activate_unwind_context(self)
-                target_context = s_sender if ret.is_local else ret.s_target_context
-                raise NonVirtualReturn(target_context, s_sender, ret.value)
+                if s_target_context is None:
+                    if (s_new_sender is not None and s_new_sender is not s_frame
+                            and s_new_sender.state is ActiveContext):
+                        if s_new_sender is not s_sender:
+                            raise ActiveSenderReturn(s_new_sender, w_result)
+                        # Changed back to the direct sender, return locally.
+                    else:
+                        raise NonVirtualReturn(s_new_sender, s_new_sender, w_result)
+                else:
+                    raise NonVirtualReturn(s_target_context, s_new_sender, w_result)
             else:
                 s_frame._activate_unwind_context(self)
-                if ret.is_local or ret.s_target_context is s_sender:
-                    ret.arrived_at_target = True
-                raise ret
+                if s_target_context is not None and s_target_context is not s_sender:
+                    raise Return(s_target_context, w_result)
         finally:
+            if counted:
+                self.remaining_stack_depth += 1
             if self.is_tracing():
                 self.stack_depth -= 1
             s_frame.state = InactiveContext
+        if s_sender is None:
+            return w_result
+        if not jit.we_are_jitted():
+            self.space.context_pool.recycle(s_frame)
+        s_sender.push(w_result)
+        return None
+
+    # Called when the process executing s_frame was switched. Instead of unwinding
+    # all frames to loop, the frames of the suspended process stay on the Python
+    # stack. The new process runs in a nested loop on top of them, as long as
+    # enough stack depth is left. Switching back to a context that is suspended on
+    # the stack only unwinds the frames above it. Returns the result of s_frame.
+    def switch_process_on_stack(self, s_frame, e, may_context_switch):
+        while True:
+            s_new_context = e.s_new_context
+            if s_new_context is not s_frame and (
+                    s_new_context.state is not InactiveContext or
+                    self.remaining_stack_depth <= self.max_stack_depth / 2):
+                raise e
+            if self.is_tracing() or self.trace_important:
+                e.print_trace()
+            self.space.context_switches.finish()
+            if s_new_context is not s_frame:
+                try:
+                    self.loop(s_new_context.w_self())
+                except ProcessSwitch, e:
+                    continue
+                except ActiveSenderReturn, ret:
+                    if ret.s_target_context is not s_frame:
+                        raise
+                    s_frame.push(ret.value)
+            try:
+                return self.loop_bytecodes(s_frame, may_context_switch)
+            except ProcessSwitch, e:
+                pass
 
     def loop_bytecodes(self, s_context, may_context_switch=True):
         old_pc = 0
@@ -158,9 +258,8 @@ class Interpreter(object):
         while True:
             pc = s_context.pc()
             if pc < old_pc:
-                if jit.we_are_jitted():
-                    # Do the interrupt-check at the end of a loop, don't interrupt loops midway.
-                    self.jitted_check_for_interrupt(s_context)
+                # Do the interrupt-check at the end of a loop, don't interrupt loops midway.
+                self.quick_check_for_interrupt(s_context)
                 self.jit_driver.can_enter_jit(
                     pc=pc, self=self, method=method,
                     s_context=s_context)
@@ -168,13 +267,9 @@ class Interpreter(object):
             self.jit_driver.jit_merge_point(
                 pc=pc, self=self, method=method,
                 s_context=s_context)
-            try:
-                self.step(s_context)
-            except Return, ret:
-                if ret.arrived_at_target:
-                    s_context.push(ret.value)
-                else:
-                    raise ret
+            w_result = self.step(s_context)
+            if w_result is not None:
+                return w_result
 
     def unwind_context_chain(self, start_context, target_context, return_value):
         if start_context is None:
@@ -198,37 +293,22 @@ class Interpreter(object):
         return context
 
     def step(self, context):
-        bytecode = context.fetch_next_bytecode()
-        for entry in UNROLLING_BYTECODE_RANGES:
-            if len(entry) == 2:
-                bc, methname = entry
-                if bytecode == bc:
-                    return getattr(context, methname)(self, bytecode)
-            else:
-                start, stop, methname = entry
-                if start <= bytecode <= stop:
-                    return getattr(context, methname)(self, bytecode)
-        assert 0, "unreachable"
+        bytecode, first, second, third = context.fetch_next_instruction()
+        if self.trace_bytecodes:
+            self.print_padded('.. <%s>%s' % (hex(bytecode), interpreter_bytecodes.BYTECODE_NAMES[bytecode]))
+        handler = BYTECODE_DISPATCH_TABLE.handlers[bytecode]
+        return handler(context, self, bytecode, first, second, third)
 
     # ============== Methods for handling user interrupts ==============
 
-    def jitted_check_for_interrupt(self, s_frame):
+    # The interrupt timer raises a flag asynchronously, which is polled on
+    # every send and loop back-edge.
+    def quick_check_for_interrupt(self, s_frame):
         if not self.interrupts:
             return
-        # Normally, the tick counter is decremented by 1 for every message send.
-        # Since we don't know how many messages are called during this trace, we
-        # just decrement by 100th of the trace length (num of bytecodes).
-        trace_length = jit.current_trace_length()
-        decr_by = int(trace_length // 100)
-        decr_by = max(decr_by, 1)
-        self.quick_check_for_interrupt(s_frame, decr_by)
-
-    def quick_check_for_interrupt(self, s_frame, dec=1):
-        if not self.interrupts:
-            return
-        self.interrupt_check_counter -= dec
-        if self.interrupt_check_counter <= 0:
-            self.interrupt_check_counter = self.interrupt_counter_size
+        timer = self.space.interrupt_timer
+        if timer.is_pending():
+            timer.acknowledge()
             self.check_for_interrupts(s_frame)
 
     def check_for_interrupts(self, s_frame):
@@ -244,6 +324,7 @@ class Interpreter(object):
         # Process inputs
         # Process User Interrupt?
         if not self.next_wakeup_tick == 0 and now >= self.next_wakeup_tick:
+            self.space.interrupt_timer.record_wakeup(now - self.next_wakeup_tick)
             self.next_wakeup_tick = 0
             semaphore = self.space.objtable["w_timerSemaphore"]
             if not semaphore.is_nil(self.space):
@@ -260,11 +341,18 @@ class Interpreter(object):
     # ============== Convenience methods for executing code ==============
 
     def interpret_toplevel(self, w_frame):
+        timer = self.space.interrupt_timer
+        # Nested calls leave the timer to the outermost one.
+        started_timer = self.interrupts and not timer.running
         try:
-            self.interrupt_check_counter = self.interrupt_counter_size
+            if started_timer:
+                timer.start()
             self.loop(w_frame)
         except ReturnFromTopLevel, e:
             return e.object
+        finally:
+            if started_timer:
+                timer.stop()
 
     def perform(self, w_receiver, selector="", w_selector=None, w_arguments=[]):
         s_frame = self.create_toplevel_context(w_receiver, selector, w_selector, w_arguments)
@@ -1,40 +1,73 @@
 
+import operator
+
 from spyvm.storage_contexts import ContextPartShadow
 from spyvm.storage_classes import ClassShadow
-from spyvm import model, primitives, wrapper, error
+from spyvm import model, constants, primitives, wrapper, error, storage_classes
 from spyvm.util.bitmanipulation import splitter
 from rpython.rlib import objectmodel, unroll, jit
+from rpython.rlib.rarithmetic import ovfcheck
+
+# Decoders turn a bytecode and its parameter bytes into (up to three) operands.
+# They are applied only once per instruction, see decode_instruction().
+def decode_parameters(current_bytecode, first, second, third):
+    return first, second, third
+
+def decode_extended_variable(current_bytecode, descriptor, second, third):
+    # Variable type and index
+    return (descriptor >> 6) & 3, descriptor & 63, 0
+
+def decode_new_array(current_bytecode, descriptor, second, third):
+    arraySize, popIntoArray = splitter[7, 1](descriptor)
+    return arraySize, popIntoArray, 0
+
+def decode_closure_copy(current_bytecode, descriptor, j, i):
+    numArgs, numCopied = splitter[4, 4](descriptor)
+    return numArgs, numCopied, (j << 8) | i
+
+def decode_literal_send(current_bytecode, second, third, fourth):
+    # Literal index of the selector and argument count
+    return current_bytecode & 15, ((current_bytecode >> 4) & 3) - 1, 0
+
+def decode_single_extended_send(current_bytecode, descriptor, second, third):
+    return descriptor & 31, descriptor >> 5, 0
+
+def decode_second_extended_send(current_bytecode, descriptor, second, third):
+    return descriptor & 63, descriptor >> 6, 0
 
-# unrolling_zero has been removed from rlib at some point.
-if hasattr(unroll, "unrolling_zero"):
-    unrolling_zero = unroll.unrolling_zero
-else:
-    class unrolling_int(int, unroll.SpecTag):
-        def __add__(self, other):
-            return unrolling_int(int.__add__(self, other))
-        __radd__ = __add__
-        def __sub__(self, other):
-            return unrolling_int(int.__sub__(self, other))
-        def __rsub__(self, other):
-            return unrolling_int(int.__rsub__(self, other))
-    unrolling_zero = unrolling_int(0)
+def decode_double_extended(current_bytecode, second, third, fourth):
+    # Operation type, argument count (for sends) and index
+    return second >> 5, second & 31, third
+
+def decode_long_jump(current_bytecode, parameter, second, third):
+    return (((current_bytecode & 7) - 4) << 8) + parameter, 0, 0
+
+def decode_long_conditional_jump(current_bytecode, parameter, second, third):
+    return ((current_bytecode & 3) << 8) + parameter, 0, 0
 
 # This is a decorator for bytecode implementation methods.
 # parameter_bytes=N means N additional bytes are fetched as parameters.
-def bytecode_implementation(parameter_bytes=0):
+# The decoder computes the operands passed to the implementation from the
+# bytecode and the parameter bytes, by default the parameter bytes themselves.
+def bytecode_implementation(parameter_bytes=0, decoder=decode_parameters):
     def bytecode_implementation_decorator(actual_implementation_method):
-        @jit.unroll_safe
-        def bytecode_implementation_wrapper(self, interp, current_bytecode):
-            parameters = ()
-            i = unrolling_zero
-            while i < parameter_bytes:
-                parameters += (self.fetch_next_bytecode(), )
-                i = i + 1
+        operand_count = actual_implementation_method.func_code.co_argcount - 3
+        assert 0 <= operand_count <= 3
+        def bytecode_implementation_wrapper(self, interp, current_bytecode, first, second, third):
             # This is a good place to step through bytecodes.
             
             self.debug_bytecode(interp)
-            return actual_implementation_method(self, interp, current_bytecode, *parameters)
+            if operand_count == 0:
+                return actual_implementation_method(self, interp, current_bytecode)
+            elif operand_count == 1:
+                return actual_implementation_method(self, interp, current_bytecode, first)
+            elif operand_count == 2:
+                return actual_implementation_method(self, interp, current_bytecode, first, second)
+            else:
+                return actual_implementation_method(self, interp, current_bytecode, first, second, third)
         bytecode_implementation_wrapper.func_name = actual_implementation_method.func_name
+        bytecode_implementation_wrapper.parameter_bytes = parameter_bytes
+        bytecode_implementation_wrapper.decoder = decoder
         return bytecode_implementation_wrapper
     return bytecode_implementation_decorator
 
@@ -83,6 +116,64 @@ def make_quick_call_primitive_bytecode(primitive_index, argcount):
         return func(interp, self, argcount)
     return quick_call_primitive_bytecode
 
+# Arithmetic and comparison bytecodes with inlined fast paths for SmallIntegers and Floats.
+# The primitive (and the send, if it fails) is only used when no fast path applies:
+# for other receivers or arguments, or when the SmallInteger operation overflows
+# (or the result does not fit into a tagged SmallInteger).
+def make_arithmetic_bytecode(primitive, selector, op, is_comparison=False):
+    call_primitive = make_call_primitive_bytecode(primitive, selector, 1)
+    @bytecode_implementation()
+    def arithmeticBytecode(self, interp, current_bytecode):
+        w_arg = self.peek(0)
+        w_rcvr = self.peek(1)
+        if isinstance(w_rcvr, model.W_SmallInteger) and isinstance(w_arg, model.W_SmallInteger):
+            if is_comparison:
+                w_result = self.space.wrap_bool(op(w_rcvr.value, w_arg.value))
+            else:
+                try:
+                    w_result = self.space.wrap_int(ovfcheck(op(w_rcvr.value, w_arg.value)))
+                except (OverflowError, error.WrappingError):
+                    return call_primitive(self, interp, current_bytecode, 0, 0, 0)
+        elif _is_float_operand(w_rcvr) and _is_float_operand(w_arg):
+            # Float x Float, or mixed SmallInteger and Float
+            if is_comparison:
+                w_result = self.space.wrap_bool(op(_float_value(w_rcvr), _float_value(w_arg)))
+            else:
+                w_result = self.space.wrap_float(op(_float_value(w_rcvr), _float_value(w_arg)))
+        else:
+            return call_primitive(self, interp, current_bytecode, 0, 0, 0)
+        self.pop_n(2)
+        self.push(w_result)
+    arithmeticBytecode.func_name = "arithmeticBytecode_%s" % primitive
+    return arithmeticBytecode
+
+def _is_float_operand(w_object):
+    return isinstance(w_object, model.W_Float) or isinstance(w_object, model.W_SmallInteger)
+
+def _float_value(w_object):
+    if isinstance(w_object, model.W_Float):
+        return w_object.value
+    assert isinstance(w_object, model.W_SmallInteger)
+    return float(w_object.value)
+
+# Superinstruction for a comparison followed by a conditional jump (as used by whileTrue:).
+def make_compare_and_jump_superinstruction(compare_bytecode, compare_implementation):
+    @bytecode_implementation()
+    def compareAndJumpSuperinstruction(self, interp, current_bytecode, jump_bytecode, offset):
+        end_pc = self.pc()
+        # If the comparison sends a message, execution continues at the jump.
+        if jump_bytecode < 160:
+            self.store_pc(end_pc - 1)
+        else:
+            self.store_pc(end_pc - 2)
+        w_return_value = compare_implementation(self, interp, compare_bytecode, 0, 0, 0)
+        if w_return_value is not None:
+            return w_return_value
+        self.store_pc(end_pc)
+        self._jumpConditional(interp, 168 <= jump_bytecode <= 171, offset)
+    compareAndJumpSuperinstruction.func_name = "compareAndJumpSuperinstruction_%s" % compare_bytecode
+    return compareAndJumpSuperinstruction
+
 # This is for bytecodes that actually implement a simple message-send.
 # We do not optimize anything for these cases.
 def make_send_selector_bytecode(selector, argcount):
@@ -121,10 +212,20 @@ class __extend__(ContextPartShadow):
         # this bytecode assumes that literals[index] is an Association
         # which is an object with two named vars, and fetches the second
         # named var (the value).    
-        index = current_bytecode & 31
+        self._pushLiteralVariable(current_bytecode & 31)
+
+    def _pushLiteralVariable(self, index):
         w_association = self.w_method().getliteral(index)
-        association = wrapper.AssociationWrapper(self.space, w_association)
-        self.push(association.value())
+        if isinstance(w_association, model.W_PointersObject):
+            # The value of a global or class variable is cached for the version of
+            # the association, so that the jit can constant-fold it. Storing into
+            # the association (rebinding the variable) changes the version, until
+            # it was rebound too often to be treated as a constant.
+            s_association = jit.promote(w_association.as_cached_object_get_shadow(self.space))
+            self.push(s_association.fetch(constants.ASSOCIATION_VALUE_INDEX))
+        else:
+            association = wrapper.AssociationWrapper(self.space, w_association)
+            self.push(association.value())
 
     @bytecode_implementation()
     def storeAndPopReceiverVariableBytecode(self, interp, current_bytecode):
@@ -180,9 +281,8 @@ class __extend__(ContextPartShadow):
     def popStackBytecode(self, interp, current_bytecode):
         self.pop()
 
-    @bytecode_implementation(parameter_bytes=1)
-    def pushNewArrayBytecode(self, interp, current_bytecode, descriptor):
-        arraySize, popIntoArray = splitter[7, 1](descriptor)
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_new_array)
+    def pushNewArrayBytecode(self, interp, current_bytecode, arraySize, popIntoArray):
         newArray = None
         if popIntoArray == 1:
            newArray = interp.space.wrap_list(self.pop_and_return_n(arraySize))
@@ -192,12 +292,8 @@ class __extend__(ContextPartShadow):
 
     # ====== Extended Push/Pop bytecodes ======
 
-    def _extendedVariableTypeAndIndex(self, descriptor):
-        return ((descriptor >> 6) & 3), (descriptor & 63)
-
-    @bytecode_implementation(parameter_bytes=1)
-    def extendedPushBytecode(self, interp, current_bytecode, descriptor):
-        variableType, variableIndex = self._extendedVariableTypeAndIndex(descriptor)
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_extended_variable)
+    def extendedPushBytecode(self, interp, current_bytecode, variableType, variableIndex):
         if variableType == 0:
             self.push(self.w_receiver().fetch(self.space, variableIndex))
         elif variableType == 1:
@@ -205,14 +301,11 @@ class __extend__(ContextPartShadow):
         elif variableType == 2:
             self.push(self.w_method().getliteral(variableIndex))
         elif variableType == 3:
-            w_association = self.w_method().getliteral(variableIndex)
-            association = wrapper.AssociationWrapper(self.space, w_association)
-            self.push(association.value())
+            self._pushLiteralVariable(variableIndex)
         else:
             assert 0
 
-    def _extendedStoreBytecode(self, interp, current_bytecode, descriptor):
-        variableType, variableIndex = self._extendedVariableTypeAndIndex(descriptor)
+    def _extendedStoreBytecode(self, interp, current_bytecode, variableType, variableIndex):
         if variableType == 0:
             self.w_receiver().store(self.space, variableIndex, self.top())
         elif variableType == 1:
@@ -224,13 +317,13 @@ class __extend__(ContextPartShadow):
             association = wrapper.AssociationWrapper(self.space, w_association)
             association.store_value(self.top())
 
-    @bytecode_implementation(parameter_bytes=1)
-    def extendedStoreBytecode(self, interp, current_bytecode, descriptor):
-        return self._extendedStoreBytecode(interp, current_bytecode, descriptor)
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_extended_variable)
+    def extendedStoreBytecode(self, interp, current_bytecode, variableType, variableIndex):
+        return self._extendedStoreBytecode(interp, current_bytecode, variableType, variableIndex)
 
-    @bytecode_implementation(parameter_bytes=1)
-    def extendedStoreAndPopBytecode(self, interp, current_bytecode, descriptor):
-        self._extendedStoreBytecode(interp, current_bytecode, descriptor)
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_extended_variable)
+    def extendedStoreAndPopBytecode(self, interp, current_bytecode, variableType, variableIndex):
+        self._extendedStoreBytecode(interp, current_bytecode, variableType, variableIndex)
         self.pop()
 
     def _extract_index_and_temps(self, index_in_array, index_of_array):
@@ -252,8 +345,8 @@ class __extend__(ContextPartShadow):
         index_in_array, w_indirectTemps = self._extract_index_and_temps(index_in_array, index_of_array)
         w_indirectTemps.atput0(self.space, index_in_array, self.pop())
 
-    @bytecode_implementation(parameter_bytes=3)
-    def pushClosureCopyCopiedValuesBytecode(self, interp, current_bytecode, descriptor, j, i):
+    @bytecode_implementation(parameter_bytes=3, decoder=decode_closure_copy)
+    def pushClosureCopyCopiedValuesBytecode(self, interp, current_bytecode, numArgs, numCopied, blockSize):
         """ Copied from Blogpost: http://www.mirandabanda.org/cogblog/2008/07/22/closures-part-ii-the-bytecodes/
         ContextPart>>pushClosureCopyNumCopiedValues: numCopied numArgs: numArgs blockSize: blockSize
         "Simulate the action of a 'closure copy' bytecode whose result is the
@@ -276,8 +369,6 @@ class __extend__(ContextPartShadow):
         """
 
         space = self.space
-        numArgs, numCopied = splitter[4, 4](descriptor)
-        blockSize = (j << 8) | i
         # Create new instance of BlockClosure
         w_closure = space.newClosure(self.w_self(), self.pc(), numArgs,
                                             self.pop_and_return_n(numCopied))
@@ -289,20 +380,30 @@ class __extend__(ContextPartShadow):
     def _sendSelfSelector(self, w_selector, argcount, interp):
         receiver = self.peek(argcount)
         return self._sendSelector(w_selector, argcount, interp,
-                                  receiver, receiver.class_shadow(self.space))
+                                  receiver, receiver.class_shadow(self.space),
+                                  send_site=True)
 
     def _sendSuperSelector(self, w_selector, argcount, interp):
         compiledin_class = self.w_method().compiled_in()
         assert isinstance(compiledin_class, model.W_PointersObject)
         s_compiledin = compiledin_class.as_class_get_shadow(self.space)
         return self._sendSelector(w_selector, argcount, interp, self.w_receiver(),
-                                  s_compiledin.s_superclass())
+                                  s_compiledin.s_superclass(), send_site=True)
+
+    def _lookup(self, w_selector, receiverclassshadow, send_site):
+        if send_site and not jit.we_are_jitted():
+            # The JIT promotes the receiver class and constant-folds the
+            # lookup, so the inline caches are only used outside of traces.
+            cache = self.w_method().inline_cache_at(self.pc(), w_selector)
+            if cache is not None:
+                return cache.lookup(receiverclassshadow)
+        return receiverclassshadow.lookup(w_selector)
 
     def _sendSelector(self, w_selector, argcount, interp,
-                      receiver, receiverclassshadow, w_arguments=None):
+                      receiver, receiverclassshadow, w_arguments=None, send_site=False):
         assert argcount >= 0
         try:
-            w_method = receiverclassshadow.lookup(w_selector)
+            w_method = self._lookup(w_selector, receiverclassshadow, send_site)
         except error.MethodNotFound:
             return self._doesNotUnderstand(w_selector, argcount, interp, receiver)
         
@@ -330,10 +431,14 @@ class __extend__(ContextPartShadow):
         w_selector = self.space.get_special_selector(selector)
         return self._sendSelfSelector(w_selector, numargs, interp)
 
+    @objectmodel.specialize.arg(3)
     def _sendSpecialSelector(self, interp, receiver, special_selector, w_args=[]):
-        w_special_selector = self.space.objtable["w_" + special_selector]
         s_class = receiver.class_shadow(self.space)
+        w_special_selector = self.space.objtable["w_" + special_selector]
         w_method = s_class.lookup(w_special_selector)
+        return self._activateSpecialMethod(interp, receiver, special_selector, w_method, w_args)
+
+    def _activateSpecialMethod(self, interp, receiver, special_selector, w_method, w_args):
         s_frame = w_method.create_frame(interp.space, receiver, w_args)
         
         # ######################################################################
@@ -344,22 +449,20 @@ class __extend__(ContextPartShadow):
 
     def _doesNotUnderstand(self, w_selector, argcount, interp, receiver):
         arguments = self.pop_and_return_n(argcount)
-        w_message_class = self.space.classtable["w_Message"]
-        assert isinstance(w_message_class, model.W_PointersObject)
-        s_message_class = w_message_class.as_class_get_shadow(self.space)
+        s_class = receiver.class_shadow(self.space)
+        try:
+            w_method, s_message_class = s_class.lookup_doesNotUnderstand()
+        except error.MethodNotFound:
+            assert isinstance(s_class, ClassShadow)
+            raise error.Exit("Missing doesNotUnderstand in hierarchy of %s" % s_class.getname())
         w_message = s_message_class.new()
         w_message.store(self.space, 0, w_selector)
         w_message.store(self.space, 1, self.space.wrap_list(arguments))
         self.pop() # The receiver, already known.
 
-        try:
-            if interp.space.headless.is_set():
-                primitives.exitFromHeadlessExecution(self, "doesNotUnderstand:", w_message)
-            return self._sendSpecialSelector(interp, receiver, "doesNotUnderstand", [w_message])
-        except error.MethodNotFound:
-            s_class = receiver.class_shadow(self.space)
-            assert isinstance(s_class, ClassShadow)
-            raise error.Exit("Missing doesNotUnderstand in hierarchy of %s" % s_class.getname())
+        if interp.space.headless.is_set():
+            primitives.exitFromHeadlessExecution(self, "doesNotUnderstand:", w_message)
+        return self._activateSpecialMethod(interp, receiver, "doesNotUnderstand", w_method, [w_message])
 
     def _mustBeBoolean(self, interp, receiver):
         return self._sendSpecialSelector(interp, receiver, "mustBeBoolean")
@@ -392,11 +495,11 @@ class __extend__(ContextPartShadow):
         if self.home_is_self() or local_return:
             # a local return just needs to go up the stack once. there
             # it will find the sender as a local, and we don't have to
-            # force the reference
-            s_return_to = None
-        else:
-            s_return_to = self.s_home().s_sender()
-            assert s_return_to, "No sender to return to!"
+            # force the reference. The value is handed to stack_frame
+            # as the result of loop_bytecodes.
+            return return_value
+        s_return_to = self.s_home().s_sender()
+        assert s_return_to, "No sender to return to!"
         
         from spyvm.interpreter import Return
         raise Return(s_return_to, return_value)
@@ -427,32 +530,26 @@ class __extend__(ContextPartShadow):
     def returnTopFromBlockBytecode(self, interp, current_bytecode):
         return self._return(self.pop(), interp, local_return=True)
 
-    @bytecode_implementation()
-    def sendLiteralSelectorBytecode(self, interp, current_bytecode):
-        w_selector = self.w_method().getliteral(current_bytecode & 15)
-        argcount = ((current_bytecode >> 4) & 3) - 1
+    @bytecode_implementation(decoder=decode_literal_send)
+    def sendLiteralSelectorBytecode(self, interp, current_bytecode, index, argcount):
+        w_selector = self.w_method().getliteral(index)
         return self._sendSelfSelector(w_selector, argcount, interp)
 
-    def _getExtendedSelectorArgcount(self, descriptor):
-        return ((self.w_method().getliteral(descriptor & 31)),
-                (descriptor >> 5))
-
-    @bytecode_implementation(parameter_bytes=1)
-    def singleExtendedSendBytecode(self, interp, current_bytecode, descriptor):
-        w_selector, argcount = self._getExtendedSelectorArgcount(descriptor)
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_single_extended_send)
+    def singleExtendedSendBytecode(self, interp, current_bytecode, index, argcount):
+        w_selector = self.w_method().getliteral(index)
         return self._sendSelfSelector(w_selector, argcount, interp)
 
-    @bytecode_implementation(parameter_bytes=2)
-    def doubleExtendedDoAnythingBytecode(self, interp, current_bytecode, second, third):
-        opType = second >> 5
+    @bytecode_implementation(parameter_bytes=2, decoder=decode_double_extended)
+    def doubleExtendedDoAnythingBytecode(self, interp, current_bytecode, opType, argcount, third):
         if opType == 0:
             # selfsend
             return self._sendSelfSelector(self.w_method().getliteral(third),
-                                          second & 31, interp)
+                                          argcount, interp)
         elif opType == 1:
             # supersend
             return self._sendSuperSelector(self.w_method().getliteral(third),
-                                           second & 31, interp)
+                                           argcount, interp)
         elif opType == 2:
             # pushReceiver
             self.push(self.w_receiver().fetch(self.space, third))
@@ -461,9 +558,7 @@ class __extend__(ContextPartShadow):
             self.push(self.w_method().getliteral(third))
         elif opType == 4:
             # pushLiteralVariable
-            w_association = self.w_method().getliteral(third)
-            association = wrapper.AssociationWrapper(self.space, w_association)
-            self.push(association.value())
+            self._pushLiteralVariable(third)
         elif opType == 5:
             self.w_receiver().store(self.space, third, self.top())
         elif opType == 6:
@@ -473,15 +568,14 @@ class __extend__(ContextPartShadow):
             association = wrapper.AssociationWrapper(self.space, w_association)
             association.store_value(self.top())
 
-    @bytecode_implementation(parameter_bytes=1)
-    def singleExtendedSuperBytecode(self, interp, current_bytecode, descriptor):
-        w_selector, argcount = self._getExtendedSelectorArgcount(descriptor)
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_single_extended_send)
+    def singleExtendedSuperBytecode(self, interp, current_bytecode, index, argcount):
+        w_selector = self.w_method().getliteral(index)
         return self._sendSuperSelector(w_selector, argcount, interp)
 
-    @bytecode_implementation(parameter_bytes=1)
-    def secondExtendedSendBytecode(self, interp, current_bytecode, descriptor):
-        w_selector = self.w_method().getliteral(descriptor & 63)
-        argcount = descriptor >> 6
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_second_extended_send)
+    def secondExtendedSendBytecode(self, interp, current_bytecode, index, argcount):
+        w_selector = self.w_method().getliteral(index)
         return self._sendSelfSelector(w_selector, argcount, interp)
 
     # ====== Misc ======
@@ -494,13 +588,10 @@ class __extend__(ContextPartShadow):
         if self.gettemp(1).is_nil(self.space):
             self.settemp(1, self.space.w_true) # mark unwound
             self.push(self.gettemp(0)) # push the first argument
-            from spyvm.interpreter import Return
             try:
-                self.bytecodePrimValue(interp, 0)
-            except Return, ret:
+                self.bytecodePrimValue(interp, 0, 0, 0, 0)
                 # Local return value of ensure: block is ignored
-                if not ret.arrived_at_target:
-                    raise ret
+                self.pop()
             finally:
                 self.mark_returned()
     
@@ -535,9 +626,6 @@ class __extend__(ContextPartShadow):
     def _shortJumpOffset(self, current_bytecode):
         return (current_bytecode & 7) + 1
 
-    def _longJumpOffset(self, current_bytecode, parameter):
-        return ((current_bytecode & 3) << 8) + parameter
-
     @bytecode_implementation()
     def shortUnconditionalJumpBytecode(self, interp, current_bytecode):
         self._jump(self._shortJumpOffset(current_bytecode))
@@ -547,30 +635,29 @@ class __extend__(ContextPartShadow):
         # The conditional jump is "jump on false"
         self._jumpConditional(interp, False, self._shortJumpOffset(current_bytecode))
 
-    @bytecode_implementation(parameter_bytes=1)
-    def longUnconditionalJumpBytecode(self, interp, current_bytecode, parameter):
-        offset = (((current_bytecode & 7) - 4) << 8) + parameter
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_long_jump)
+    def longUnconditionalJumpBytecode(self, interp, current_bytecode, offset):
         self._jump(offset)
 
-    @bytecode_implementation(parameter_bytes=1)
-    def longJumpIfTrueBytecode(self, interp, current_bytecode, parameter):
-        self._jumpConditional(interp, True, self._longJumpOffset(current_bytecode, parameter))
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_long_conditional_jump)
+    def longJumpIfTrueBytecode(self, interp, current_bytecode, offset):
+        self._jumpConditional(interp, True, offset)
 
-    @bytecode_implementation(parameter_bytes=1)
-    def longJumpIfFalseBytecode(self, interp, current_bytecode, parameter):
-        self._jumpConditional(interp, False, self._longJumpOffset(current_bytecode, parameter))
+    @bytecode_implementation(parameter_bytes=1, decoder=decode_long_conditional_jump)
+    def longJumpIfFalseBytecode(self, interp, current_bytecode, offset):
+        self._jumpConditional(interp, False, offset)
 
     # ====== Bytecodes implemented with primitives and message sends ======
 
-    bytecodePrimAdd = make_call_primitive_bytecode(primitives.ADD, "+", 1)
-    bytecodePrimSubtract = make_call_primitive_bytecode(primitives.SUBTRACT, "-", 1)
-    bytecodePrimLessThan = make_call_primitive_bytecode (primitives.LESSTHAN, "<", 1)
-    bytecodePrimGreaterThan = make_call_primitive_bytecode(primitives.GREATERTHAN, ">", 1)
-    bytecodePrimLessOrEqual = make_call_primitive_bytecode(primitives.LESSOREQUAL,  "<=", 1)
-    bytecodePrimGreaterOrEqual = make_call_primitive_bytecode(primitives.GREATEROREQUAL,  ">=", 1)
-    bytecodePrimEqual = make_call_primitive_bytecode(primitives.EQUAL,   "=", 1)
-    bytecodePrimNotEqual = make_call_primitive_bytecode(primitives.NOTEQUAL,  "~=", 1)
-    bytecodePrimMultiply = make_call_primitive_bytecode(primitives.MULTIPLY,  "*", 1)
+    bytecodePrimAdd = make_arithmetic_bytecode(primitives.ADD, "+", operator.add)
+    bytecodePrimSubtract = make_arithmetic_bytecode(primitives.SUBTRACT, "-", operator.sub)
+    bytecodePrimLessThan = make_arithmetic_bytecode(primitives.LESSTHAN, "<", operator.lt, is_comparison=True)
+    bytecodePrimGreaterThan = make_arithmetic_bytecode(primitives.GREATERTHAN, ">", operator.gt, is_comparison=True)
+    bytecodePrimLessOrEqual = make_arithmetic_bytecode(primitives.LESSOREQUAL, "<=", operator.le, is_comparison=True)
+    bytecodePrimGreaterOrEqual = make_arithmetic_bytecode(primitives.GREATEROREQUAL, ">=", operator.ge, is_comparison=True)
+    bytecodePrimEqual = make_arithmetic_bytecode(primitives.EQUAL, "=", operator.eq, is_comparison=True)
+    bytecodePrimNotEqual = make_arithmetic_bytecode(primitives.NOTEQUAL, "~=", operator.ne, is_comparison=True)
+    bytecodePrimMultiply = make_arithmetic_bytecode(primitives.MULTIPLY, "*", operator.mul)
     bytecodePrimDivide = make_call_primitive_bytecode(primitives.DIVIDE,  "/", 1)
     bytecodePrimMod = make_call_primitive_bytecode(primitives.MOD, "\\\\", 1)
     bytecodePrimMakePoint = make_call_primitive_bytecode(primitives.MAKE_POINT, "@", 1)
@@ -579,9 +666,67 @@ class __extend__(ContextPartShadow):
     bytecodePrimBitAnd = make_call_primitive_bytecode(primitives.BIT_AND, "bitAnd:", 1)
     bytecodePrimBitOr = make_call_primitive_bytecode(primitives.BIT_OR, "bitOr:", 1)
 
-    bytecodePrimAt = make_send_selector_bytecode("at:", 1)
-    bytecodePrimAtPut = make_send_selector_bytecode("at:put:", 2)
-    bytecodePrimSize = make_send_selector_bytecode("size", 0)
+    # at:, at:put: and size access the receiver directly (like the atCache of Squeak),
+    # if the method of the receiver class is the usual primitive (see at_cache_primitive).
+    # The message is sent if the class overrides the method, or the primitive would fail.
+
+    @bytecode_implementation()
+    def bytecodePrimAt(self, interp, current_bytecode):
+        w_rcvr = self.peek(1)
+        w_index = self.peek(0)
+        code = w_rcvr.class_shadow(self.space).at_cache_primitive(storage_classes.AT_CACHE_AT)
+        if ((code == primitives.AT or code == primitives.STRING_AT)
+                and isinstance(w_index, model.W_SmallInteger)):
+            n0 = w_index.value - 1
+            if 0 <= n0 < w_rcvr.varsize():
+                if code == primitives.AT:
+                    w_result = w_rcvr.at0(self.space, n0)
+                elif isinstance(w_rcvr, model.W_BytesObject):
+                    w_result = self.space.wrap_char(w_rcvr.getchar(n0))
+                else:
+                    w_result = None
+                if w_result is not None:
+                    self.pop_n(2)
+                    self.push(w_result)
+                    return
+        return self._sendSelfSelectorSpecial("at:", 1, interp)
+
+    @bytecode_implementation()
+    def bytecodePrimAtPut(self, interp, current_bytecode):
+        w_rcvr = self.peek(2)
+        w_index = self.peek(1)
+        w_value = self.peek(0)
+        code = w_rcvr.class_shadow(self.space).at_cache_primitive(storage_classes.AT_CACHE_AT_PUT)
+        if ((code == primitives.AT_PUT or code == primitives.STRING_AT_PUT)
+                and isinstance(w_index, model.W_SmallInteger)):
+            n0 = w_index.value - 1
+            if 0 <= n0 < w_rcvr.varsize():
+                try:
+                    if code == primitives.AT_PUT:
+                        w_rcvr.atput0(self.space, n0, w_value)
+                    elif isinstance(w_rcvr, model.W_BytesObject):
+                        w_rcvr.setchar(n0, self.space.unwrap_char(w_value))
+                    else:
+                        raise error.PrimitiveFailedError()
+                except error.PrimitiveFailedError:
+                    pass
+                else:
+                    self.pop_n(3)
+                    self.push(w_value)
+                    return
+        return self._sendSelfSelectorSpecial("at:put:", 2, interp)
+
+    @bytecode_implementation()
+    def bytecodePrimSize(self, interp, current_bytecode):
+        w_rcvr = self.peek(0)
+        s_class = w_rcvr.class_shadow(self.space)
+        if (s_class.at_cache_primitive(storage_classes.AT_CACHE_SIZE) == primitives.SIZE
+                and s_class.isvariable()):
+            self.pop()
+            self.push(self.space.wrap_int(w_rcvr.varsize()))
+            return
+        return self._sendSelfSelectorSpecial("size", 0, interp)
+
     bytecodePrimNext = make_send_selector_bytecode("next", 0)
     bytecodePrimNextPut = make_send_selector_bytecode("nextPut:", 1)
     bytecodePrimAtEnd = make_send_selector_bytecode("atEnd", 0)
@@ -598,6 +743,26 @@ class __extend__(ContextPartShadow):
     bytecodePrimNewWithArg = make_send_selector_bytecode("new:", 1)
     bytecodePrimPointX = make_send_selector_bytecode("x", 0)
     bytecodePrimPointY = make_send_selector_bytecode("y", 0)
+
+    # ====== Superinstructions ======
+
+    @bytecode_implementation()
+    def pushTemporaryLiteralAddSuperinstruction(self, interp, current_bytecode, push_temporary, push_literal):
+        self.pushTemporaryVariableBytecode(interp, push_temporary, 0, 0, 0)
+        self.pushLiteralConstantBytecode(interp, push_literal, 0, 0, 0)
+        return self.bytecodePrimAdd(interp, 176, 0, 0, 0)
+
+    @bytecode_implementation()
+    def pushReceiverVariableReturnSuperinstruction(self, interp, current_bytecode, push_receiver_variable):
+        self.pushReceiverVariableBytecode(interp, push_receiver_variable, 0, 0, 0)
+        return self.returnTopFromMethodBytecode(interp, 124, 0, 0, 0)
+
+    lessThanJumpSuperinstruction = make_compare_and_jump_superinstruction(178, bytecodePrimLessThan)
+    greaterThanJumpSuperinstruction = make_compare_and_jump_superinstruction(179, bytecodePrimGreaterThan)
+    lessOrEqualJumpSuperinstruction = make_compare_and_jump_superinstruction(180, bytecodePrimLessOrEqual)
+    greaterOrEqualJumpSuperinstruction = make_compare_and_jump_superinstruction(181, bytecodePrimGreaterOrEqual)
+    equalJumpSuperinstruction = make_compare_and_jump_superinstruction(182, bytecodePrimEqual)
+    notEqualJumpSuperinstruction = make_compare_and_jump_superinstruction(183, bytecodePrimNotEqual)
     
     def debug_bytecode(self, interp):
         # Hook used in interpreter_debugging
@@ -682,9 +847,23 @@ BYTECODE_RANGES = [
             (208, 255, "sendLiteralSelectorBytecode"),
             ]
 
+# Superinstructions execute a frequent sequence of bytecodes at once. They are
+# not part of the bytecode set, their opcodes only appear in the pre-decoded
+# instruction stream of compiled methods (see fuse_bytecodes).
+SUPERINSTRUCTIONS = [
+            (256, "pushTemporaryLiteralAddSuperinstruction"),
+            (257, "pushReceiverVariableReturnSuperinstruction"),
+            (258, "lessThanJumpSuperinstruction"),
+            (259, "greaterThanJumpSuperinstruction"),
+            (260, "lessOrEqualJumpSuperinstruction"),
+            (261, "greaterOrEqualJumpSuperinstruction"),
+            (262, "equalJumpSuperinstruction"),
+            (263, "notEqualJumpSuperinstruction"),
+            ]
+
 def initialize_bytecode_names():
-    result = [None] * 256
-    for entry in BYTECODE_RANGES:
+    result = [None] * (256 + len(SUPERINSTRUCTIONS))
+    for entry in BYTECODE_RANGES + SUPERINSTRUCTIONS:
         if len(entry) == 2:
             result[entry[0]] = entry[1]
         else:
@@ -709,3 +888,92 @@ def initialize_bytecode_table():
 
 # this table is only used for creating named bytecodes in tests and printing
 BYTECODE_TABLE = initialize_bytecode_table()
+
+def initialize_bytecode_dispatch():
+    implementations = []
+    dispatch = [-1] * (256 + len(SUPERINSTRUCTIONS))
+    for entry in BYTECODE_RANGES + SUPERINSTRUCTIONS:
+        if len(entry) == 2:
+            positions = [entry[0]]
+        else:
+            positions = range(entry[0], entry[1]+1)
+        methname = entry[-1]
+        if methname not in implementations:
+            implementations.append(methname)
+        for pos in positions:
+            dispatch[pos] = implementations.index(methname)
+    assert -1 not in dispatch
+    return implementations, dispatch
+
+# BYTECODE_DISPATCH maps every bytecode (and superinstruction) to an index into
+# BYTECODE_IMPLEMENTATIONS, which holds the names of the handler methods of ContextPartShadow
+BYTECODE_IMPLEMENTATIONS, BYTECODE_DISPATCH = initialize_bytecode_dispatch()
+
+def make_bytecode_handler(methname):
+    def handle_bytecode(context, interp, bytecode, first, second, third):
+        return getattr(context, methname)(interp, bytecode, first, second, third)
+    handle_bytecode.func_name = "handle_" + methname
+    return handle_bytecode
+
+# BYTECODE_HANDLERS holds the function executing each bytecode (and superinstruction).
+# Interpreter.step calls it through this table, translated and untranslated.
+BYTECODE_HANDLERS = [make_bytecode_handler(methname) for methname in BYTECODE_IMPLEMENTATIONS]
+BYTECODE_HANDLERS = [BYTECODE_HANDLERS[index] for index in BYTECODE_DISPATCH]
+
+UNROLLING_BYTECODE_DECODERS = unroll.unrolling_iterable([
+    (i, getattr(ContextPartShadow, methname).im_func.parameter_bytes,
+        getattr(ContextPartShadow, methname).im_func.decoder)
+    for i, methname in enumerate(BYTECODE_IMPLEMENTATIONS)
+    if i in BYTECODE_DISPATCH[:256]])
+
+def fuse_bytecodes(w_method, pc):
+    # Returns the superinstruction executing the bytecodes starting at pc,
+    # its operands and the pc after the fused bytecodes. The opcode is -1 if
+    # the bytecodes cannot be fused.
+    size = len(w_method.bytes)
+    if pc + 1 >= size:
+        return -1, 0, 0, 0
+    bytecode = ord(w_method.fetch_bytecode(pc))
+    following = ord(w_method.fetch_bytecode(pc + 1))
+    if 16 <= bytecode <= 31 and 32 <= following <= 63:
+        if pc + 2 < size and ord(w_method.fetch_bytecode(pc + 2)) == 176:
+            return 256, bytecode, following, pc + 3
+    elif 0 <= bytecode <= 15 and following == 124:
+        return 257, bytecode, 0, pc + 2
+    elif 178 <= bytecode <= 183:
+        opcode = 258 + bytecode - 178
+        if 152 <= following <= 159:
+            return opcode, following, (following & 7) + 1, pc + 2
+        elif 168 <= following <= 175 and pc + 2 < size:
+            parameter = ord(w_method.fetch_bytecode(pc + 2))
+            return opcode, following, ((following & 3) << 8) + parameter, pc + 3
+    return -1, 0, 0, 0
+
+def decode_instruction(space, w_method, pc, instructions, start):
+    # Fills in the pre-decoded instruction at pc: the bytecode, the three
+    # operands computed by the decoder of its implementation, and the pc
+    # of the next instruction.
+    if not space.no_superinstructions.is_set():
+        opcode, first, second, next_pc = fuse_bytecodes(w_method, pc)
+        if opcode != -1:
+            instructions[start + 1] = first
+            instructions[start + 2] = second
+            instructions[start + 3] = 0
+            instructions[start + 4] = next_pc
+            instructions[start] = opcode
+            return
+    bytecode = ord(w_method.fetch_bytecode(pc))
+    index = BYTECODE_DISPATCH[bytecode]
+    for i, parameter_bytes, decoder in UNROLLING_BYTECODE_DECODERS:
+        if index == i:
+            parameters = [0, 0, 0]
+            for j in range(parameter_bytes):
+                parameters[j] = ord(w_method.fetch_bytecode(pc + 1 + j))
+            first, second, third = decoder(bytecode, parameters[0], parameters[1], parameters[2])
+            instructions[start + 1] = first
+            instructions[start + 2] = second
+            instructions[start + 3] = third
+            instructions[start + 4] = pc + 1 + parameter_bytes
+            instructions[start] = bytecode
+            return
+    assert 0, "unreachable"
@@ -56,10 +56,10 @@ def activate_debugging():
     
     @patch_context
     def _sendSelector(original):
-        def meth(self, w_selector, argcount, interp, receiver, receiverclassshadow, w_arguments=None):
+        def meth(self, w_selector, argcount, interp, receiver, receiverclassshadow, w_arguments=None, send_site=False):
             if interp.step_sends:
                 _break() # Continue stepping from here to get to the current message send
-            return original(self, w_selector, argcount, interp, receiver, receiverclassshadow, w_arguments=w_arguments)
+            return original(self, w_selector, argcount, interp, receiver, receiverclassshadow, w_arguments=w_arguments, send_site=send_site)
         return meth
     
     @patch_context
@@ -13,7 +13,7 @@ Squeak model.
 """
 import sys
 from spyvm import constants, error
-from spyvm.util.version import constant_for_version, constant_for_version_arg, VersionMixin
+from spyvm.util.version import constant_for_version, constant_for_version_arg, constant_for_version_two_args, VersionMixin
 
 from rpython.rlib import rrandom, objectmodel, jit, signature
 from rpython.rlib.rarithmetic import intmask, r_uint, r_int
@@ -23,6 +23,16 @@ from rpython.rlib.objectmodel import instantiate, compute_hash, import_from_mixi
 from rpython.rtyper.lltypesystem import lltype, rffi
 from rsdl import RSDL, RSDL_helper
 
+def copy_list_range(dest, dest_start0, src, src_start0, count):
+    # Copies count elements forward, like replaceFrom:to:with:startingAt:.
+    # The slice assignment is translated to an arraycopy. Only a copy to a later, overlapping
+    # range of the same list has to go element by element to repeat the copied elements.
+    if dest is src and src_start0 < dest_start0 < src_start0 + count:
+        for i in range(count):
+            dest[dest_start0 + i] = src[src_start0 + i]
+    elif count > 0:
+        dest[dest_start0:dest_start0 + count] = src[src_start0:src_start0 + count]
+
 class W_Object(object):
     """Root of Squeak model, abstract."""
     _attrs_ = []    # no RPython-level instance variables allowed in W_Object
@@ -83,6 +93,14 @@ class W_Object(object):
         otherwise patches bytecode (ie byte code indexing starts at literalsize)."""
         raise NotImplementedError()
 
+    def replace_range(self, space, start0, stop0, w_replacement, rep_start0):
+        """Store the elements of w_replacement, starting at rep_start0, into the
+        variable-sized part from start0 to stop0, as by replaceFrom:to:with:startingAt:.
+        The caller checks the bounds. Subclasses copy without boxing if possible."""
+        rep_off = rep_start0 - start0
+        for i0 in range(start0, stop0 + 1):
+            self.atput0(space, i0, w_replacement.at0(space, rep_off + i0))
+
     def fetch(self, space, n0):
         """Access fixed-size part, maybe also variable-sized part (we have to
         consult the Blue Book)."""
@@ -130,6 +148,10 @@ class W_Object(object):
         used as class)."""
         return False
 
+    def is_context(self, space):
+        """Return True, if the receiver is a MethodContext or BlockContext."""
+        return False
+
     def become(self, other):
         """Become swaps two objects.
            False means swapping failed"""
@@ -195,17 +217,17 @@ class W_Object(object):
     def selector_string(self):
         return self.as_repr_string()
 
-class W_SmallInteger(W_Object):
-    """Boxed integer value"""
+class W_SmallInteger(W_Object, objectmodel.UnboxedValue):
+    """Integer value. Represented as a tagged pointer when translated with
+    --taggedpointers, so wrapping an int does not allocate. Constructing it
+    raises OverflowError if the value does not fit into a tagged pointer,
+    see ObjSpace.wrap_int."""
     # TODO can we tell pypy that its never larger then 31-bit?
     _attrs_ = ['value']
     __slots__ = ('value',)     # the only allowed slot here
     _immutable_fields_ = ["value"]
     repr_classname = "W_SmallInteger"
 
-    def __init__(self, value):
-        self.value = intmask(value)
-
     def getclass(self, space):
         return space.w_SmallInteger
 
@@ -596,6 +618,14 @@ class W_PointersObject(W_AbstractObjectWithClassReference):
             return True
         return W_AbstractObjectWithClassReference.is_class(self, space)
 
+    def is_context(self, space):
+        from spyvm.storage_contexts import ContextPartShadow
+        if isinstance(self.shadow, ContextPartShadow):
+            return True
+        w_class = self.getclass(space)
+        return (w_class.is_same_object(space.w_MethodContext) or
+                w_class.is_same_object(space.w_BlockContext))
+
     def assert_shadow(self):
         # Failing the following assert most likely indicates a bug. The shadow can only be absent during
         # the bootstrapping sequence. It will be initialized in the fillin() method. Before that, it should
@@ -631,6 +661,8 @@ class W_PointersObject(W_AbstractObjectWithClassReference):
         # The size of the object cannot be changed in any case.
         my_length = self.size()
         incoming_length = min(my_length, len(collection))
+        if incoming_length == my_length:
+            space.strategy_factory.specialize_for(self, collection)
         i = 0
         while i < incoming_length:
             self.store(space, i, collection[i])
@@ -647,6 +679,17 @@ class W_PointersObject(W_AbstractObjectWithClassReference):
         # To test, at0 = in varsize part
         self.store(space, index0 + self.instsize(), w_value)
 
+    def replace_range(self, space, start0, stop0, w_replacement, rep_start0):
+        assert isinstance(w_replacement, W_PointersObject)
+        count = stop0 - start0 + 1
+        s_self = self._get_shadow()
+        s_replacement = w_replacement._get_shadow()
+        if not s_self.copy_range_from(start0 + self.instsize(), s_replacement,
+                                      rep_start0 + w_replacement.instsize(), count):
+            W_AbstractObjectWithClassReference.replace_range(
+                self, space, start0, stop0, w_replacement, rep_start0)
+        space.strategy_factory.bulk_stored(self, count)
+
     def fetch(self, space, n0):
         return self._get_shadow().fetch(n0)
 
@@ -749,13 +792,18 @@ class W_PointersObject(W_AbstractObjectWithClassReference):
 
     @jit.unroll_safe
     def clone(self, space):
-        my_pointers = self.fetch_all(space)
-        w_result = W_PointersObject(space, self.getclass(space), len(my_pointers))
-        w_result.store_all(space, my_pointers)
+        w_result = instantiate(W_PointersObject)
+        W_AbstractObjectWithClassReference.__init__(w_result, space, self.getclass(space))
+        if not space.strategy_factory.clone_strategy(self, w_result):
+            my_pointers = self.fetch_all(space)
+            w_result.initialize_storage(space, len(my_pointers))
+            w_result.store_all(space, my_pointers)
         return w_result
 
 class W_BytesObject(W_AbstractObjectWithClassReference):
-    _attrs_ = ['bytes', 'c_bytes', '_size']
+    """The bytes are stored in a list of chars, which is translated to
+    a contiguous, GC-managed array with one byte per element."""
+    _attrs_ = ['bytes']
     repr_classname = 'W_BytesObject'
     bytes_per_slot = 1
 
@@ -763,12 +811,13 @@ class W_BytesObject(W_AbstractObjectWithClassReference):
         W_AbstractObjectWithClassReference.__init__(self, space, w_class)
         assert isinstance(size, int)
         self.bytes = ['\x00'] * size
-        self._size = size
 
     def fillin(self, space, g_self):
         W_AbstractObjectWithClassReference.fillin(self, space, g_self)
-        self.bytes = g_self.get_bytes()
-        self._size = len(self.bytes)
+        bytes = g_self.get_bytes()
+        self.bytes = ['\x00'] * len(bytes)
+        for i in range(len(bytes)):
+            self.bytes[i] = bytes[i]
 
     def at0(self, space, index0):
         return space.wrap_int(ord(self.getchar(index0)))
@@ -777,19 +826,18 @@ class W_BytesObject(W_AbstractObjectWithClassReference):
         self.setchar(index0, chr(space.unwrap_int(w_value)))
 
     def getchar(self, n0):
-        if self.bytes is not None:
-            return self.bytes[n0]
-        else:
-            if n0 >= self._size:
-                raise IndexError
-            return self.c_bytes[n0]
+        return self.bytes[n0]
 
     def setchar(self, n0, character):
         assert len(character) == 1
-        if self.bytes is not None:
-            self.bytes[n0] = character
-        else:
-            self.c_bytes[n0] = character
+        self.bytes[n0] = character
+
+    def replace_range(self, space, start0, stop0, w_replacement, rep_start0):
+        assert isinstance(w_replacement, W_BytesObject)
+        copy_list_range(self.bytes, start0, w_replacement.bytes, rep_start0, stop0 - start0 + 1)
+
+    def fill(self, value):
+        self.bytes = [chr(value)] * len(self.bytes)
 
     def short_at0(self, space, index0):
         byte_index0 = index0 * 2
@@ -811,7 +859,7 @@ class W_BytesObject(W_AbstractObjectWithClassReference):
         self.setchar(byte_index0 + 1, chr(byte1))
 
     def size(self):
-        return self._size
+        return len(self.bytes)
 
     def str_content(self):
         if self.has_class() and self.w_class.has_space():
@@ -820,11 +868,7 @@ class W_BytesObject(W_AbstractObjectWithClassReference):
         return "'%s'" % self.as_string().replace('\r', '\n')
 
     def as_string(self):
-        if self.bytes is not None:
-            string = "".join(self.bytes)
-        else:
-            string = "".join([self.c_bytes[i] for i in range(self.size())])
-        return string
+        return "".join(self.bytes)
 
     def selector_string(self):
         return "#" + self.as_string()
@@ -846,7 +890,7 @@ class W_BytesObject(W_AbstractObjectWithClassReference):
         size = self.size()
         if size != other.size():
             return False
-        elif size > 256 and self.bytes is not None and other.bytes is not None:
+        elif size > 256:
             return self.bytes == other.bytes
         else:
             return self.has_same_chars(other, size)
@@ -859,12 +903,8 @@ class W_BytesObject(W_AbstractObjectWithClassReference):
         return True
 
     def clone(self, space):
-        size = self.size()
-        w_result = W_BytesObject(space, self.getclass(space), size)
-        if self.bytes is not None:
-            w_result.bytes = list(self.bytes)
-        else:
-            w_result.bytes = [self.c_bytes[i] for i in range(size)]
+        w_result = W_BytesObject(space, self.getclass(space), 0)
+        w_result.bytes = list(self.bytes)
         return w_result
 
     def unwrap_uint(self, space):
@@ -883,27 +923,28 @@ class W_BytesObject(W_AbstractObjectWithClassReference):
     def _become(self, w_other):
         assert isinstance(w_other, W_BytesObject)
         self.bytes, w_other.bytes = w_other.bytes, self.bytes
-        self.c_bytes, w_other.c_bytes = w_other.c_bytes, self.c_bytes
-        self._size, w_other._size = w_other._size, self._size
         W_AbstractObjectWithClassReference._become(self, w_other)
 
-    def __del__(self):
-        if self.bytes is None:
-            rffi.free_charp(self.c_bytes)
+# Words are stored as 32 bit values, also on 64 bit hosts.
+def store_word(word):
+    return rffi.cast(rffi.UINT, word)
 
 class W_WordsObject(W_AbstractObjectWithClassReference):
-    _attrs_ = ['words', 'c_words', '_size']
+    """The words are stored in a list of 32 bit unsigned integers,
+    which is translated to a contiguous, GC-managed array with four bytes per element."""
+    _attrs_ = ['words']
     repr_classname = "W_WordsObject"
 
     def __init__(self, space, w_class, size):
         W_AbstractObjectWithClassReference.__init__(self, space, w_class)
-        self.words = [r_uint(0)] * size
-        self._size = size
+        self.words = [store_word(0)] * size
 
     def fillin(self, space, g_self):
         W_AbstractObjectWithClassReference.fillin(self, space, g_self)
-        self.words = g_self.get_ruints()
-        self._size = len(self.words)
+        words = g_self.get_ruints()
+        self.words = [store_word(0)] * len(words)
+        for i in range(len(words)):
+            self.words[i] = store_word(words[i])
 
     def at0(self, space, index0):
         val = self.getword(index0)
@@ -915,16 +956,17 @@ class W_WordsObject(W_AbstractObjectWithClassReference):
 
     def getword(self, n):
         assert self.size() > n >= 0
-        if self.words is not None:
-            return self.words[n]
-        else:
-            return r_uint(self.c_words[n])
+        return r_uint(self.words[n])
 
     def setword(self, n, word):
-        if self.words is not None:
-            self.words[n] = r_uint(word)
-        else:
-            self.c_words[n] = intmask(word)
+        self.words[n] = store_word(word)
+
+    def replace_range(self, space, start0, stop0, w_replacement, rep_start0):
+        assert isinstance(w_replacement, W_WordsObject)
+        copy_list_range(self.words, start0, w_replacement.words, rep_start0, stop0 - start0 + 1)
+
+    def fill(self, value):
+        self.words = [store_word(value)] * len(self.words)
 
     def short_at0(self, space, index0):
         word = intmask(self.getword(index0 / 2))
@@ -951,19 +993,15 @@ class W_WordsObject(W_AbstractObjectWithClassReference):
         self.setword(word_index0, value)
 
     def size(self):
-        return self._size
+        return len(self.words)
 
     def invariant(self):
         return (W_AbstractObjectWithClassReference.invariant(self) and
                 isinstance(self.words, list))
 
     def clone(self, space):
-        size = self.size()
-        w_result = W_WordsObject(space, self.getclass(space), size)
-        if self.words is not None:
-            w_result.words = list(self.words)
-        else:
-            w_result.words = [r_uint(self.c_words[i]) for i in range(size)]
+        w_result = W_WordsObject(space, self.getclass(space), 0)
+        w_result.words = list(self.words)
         return w_result
 
     def is_array_object(self):
@@ -972,14 +1010,8 @@ class W_WordsObject(W_AbstractObjectWithClassReference):
     def _become(self, w_other):
         assert isinstance(w_other, W_WordsObject)
         self.words, w_other.words = w_other.words, self.words
-        self.c_words, w_other.c_words = w_other.c_words, self.c_words
-        self._size, w_other._size = w_other._size, self._size
         W_AbstractObjectWithClassReference._become(self, w_other)
 
-    def __del__(self):
-        if self.words is None:
-            lltype.free(self.c_words, flavor='raw')
-
 class W_CompiledMethod(W_AbstractObjectWithIdentityHash):
     """My instances are methods suitable for interpretation by the virtual machine.  This is the only class in the system whose instances intermix both indexable pointer fields and indexable integer fields.
 
@@ -1000,10 +1032,16 @@ class W_CompiledMethod(W_AbstractObjectWithIdentityHash):
                 # Main method content
                 "bytes", "literals",
                 # Additional info about the method
-                "lookup_selector", "compiledin_class", "lookup_class" ]
+                "lookup_selector", "compiledin_class", "lookup_class",
+                # Inline caches of the send sites, indexed by pc
+                "inline_caches",
+                # Pre-decoded instructions, see fetch_instruction
+                "instructions" ]
 
     lookup_selector = "<unknown>"
     lookup_class = None
+    inline_caches = None
+    instructions = None
     import_from_mixin(VersionMixin)
 
     def __init__(self, space, bytecount=0, header=0):
@@ -1036,12 +1074,14 @@ class W_CompiledMethod(W_AbstractObjectWithIdentityHash):
         self.literals[index] = w_lit
         if index == len(self.literals):
             self.compiledin_class = None
+        self.inline_caches = None
         self.changed()
 
     def setliterals(self, literals):
         """NOT RPYTHON""" # Only for testing, not safe.
         self.literals = literals
         self.compiledin_class = None
+        self.inline_caches = None
         self.changed()
 
     def set_lookup_class_and_name(self, w_class, selector):
@@ -1051,11 +1091,14 @@ class W_CompiledMethod(W_AbstractObjectWithIdentityHash):
 
     def setbytes(self, bytes):
         self.bytes = bytes
+        self.inline_caches = None
+        self.instructions = None
         self.changed()
 
     def setchar(self, index0, character):
         assert index0 >= 0
         self.bytes[index0] = character
+        self.instructions = None
         self.changed()
 
     # === Getters ===
@@ -1105,6 +1148,21 @@ class W_CompiledMethod(W_AbstractObjectWithIdentityHash):
         assert pc >= 0 and pc < len(self.bytes)
         return self.bytes[pc]
 
+    @constant_for_version_two_args
+    def fetch_instruction(self, space, index):
+        # Return one field of the pre-decoded instruction stream. The instruction
+        # at pc starts at index pc * INSTRUCTION_SIZE, it is decoded when it
+        # is first executed (see interpreter_bytecodes.decode_instruction).
+        from spyvm.interpreter_bytecodes import decode_instruction
+        instructions = self.instructions
+        if instructions is None:
+            instructions = self.instructions = [-1] * (len(self.bytes) * constants.INSTRUCTION_SIZE)
+        start = index - index % constants.INSTRUCTION_SIZE
+        assert 0 <= start < len(instructions)
+        if instructions[start] == -1:
+            decode_instruction(space, self, start / constants.INSTRUCTION_SIZE, instructions, start)
+        return instructions[index]
+
     def compiled_in(self):
         # This method cannot be constant/elidable. Looking up the compiledin-class from
         # the literals must be done lazily because we cannot analyze the literals
@@ -1132,6 +1190,21 @@ class W_CompiledMethod(W_AbstractObjectWithIdentityHash):
     def safe_compiled_in(self):
         return self.constant_compiledin_class() or self.constant_lookup_class()
 
+    def inline_cache_at(self, pc, w_selector):
+        # Return the inline cache of the send site at pc, or None if the
+        # site is not sending w_selector (e.g. for sends done by primitives).
+        from spyvm.storage_classes import InlineCache
+        caches = self.inline_caches
+        if caches is None:
+            caches = self.inline_caches = [None] * (len(self.bytes) + 1)
+        assert 0 <= pc < len(caches)
+        cache = caches[pc]
+        if cache is None:
+            cache = caches[pc] = InlineCache(w_selector)
+        elif cache.w_selector is not w_selector:
+            return None
+        return cache
+
     # === Object Access ===
 
     def literalat0(self, space, index0):
@@ -1209,6 +1282,8 @@ class W_CompiledMethod(W_AbstractObjectWithIdentityHash):
         self.islarge, w_other.islarge = w_other.islarge, self.islarge
         self.lookup_selector, w_other.lookup_selector = w_other.lookup_selector, self.lookup_selector
         self.compiledin_class, w_other.compiledin_class = w_other.compiledin_class, self.compiledin_class
+        self.inline_caches = w_other.inline_caches = None
+        self.instructions = w_other.instructions = None
         W_AbstractObjectWithIdentityHash._become(self, w_other)
         self.changed()
         w_other.changed()
@@ -77,6 +77,11 @@ class W_DisplayBitmap(model.W_AbstractObjectWithClassReference):
         if self.pixelbuffer_words > 0:
             self.set_pixelbuffer_word(n, word)
 
+    def fill(self, value):
+        # Every word also has to be converted into the pixel buffer.
+        for i in xrange(self.size()):
+            self.setword(i, value)
+
     def size(self):
         return self._realsize
 
@@ -1,7 +1,8 @@
 import os
 
-from spyvm import constants, model, wrapper, display, storage
+from spyvm import constants, model, wrapper, display, storage, storage_classes, storage_contexts
 from spyvm.error import UnwrappingError, WrappingError
+from spyvm.util.interrupt_timer import InterruptTimer
 from rpython.rlib import jit, rpath
 from rpython.rlib.objectmodel import instantiate, specialize, import_from_mixin
 from rpython.rlib.rarithmetic import intmask, r_uint, int_between
@@ -47,6 +48,8 @@ def empty_object():
     return instantiate(model.W_PointersObject)
     
 class ObjSpace(object):
+    _immutable_fields_ = ["pending_class_changes"]
+
     def __init__(self):
         # This is a hack; see compile_code() in targetimageloadingsmalltalk.py
         self.suppress_process_switch = ConstantFlag()
@@ -54,6 +57,9 @@ class ObjSpace(object):
         self.headless = ConstantFlag()
         self.omit_printing_raw_bytes = ConstantFlag()
         self.image_loaded = ConstantFlag()
+        self.print_statistics = ConstantFlag()
+        # Fusing bytecodes into superinstructions can be disabled to compare results.
+        self.no_superinstructions = ConstantFlag()
         
         self.classtable = {}
         self.objtable = {}
@@ -68,6 +74,13 @@ class ObjSpace(object):
         self.add_bootstrap_object("w_nil", w_nil)
         
         self.strategy_factory = storage.StrategyFactory(self)
+        self.method_cache = storage_classes.MethodCache()
+        self.pending_class_changes = storage_classes.PendingClassChanges()
+        self.context_pool = storage_contexts.ContextPool()
+        self.context_switches = storage_contexts.ContextSwitchStats()
+        self.interrupt_timer = InterruptTimer()
+        self.run_queue = wrapper.RunQueueIndex()
+        self.scheduler_wrapper = None
         self.make_bootstrap_classes()
         self.make_bootstrap_objects()
 
@@ -140,8 +153,10 @@ class ObjSpace(object):
     def wrap_int(self, val):
         from spyvm import constants
         assert isinstance(val, int)
-        # we don't do tagging
-        return model.W_SmallInteger(val)
+        try:
+            return model.W_SmallInteger(val)
+        except OverflowError:
+            raise WrappingError("integer too large to fit into a tagged pointer")
 
     def wrap_uint(self, val):
         from rpython.rlib.objectmodel import we_are_translated
@@ -153,11 +168,14 @@ class ObjSpace(object):
     def wrap_positive_32bit_int(self, val):
         # This will always return a positive value.
         # XXX: For now, we assume that val is at most 32bit, i.e. overflows are
-        # checked for before wrapping. Also, we ignore tagging.
+        # checked for before wrapping. Values that do not fit into a tagged
+        # pointer are boxed.
         if int_between(0, val, constants.MAXINT):
-            return model.W_SmallInteger(val)
-        else:
-            return model.W_LargePositiveInteger1Word(val)
+            try:
+                return model.W_SmallInteger(val)
+            except OverflowError:
+                pass
+        return model.W_LargePositiveInteger1Word(val)
 
     def wrap_float(self, i):
         return model.W_Float(i)
@@ -260,6 +278,16 @@ class ObjSpace(object):
         return disp
     
     # ============= Other Methods =============
+
+    def print_stats(self):
+        if not self.print_statistics.is_set():
+            return
+        self.method_cache.print_stats()
+        self.pending_class_changes.print_stats()
+        self.context_pool.print_stats()
+        self.context_switches.print_stats()
+        self.interrupt_timer.print_stats()
+        self.strategy_factory.prediction_stats.print_stats()
     
     def _freeze_(self):
         return True
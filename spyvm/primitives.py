@@ -667,22 +667,21 @@ def func(interp, s_frame, w_rcvr, w_into):
 
 @expose_primitive(BITBLT_COPY_BITS, clean_stack=False, no_result=False, compiled_method=True)
 def func(interp, s_frame, argcount, w_method):
-    from spyvm.interpreter import Return
     w_rcvr = s_frame.peek(0)
     try:
         s_frame._sendSelfSelector(interp.image.w_simulateCopyBits, 0, interp)
-    except Return:
-        w_dest_form = w_rcvr.fetch(interp.space, 0)
-        w_display = interp.space.objtable['w_display']
-        if w_dest_form.is_same_object(w_display):
-            w_bitmap = w_display.fetch(interp.space, 0)
-            assert isinstance(w_bitmap, model_display.W_DisplayBitmap)
-            w_bitmap.flush_to_screen()
-        return w_rcvr
     except error.MethodNotFound:
         from spyvm.plugins.bitblt import BitBltPlugin
         BitBltPlugin.call("primitiveCopyBits", interp, s_frame, argcount, w_method)
         return w_rcvr
+    s_frame.pop() # The result of simulateCopyBits is ignored
+    w_dest_form = w_rcvr.fetch(interp.space, 0)
+    w_display = interp.space.objtable['w_display']
+    if w_dest_form.is_same_object(w_display):
+        w_bitmap = w_display.fetch(interp.space, 0)
+        assert isinstance(w_bitmap, model_display.W_DisplayBitmap)
+        w_bitmap.flush_to_screen()
+    return w_rcvr
 
 @expose_primitive(BE_CURSOR)
 def func(interp, s_frame, argcount):
@@ -771,9 +770,7 @@ def func(interp, s_frame, w_rcvr, start, stop, w_replacement, repStart):
     if (w_rcvr.size() - w_rcvr.instsize() <= stop
             or w_replacement.size() - w_replacement.instsize() <= repStart + (stop - start)):
         raise PrimitiveFailedError()
-    repOff = repStart - start
-    for i0 in range(start, stop + 1):
-        w_rcvr.atput0(interp.space, i0, w_replacement.at0(interp.space, repOff + i0))
+    w_rcvr.replace_range(interp.space, start, stop, w_replacement, repStart)
     return w_rcvr
 
 @expose_primitive(SCREEN_SIZE, unwrap_spec=[object])
@@ -1112,15 +1109,12 @@ def func(interp, s_frame, w_receiver, n0, w_value):
 
 @expose_primitive(FILL, unwrap_spec=[object, pos_32bit_int])
 def func(interp, s_frame, w_arg, new_value):
-    space = interp.space
     if isinstance(w_arg, model.W_BytesObject):
         if new_value > 255:
             raise PrimitiveFailedError
-        for i in xrange(w_arg.size()):
-            w_arg.setchar(i, chr(new_value))
+        w_arg.fill(new_value)
     elif isinstance(w_arg, model.W_WordsObject) or isinstance(w_arg, model_display.W_DisplayBitmap):
-        for i in xrange(w_arg.size()):
-            w_arg.setword(i, new_value)
+        w_arg.fill(new_value)
     else:
         raise PrimitiveFailedError
     return w_arg
@@ -1394,7 +1388,6 @@ def func(interp, s_frame, w_rcvr):
     wrapper.ProcessWrapper(interp.space, w_rcvr).suspend(s_frame)
 
 
-
 @expose_primitive(FLUSH_CACHE, unwrap_spec=[object])
 def func(interp, s_frame, w_rcvr):
     w_rcvr = assert_pointers(w_rcvr)
@@ -1402,6 +1395,46 @@ def func(interp, s_frame, w_rcvr):
     s_class.flush_method_caches()
     return w_rcvr
 
+# ___________________________________________________________________________
+# Context Primitives
+# Exception handling and unwinding search the sender chain of a context. Without
+# these primitives, the Smalltalk code reifies every context on the way.
+
+FIND_NEXT_UNWIND_CONTEXT = 195
+TERMINATE_TO = 196
+FIND_HANDLER_CONTEXT = 197
+
+def context_or_none(space, w_context):
+    # Anything but a context (e.g. nil) means the whole sender chain.
+    if not w_context.is_context(space):
+        return None
+    return assert_pointers(w_context).as_context_get_shadow(space)
+
+def wrap_context(space, s_context):
+    if s_context is None:
+        return space.w_nil
+    return s_context.w_self()
+
+@expose_primitive(FIND_NEXT_UNWIND_CONTEXT, unwrap_spec=[object, object])
+def func(interp, s_frame, w_rcvr, w_stop):
+    space = interp.space
+    s_context = assert_pointers(w_rcvr).as_context_get_shadow(space)
+    s_stop = context_or_none(space, w_stop)
+    return wrap_context(space, s_context.find_next_unwind_context_up_to(s_stop))
+
+@expose_primitive(TERMINATE_TO, unwrap_spec=[object, object])
+def func(interp, s_frame, w_rcvr, w_previous):
+    space = interp.space
+    s_context = assert_pointers(w_rcvr).as_context_get_shadow(space)
+    s_context.terminate_to(context_or_none(space, w_previous))
+    return w_rcvr
+
+@expose_primitive(FIND_HANDLER_CONTEXT, unwrap_spec=[object])
+def func(interp, s_frame, w_rcvr):
+    space = interp.space
+    s_context = assert_pointers(w_rcvr).as_context_get_shadow(space)
+    return wrap_context(space, s_context.find_next_handler_context())
+
 # ___________________________________________________________________________
 # BlockClosure Primitives
 
@@ -1497,11 +1530,15 @@ def func(interp, s_frame, w_rcvr, time_mu_s):
     import time
     s_frame.pop()
     time_s = time_mu_s / 1000000.0
-    interp.interrupt_check_counter = 0
-    interp.quick_check_for_interrupt(s_frame, dec=0)
-    time.sleep(time_s)
-    interp.interrupt_check_counter = 0
-    interp.quick_check_for_interrupt(s_frame, dec=0)
+    if interp.interrupts:
+        interp.check_for_interrupts(s_frame)
+    # The interrupt timer signal ends the sleep early, continue until the deadline.
+    deadline = time.time() + time_s
+    while time_s > 0:
+        time.sleep(time_s)
+        time_s = deadline - time.time()
+    if interp.interrupts:
+        interp.check_for_interrupts(s_frame)
 
 @expose_primitive(FORCE_DISPLAY_UPDATE, unwrap_spec=[object])
 def func(interp, s_frame, w_rcvr):
@@ -1,5 +1,5 @@
 
-import sys
+import sys, time
 from spyvm import model, constants
 from spyvm.util.version import elidable_for_version, VersionMixin
 from rpython.rlib import objectmodel, jit
@@ -40,6 +40,16 @@ class AbstractShadow(object):
     def _s_become(self, w_self, s_other, w_other):
         self._w_self, s_other._w_self = w_self, w_other
 
+    def copy_range_from(self, n0, s_other, other_n0, count):
+        # Copy count elements of s_other into this shadow without boxing them.
+        # Answer False if that is not possible, then the caller stores the elements one by one.
+        return False
+
+    def clone_for(self, w_clone):
+        # Answer a shadow for w_clone using the same strategy and holding the same elements.
+        # Answer None if that is not possible, then the caller stores the elements one by one.
+        return None
+
 # ========== Storage classes implementing storage strategies ==========
 
 class AbstractStorageShadow(AbstractShadow):
@@ -60,16 +70,43 @@ class AbstractStorageShadow(AbstractShadow):
     def default_value(self):
         return self.space.w_nil
 
-@rstrat.strategy()
+# The generalization edges between the strategies are declared in StrategyFactory.
+
 class ListStorageShadow(AbstractStorageShadow):
     repr_classname = "ListStorageShadow"
     import_from_mixin(rstrat.GenericStrategy)
+    # Elements stored by bulk operations since the last attempt to specialize,
+    # see StrategyFactory.bulk_stored
+    _attrs_ = ['storage', 'bulk_stores']
+    bulk_stores = 0
 
 class WeakListStorageShadow(AbstractStorageShadow):
+    """Tagged SmallIntegers are no heap objects and cannot be referenced weakly.
+    They are held strongly in a separate list, created on demand."""
     repr_classname = "WeakListStorageShadow"
     import_from_mixin(rstrat.WeakGenericStrategy)
+    _attrs_ = ['storage', 'immediates_w']
+    immediates_w = None
+
+    def store(self, index0, w_value):
+        self.check_index_store(index0)
+        if isinstance(w_value, model.W_SmallInteger):
+            if self.immediates_w is None:
+                self.immediates_w = [None] * self.size()
+            self.immediates_w[index0] = w_value
+            w_value = self.default_value()
+        elif self.immediates_w is not None:
+            self.immediates_w[index0] = None
+        self.storage[index0] = self._unwrap(w_value)
+
+    def fetch(self, index0):
+        self.check_index_fetch(index0)
+        if self.immediates_w is not None:
+            w_value = self.immediates_w[index0]
+            if w_value is not None:
+                return w_value
+        return self._wrap(self.storage[index0])
 
-@rstrat.strategy(generalize=[ListStorageShadow])
 class SmallIntegerOrNilStorageShadow(AbstractStorageShadow):
     repr_classname = "SmallIntegerOrNilStorageShadow"
     import_from_mixin(rstrat.TaggingStrategy)
@@ -79,7 +116,6 @@ class SmallIntegerOrNilStorageShadow(AbstractStorageShadow):
     def wrapped_tagged_value(self): return self.space.w_nil
     def unwrapped_tagged_value(self): return constants.MAXINT
 
-@rstrat.strategy(generalize=[ListStorageShadow])
 class FloatOrNilStorageShadow(AbstractStorageShadow):
     repr_classname = "FloatOrNilStorageShadow"
     import_from_mixin(rstrat.TaggingStrategy)
@@ -90,21 +126,295 @@ class FloatOrNilStorageShadow(AbstractStorageShadow):
     def wrapped_tagged_value(self): return self.space.w_nil
     def unwrapped_tagged_value(self): return self.tag_float
 
-@rstrat.strategy(generalize=[
-    SmallIntegerOrNilStorageShadow,
-    FloatOrNilStorageShadow,
-    ListStorageShadow])
 class AllNilStorageShadow(AbstractStorageShadow):
     repr_classname = "AllNilStorageShadow"
     import_from_mixin(rstrat.SingleValueStrategy)
     def value(self): return self.space.w_nil
+    def copy_range_from(self, n0, s_other, other_n0, count):
+        # Storing nil into an object that is all nil does not change it.
+        return isinstance(s_other, AllNilStorageShadow)
+    def clone_for(self, w_clone):
+        return AllNilStorageShadow(self.space, w_clone, self.size())
+
+# The following strategies cannot hold nil. They are only chosen for objects whose
+# elements are all known, e.g. when loading the image.
+
+class SmallIntegerStorageShadow(AbstractStorageShadow):
+    repr_classname = "SmallIntegerStorageShadow"
+    import_from_mixin(rstrat.SingleTypeStrategy)
+    contained_type = model.W_SmallInteger
+    def init_strategy(self, initial_size): self.storage = [0] * initial_size
+    def wrap(self, val): return self.space.wrap_int(val)
+    def unwrap(self, w_val): return self.space.unwrap_int(w_val)
+
+class FloatStorageShadow(AbstractStorageShadow):
+    repr_classname = "FloatStorageShadow"
+    import_from_mixin(rstrat.SingleTypeStrategy)
+    contained_type = model.W_Float
+    def init_strategy(self, initial_size): self.storage = [0.0] * initial_size
+    def wrap(self, val): return self.space.wrap_float(val)
+    def unwrap(self, w_val): return self.space.unwrap_float(w_val)
+    def check_can_handle(self, w_val):
+        # The tag of FloatOrNilStorageShadow is excluded, so it can take over all elements.
+        return (isinstance(w_val, model.W_Float) and
+                w_val.value != FloatOrNilStorageShadow.tag_float)
+
+class CharacterStorageShadow(AbstractStorageShadow):
+    """Stores Characters with values from 0 to 255 as one byte per element.
+    They are restored from the character table, see ObjSpace.wrap_char, so
+    only the Characters of the table are accepted."""
+    repr_classname = "CharacterStorageShadow"
+    import_from_mixin(rstrat.SingleTypeStrategy)
+    contained_type = model.W_PointersObject
+    def init_strategy(self, initial_size): self.storage = ['\x00'] * initial_size
+    def wrap(self, val): return self.space.wrap_char(val)
+    def unwrap(self, w_val): return self.space.unwrap_char(w_val)
+    def check_can_handle(self, w_val):
+        if not isinstance(w_val, model.W_PointersObject) or not w_val.has_class():
+            return False
+        if not w_val.getclass(self.space).is_same_object(self.space.w_Character):
+            return False
+        w_ord = w_val.fetch(self.space, constants.CHARACTER_VALUE_INDEX)
+        if not isinstance(w_ord, model.W_SmallInteger) or not 0 <= w_ord.value <= 255:
+            return False
+        w_table = self.space.w_charactertable
+        if w_table is None or not w_table.has_shadow():
+            return False # The image is still being loaded
+        return w_val is self.space.wrap_char(chr(w_ord.value))
+
+class BooleanStorageShadow(AbstractStorageShadow):
+    """Stores true and false as a bitset, one bit per element."""
+    _attrs_ = ['bits', '_size']
+    _immutable_fields_ = ['bits', '_size']
+    repr_classname = "BooleanStorageShadow"
+    import_from_mixin(rstrat.AbstractStrategy)
+
+    def init_strategy(self, initial_size):
+        self._size = initial_size
+        self.bits = ['\x00'] * ((initial_size + 7) / 8)
+
+    def size(self):
+        return self._size
+
+    def check_can_handle(self, w_val):
+        return w_val is self.space.w_true or w_val is self.space.w_false
+
+    def fetch(self, n0):
+        if not 0 <= n0 < self._size:
+            raise IndexError
+        if ord(self.bits[n0 >> 3]) & (1 << (n0 & 7)):
+            return self.space.w_true
+        return self.space.w_false
+
+    def store(self, n0, w_val):
+        if not 0 <= n0 < self._size:
+            raise IndexError
+        byte = ord(self.bits[n0 >> 3])
+        if w_val is self.space.w_true:
+            self.bits[n0 >> 3] = chr(byte | (1 << (n0 & 7)))
+        elif w_val is self.space.w_false:
+            self.bits[n0 >> 3] = chr(byte & ~(1 << (n0 & 7)))
+        else:
+            self.cannot_handle_store(n0, w_val)
+
+def _install_range_copy(strategy_class):
+    "NOT_RPYTHON"
+    # Both objects use the same strategy, so the unwrapped elements can be copied directly.
+    # Subclasses of the strategy (e.g. the caching shadows) have to see every store.
+    def copy_range_from(self, n0, s_other, other_n0, count):
+        if type(self) is not strategy_class or type(s_other) is not strategy_class:
+            return False
+        assert isinstance(s_other, strategy_class)
+        model.copy_list_range(self.storage, n0, s_other.storage, other_n0, count)
+        return True
+    def clone_for(self, w_clone):
+        if type(self) is not strategy_class:
+            return None
+        size = self.size()
+        s_clone = strategy_class(self.space, w_clone, size)
+        model.copy_list_range(s_clone.storage, 0, self.storage, 0, size)
+        return s_clone
+    strategy_class.copy_range_from = copy_range_from
+    strategy_class.clone_for = clone_for
+
+for _strategy_class in [ListStorageShadow, SmallIntegerOrNilStorageShadow, FloatOrNilStorageShadow,
+                        SmallIntegerStorageShadow, FloatStorageShadow, CharacterStorageShadow]:
+    _install_range_copy(_strategy_class)
+
+# ========== Map-based storage for objects with named instance variables ==========
+
+# Field types recorded in an ObjectLayout, ordered from the most specific to the most general.
+NIL_FIELD, INT_FIELD, FLOAT_FIELD, OBJECT_FIELD = range(4)
+NUM_FIELD_TYPES = 4
+
+class ObjectLayout(object):
+    """A map shared by objects using MapStorageShadow. Records the type of each
+    field and its position in the storage list for that type. Layouts are immutable:
+    when a field has to hold a value of a more general type, the object transitions
+    to another layout. Transitions are cached, so all instances of a class taking
+    the same transitions end up sharing their layouts."""
+    _attrs_ = ['field_types', 'positions', 'num_ints', 'num_floats', 'num_objects', 'transitions']
+    _immutable_fields_ = ['field_types[*]', 'positions[*]', 'num_ints', 'num_floats', 'num_objects',
+                          'transitions']
+
+    def __init__(self, field_types):
+        self.field_types = field_types
+        counts = [0] * NUM_FIELD_TYPES
+        positions = [0] * len(field_types)
+        for i in range(len(field_types)):
+            field_type = field_types[i]
+            positions[i] = counts[field_type]
+            counts[field_type] += 1
+        self.positions = positions
+        self.num_ints = counts[INT_FIELD]
+        self.num_floats = counts[FLOAT_FIELD]
+        self.num_objects = counts[OBJECT_FIELD]
+        self.transitions = {}
+
+    @staticmethod
+    def root(size):
+        return ObjectLayout([NIL_FIELD] * size)
+
+    def size(self):
+        return len(self.field_types)
+
+    @jit.elidable
+    def transition(self, n0, field_type):
+        key = n0 * NUM_FIELD_TYPES + field_type
+        layout = self.transitions.get(key, None)
+        if layout is None:
+            field_types = self.field_types[:]
+            field_types[n0] = field_type
+            layout = ObjectLayout(field_types)
+            self.transitions[key] = layout
+        return layout
+
+class MapStorageShadow(AbstractStorageShadow):
+    """Storage for objects with only named instance variables. SmallIntegers and Floats
+    are stored unboxed per field, even if the object also references other objects.
+    The field types are described by an ObjectLayout, starting from the layout the class
+    predicts for its instances.
+    Like the tagging strategies, nil is represented by a tag value in int and float fields."""
+    _attrs_ = ['layout', 'int_storage', 'float_storage', 'object_storage']
+    repr_classname = "MapStorageShadow"
+    nil_int = constants.MAXINT
+    nil_float = sys.float_info.max
+
+    def init_strategy(self, initial_size):
+        w_self = self.w_self()
+        if w_self is not None and self.strategy_factory().uses_map_storage(w_self, initial_size):
+            layout = w_self.class_shadow(self.space).predicted_layout()
+        else:
+            layout = ObjectLayout.root(initial_size)
+        self.set_layout(layout)
+
+    def set_layout(self, layout):
+        self.layout = layout
+        self.int_storage = [self.nil_int] * layout.num_ints
+        self.float_storage = [self.nil_float] * layout.num_floats
+        self.object_storage = [self.space.w_nil] * layout.num_objects
+
+    def size(self):
+        return self.layout.size()
+
+    def field_type_for(self, w_value):
+        if isinstance(w_value, model.W_SmallInteger) and w_value.value != self.nil_int:
+            return INT_FIELD
+        if isinstance(w_value, model.W_Float) and w_value.value != self.nil_float:
+            return FLOAT_FIELD
+        return OBJECT_FIELD
+
+    def fetch(self, n0):
+        layout = jit.promote(self.layout)
+        field_type = layout.field_types[n0]
+        position = layout.positions[n0]
+        if field_type == INT_FIELD:
+            value = self.int_storage[position]
+            if value != self.nil_int:
+                return self.space.wrap_int(value)
+        elif field_type == FLOAT_FIELD:
+            value = self.float_storage[position]
+            if value != self.nil_float:
+                return self.space.wrap_float(value)
+        elif field_type == OBJECT_FIELD:
+            return self.object_storage[position]
+        return self.space.w_nil
+
+    def store(self, n0, w_value):
+        layout = jit.promote(self.layout)
+        field_type = layout.field_types[n0]
+        position = layout.positions[n0]
+        if field_type == OBJECT_FIELD:
+            self.object_storage[position] = w_value
+            return
+        is_nil = w_value is self.space.w_nil
+        if field_type == INT_FIELD:
+            if is_nil:
+                self.int_storage[position] = self.nil_int
+                return
+            if self.field_type_for(w_value) == INT_FIELD:
+                assert isinstance(w_value, model.W_SmallInteger)
+                self.int_storage[position] = w_value.value
+                return
+            new_field_type = OBJECT_FIELD
+        elif field_type == FLOAT_FIELD:
+            if is_nil:
+                self.float_storage[position] = self.nil_float
+                return
+            if self.field_type_for(w_value) == FLOAT_FIELD:
+                assert isinstance(w_value, model.W_Float)
+                self.float_storage[position] = w_value.value
+                return
+            new_field_type = OBJECT_FIELD
+        else:
+            if is_nil:
+                return
+            new_field_type = self.field_type_for(w_value)
+        self.switch_layout(layout.transition(n0, new_field_type))
+        self.store(n0, w_value)
+
+    def switch_layout(self, new_layout):
+        # Every field of the new layout can hold the value of the old one.
+        old_layout = self.layout
+        values_w = [self.fetch(i) for i in range(self.size())]
+        self.set_layout(new_layout)
+        for i in range(len(values_w)):
+            self.store(i, values_w[i])
+        s_class = self.strategy_factory().class_shadow_of(self.w_self())
+        if s_class is not None:
+            s_class.learn_layout(old_layout, new_layout)
+
+class StrategyPredictionStats(object):
+    """Counts how well ClassShadows predict the storage of their new instances."""
+    _attrs_ = ["predicted", "mispredicted", "decayed"]
+
+    def __init__(self):
+        self.predicted = 0
+        self.mispredicted = 0
+        self.decayed = 0
+
+    def print_stats(self):
+        print "Strategy prediction: %d switches avoided, %d predictions decayed, %d mispredicted" % (
+            self.predicted, self.decayed, self.mispredicted)
 
 class StrategyFactory(rstrat.StrategyFactory):
-    _immutable_fields_ = ["space", "no_specialized_storage"]
+    _immutable_fields_ = ["space", "no_specialized_storage", "prediction_stats"]
     def __init__(self, space):
         from spyvm import objspace
         self.space = space
         self.no_specialized_storage = objspace.ConstantFlag()
+        self.prediction_stats = StrategyPredictionStats()
+        self.decorate_strategies({
+            ListStorageShadow: None,
+            SmallIntegerOrNilStorageShadow: [ListStorageShadow],
+            FloatOrNilStorageShadow: [ListStorageShadow],
+            AllNilStorageShadow: [SmallIntegerOrNilStorageShadow, FloatOrNilStorageShadow,
+                                  ListStorageShadow],
+            SmallIntegerStorageShadow: [SmallIntegerOrNilStorageShadow, ListStorageShadow],
+            FloatStorageShadow: [FloatOrNilStorageShadow, ListStorageShadow],
+            CharacterStorageShadow: [ListStorageShadow],
+            BooleanStorageShadow: [ListStorageShadow],
+        })
         rstrat.StrategyFactory.__init__(self, AbstractShadow)
 
     def strategy_type_for(self, objects, weak=False):
@@ -119,17 +429,89 @@ class StrategyFactory(rstrat.StrategyFactory):
             return WeakListStorageShadow
         if self.no_specialized_storage.is_set():
             return ListStorageShadow
+        if self.uses_map_storage(w_self, size):
+            return MapStorageShadow
+        s_class = self.class_shadow_of(w_self)
+        if s_class is not None:
+            # Start in the strategy the previous instances ended up in.
+            strategy_type = s_class.predicted_strategy()
+            if strategy_type is not None:
+                return strategy_type
         return AllNilStorageShadow
 
+    def class_shadow_of(self, w_self):
+        # The ClassShadow of w_self, or None if the class is not (yet) available as a class.
+        # This does not switch the storage of the class.
+        if not w_self.has_class():
+            return None
+        w_class = w_self.getclass(self.space)
+        if not isinstance(w_class, model.W_PointersObject):
+            return None
+        from spyvm.storage_classes import ClassShadow
+        s_class = w_class.shadow
+        if not isinstance(s_class, ClassShadow):
+            return None
+        return jit.promote(s_class)
+
+    def uses_map_storage(self, w_self, size):
+        # Objects with only named instance variables use the layout of their class.
+        if size == 0 or self.no_specialized_storage.is_set():
+            return False
+        from spyvm.storage_classes import POINTERS
+        s_class = self.class_shadow_of(w_self)
+        return (s_class is not None and s_class.instance_kind == POINTERS and
+                not s_class.isvariable() and s_class.instsize() == size)
+
     def set_initial_strategy(self, w_object, strategy_type, size, elements=None):
         assert w_object.shadow is None, "Shadow should not be initialized yet!"
+        if strategy_type is CharacterStorageShadow and w_object is self.space.w_charactertable:
+            # CharacterStorageShadow.wrap fetches from the character table itself.
+            strategy_type = ListStorageShadow
         strategy = strategy_type(self.space, w_object, size)
         w_object.store_shadow(strategy)
         if elements:
-            w_object.store_all(self.space, elements)
+            # The strategy was chosen for these elements, don't specialize again.
+            for i in range(min(size, len(elements))):
+                w_object.store(self.space, i, elements[i])
         strategy.strategy_switched()
         self.log(strategy)
 
+    def clone_strategy(self, w_object, w_clone):
+        # Give w_clone the strategy of w_object and a copy of its elements, without choosing
+        # a strategy for them again. Answer False if the strategy cannot be copied directly.
+        s_clone = w_object.shadow.clone_for(w_clone)
+        if s_clone is None:
+            return False
+        w_clone.store_shadow(s_clone)
+        s_clone.strategy_switched()
+        self.log(s_clone)
+        return True
+
+    def specialize_for(self, w_object, elements_w):
+        # Strategies only generalize when single elements are stored. Before all elements
+        # of w_object are overwritten, switch to the most specific strategy for the new ones.
+        old_strategy = w_object.shadow
+        if old_strategy is None or not old_strategy._is_strategy or self.no_specialized_storage.is_set():
+            return
+        strategy_type = self.strategy_type_for(elements_w)
+        if strategy_type is ListStorageShadow or type(old_strategy) is strategy_type:
+            return
+        new_strategy = self.instantiate_and_switch(old_strategy, old_strategy.size(), strategy_type)
+        new_strategy.strategy_switched()
+        self.log(new_strategy, old_strategy, cause="Narrowed")
+
+    def bulk_stored(self, w_object, count):
+        # A bulk operation stored count elements of w_object. Once as many elements were stored
+        # as the object has, try to specialize. This keeps the cost constant per stored element.
+        strategy = w_object.shadow
+        if type(strategy) is not ListStorageShadow:
+            return
+        assert isinstance(strategy, ListStorageShadow)
+        strategy.bulk_stores += count
+        if strategy.bulk_stores >= strategy.size():
+            strategy.bulk_stores = 0
+            w_object.store_all(self.space, w_object.fetch_all(self.space))
+
     def instantiate_and_switch(self, old_strategy, size, strategy_class):
         w_self = old_strategy.w_self()
 
@@ -139,8 +521,16 @@ class StrategyFactory(rstrat.StrategyFactory):
             instance = ContextPartShadow(self.space, w_self, size, is_block_context=True)
         elif strategy_class is MethodContextMarkerClass:
             instance = ContextPartShadow(self.space, w_self, size, is_block_context=False)
+        elif strategy_class is ListStorageShadow and self.uses_map_storage(w_self, size):
+            # Generalizing a homogeneous strategy: keep the remaining fields unboxed.
+            instance = MapStorageShadow(self.space, w_self, size)
         else:
             instance = strategy_class(self.space, w_self, size)
+            if strategy_class._is_strategy and instance.check_can_handle(self.space.w_nil):
+                # Only strategies that can hold nil can be used for new instances.
+                s_class = self.class_shadow_of(w_self)
+                if s_class is not None:
+                    s_class.learn_strategy(strategy_class)
 
         w_self.store_shadow(instance)
         return instance
@@ -148,7 +538,7 @@ class StrategyFactory(rstrat.StrategyFactory):
     def instantiate_empty(self, strategy_type):
         return strategy_type(self.space, None, 0)
 
-    def log(self, new_strategy, old_strategy=None, new_element=None):
+    def log(self, new_strategy, old_strategy=None, new_element=None, cause=""):
         if not self.logger.active: return
         # Gather information to be logged
         image_loaded = self.space.image_loaded.is_set()
@@ -157,10 +547,10 @@ class StrategyFactory(rstrat.StrategyFactory):
         old_strategy_str = old_strategy.repr_classname if old_strategy else ""
         classname = new_strategy.w_self().guess_classname() if image_loaded else ""
         element_classname = new_element.guess_classname() if new_element and image_loaded else ""
-        if image_loaded:
-            cause = "Switched" if old_strategy else "Initialized"
-        else:
+        if not image_loaded:
             cause = "Filledin"
+        elif not cause:
+            cause = "Switched" if old_strategy else "Initialized"
         self.logger.log(new_strategy_str, size, cause, old_strategy_str, classname, element_classname)
 
 # ========== Other storage classes, non-strategies ==========
@@ -191,15 +581,49 @@ class AbstractCachingShadow(ListStorageShadow):
         self.changed()
 
 class CachedObjectShadow(AbstractCachingShadow):
+    """The fields are constant-folded for the version of the object. Objects
+    that keep changing, like globals used as counters, stop being cached after
+    CACHED_OBJECT_CHANGE_LIMIT stores in a row, so that their readers are not
+    invalidated on every store. Stores count as in a row unless more than
+    CACHED_OBJECT_QUIET_PERIOD seconds pass between them, so objects that are
+    only rebound now and then stay cached."""
+    _immutable_fields_ = ['uncached?']
+    _attrs_ = ['uncached', 'changes', 'last_change']
     repr_classname = "CachedObjectShadow"
 
-    @elidable_for_version
+    def __init__(self, space, w_self, size):
+        AbstractCachingShadow.__init__(self, space, w_self, size)
+        self.uncached = False
+        self.changes = 0
+        self.last_change = 0.0
+
+    def strategy_switched(self):
+        # The fields were copied into this shadow, they are not changes.
+        self.changes = 0
+        self.changed()
+
     def fetch(self, n0):
+        if self.uncached:
+            return AbstractCachingShadow.fetch(self, n0)
+        return self._fetch_for_version(n0)
+
+    @elidable_for_version
+    def _fetch_for_version(self, n0):
         return AbstractCachingShadow.fetch(self, n0)
 
     def store(self, n0, w_value):
         AbstractCachingShadow.store(self, n0, w_value)
-        self.changed()
+        if self.uncached:
+            return
+        now = time.time()
+        if now - self.last_change > constants.CACHED_OBJECT_QUIET_PERIOD:
+            self.changes = 0
+        self.last_change = now
+        self.changes += 1
+        if self.changes > constants.CACHED_OBJECT_CHANGE_LIMIT:
+            self.uncached = True
+        else:
+            self.changed()
 
 class ObserveeShadow(ListStorageShadow):
     _attrs_ = ['dependent']
@@ -211,9 +635,34 @@ class ObserveeShadow(ListStorageShadow):
     def store(self, n0, w_value):
         ListStorageShadow.store(self, n0, w_value)
         if self.dependent:
-            self.dependent.update()
+            self.dependent.update(n0)
 
     def notify(self, dependent):
         if self.dependent is not None and dependent is not self.dependent:
             raise RuntimeError('Meant to be observed by only one value, so far')
         self.dependent = dependent
+
+class PriorityListsShadow(ListStorageShadow):
+    """The array of the scheduler's process lists, one per priority. Replacing
+    a list invalidates the run queue index (see wrapper.RunQueueIndex)."""
+    _attrs_ = []
+    repr_classname = "PriorityListsShadow"
+
+    def store(self, n0, w_value):
+        ListStorageShadow.store(self, n0, w_value)
+        self.space.run_queue.invalidate(self.w_self())
+
+class ProcessListShadow(ListStorageShadow):
+    """A process list of the scheduler. Storing a process into its firstLink
+    marks its priority in the run queue index, also when the image queues
+    the process without going through the VM."""
+    _attrs_ = ['priority']
+    repr_classname = "ProcessListShadow"
+    def __init__(self, space, w_self, size):
+        ListStorageShadow.__init__(self, space, w_self, size)
+        self.priority = -1
+
+    def store(self, n0, w_value):
+        ListStorageShadow.store(self, n0, w_value)
+        if n0 == 0 and self.priority >= 0 and not w_value.is_nil(self.space):
+            self.space.run_queue.mark_list(self.space, self.priority, self.w_self())
@@ -1,8 +1,8 @@
 
 from spyvm import model, constants, error, wrapper
-from spyvm.storage import AbstractCachingShadow, ListStorageShadow
+from spyvm.storage import AbstractCachingShadow, ListStorageShadow, ObjectLayout
 from spyvm.util.version import constant_for_version, constant_for_version_arg, Version
-from rpython.rlib import jit
+from rpython.rlib import jit, objectmodel, unroll
 
 POINTERS = 0
 BYTES = 1
@@ -12,6 +12,11 @@ COMPILED_METHOD = 4
 FLOAT = 5
 LARGE_POSITIVE_INTEGER = 6
 
+# Selectors of the special selector bytecodes that use the atCache, see ClassShadow.at_cache_primitive
+AT_CACHE_SELECTORS = ["at:", "at:put:", "size"]
+AT_CACHE_AT, AT_CACHE_AT_PUT, AT_CACHE_SIZE = range(len(AT_CACHE_SELECTORS))
+unrolling_at_cache_selectors = unroll.unrolling_iterable(enumerate(AT_CACHE_SELECTORS))
+
 class ClassShadowError(error.SmalltalkException):
     exception_type = "ClassShadowError"
 
@@ -21,9 +26,21 @@ class ClassShadow(AbstractCachingShadow):
     """
 
     _attrs_ = ["name", "_instance_size", "instance_varsized", "instance_kind",
-                "_s_methoddict", "_s_superclass", "subclass_s"]
+                "_s_methoddict", "_s_superclass", "subclass_s",
+                "_at_cache_primitives", "_at_cache_version",
+                "_instance_layout", "_root_layout", "_layout_budget",
+                "_predicted_strategy", "_strategy_candidate", "_strategy_votes", "_strategy_budget",
+                "_subclasses_pending"]
+    # The predictions rarely change, so that traces can allocate with a constant
+    # strategy and layout. The budgets and statistics are only counted when not jitted.
+    _immutable_fields_ = ["_instance_layout?", "_root_layout?", "_predicted_strategy?"]
     name = '??? (incomplete class info)'
     _s_superclass = _s_methoddict = None
+    _instance_layout = _root_layout = None
+    _predicted_strategy = _strategy_candidate = None
+    _strategy_votes = _strategy_budget = _layout_budget = 0
+    _subclasses_pending = False
+    _at_cache_primitives = _at_cache_version = None
     provides_getname = True
     repr_classname = "ClassShadow"
 
@@ -176,6 +193,77 @@ class ClassShadow(AbstractCachingShadow):
             raise NotImplementedError(self.instance_kind)
         return w_new
 
+    def instance_layout(self):
+        # The root ObjectLayout of instances using MapStorageShadow, shared by all of them.
+        layout = self._root_layout
+        if layout is None or layout.size() != self.instsize():
+            layout = ObjectLayout.root(self.instsize())
+            self._root_layout = layout
+            self._instance_layout = None
+        return layout
+
+    def predicted_layout(self):
+        # The layout new instances start with: the one previous instances ended up in,
+        # until the prediction decays and is learned again.
+        root = self.instance_layout()
+        layout = self._instance_layout
+        if layout is None:
+            return root
+        if jit.we_are_jitted():
+            return layout
+        self._layout_budget -= 1
+        if self._layout_budget <= 0:
+            self._instance_layout = None
+            self.space.strategy_factory.prediction_stats.decayed += 1
+        else:
+            self.space.strategy_factory.prediction_stats.predicted += 1
+        return layout
+
+    def learn_layout(self, old_layout, layout):
+        # Called when an instance using MapStorageShadow changes its layout.
+        if layout.size() != self.instsize():
+            return
+        if (old_layout is self._instance_layout and
+                self._layout_budget < constants.STRATEGY_PREDICTION_DECAY):
+            # The layout was already predicted for new instances, but had to be left.
+            # An instance passing through the layouts while they are learned is no misprediction.
+            self.space.strategy_factory.prediction_stats.mispredicted += 1
+        if layout is not self._instance_layout:
+            self._instance_layout = layout
+        self._layout_budget = constants.STRATEGY_PREDICTION_DECAY
+
+    def predicted_strategy(self):
+        # The storage strategy new instances start in, or None to start them in AllNilStorageShadow.
+        strategy_type = self._predicted_strategy
+        if strategy_type is None or jit.we_are_jitted():
+            return strategy_type
+        self._strategy_budget -= 1
+        if self._strategy_budget <= 0:
+            # Usage of the class might have changed, learn the strategy again.
+            self._predicted_strategy = None
+            self._strategy_votes = 0
+            self.space.strategy_factory.prediction_stats.decayed += 1
+        else:
+            self.space.strategy_factory.prediction_stats.predicted += 1
+        return strategy_type
+
+    def learn_strategy(self, strategy_type):
+        # Called when an instance switches its storage strategy.
+        if strategy_type is self._predicted_strategy:
+            return
+        if self._predicted_strategy is not None:
+            # An instance started in the predicted strategy, but had to switch away from it.
+            self._predicted_strategy = None
+            self.space.strategy_factory.prediction_stats.mispredicted += 1
+        if strategy_type is self._strategy_candidate:
+            self._strategy_votes += 1
+        else:
+            self._strategy_candidate = strategy_type
+            self._strategy_votes = 1
+        if self._strategy_votes >= constants.STRATEGY_PREDICTION_THRESHOLD:
+            self._predicted_strategy = strategy_type
+            self._strategy_budget = constants.STRATEGY_PREDICTION_DECAY
+
     def w_methoddict(self):
         return self._s_methoddict.w_self()
 
@@ -207,8 +295,55 @@ class ClassShadow(AbstractCachingShadow):
     # _______________________________________________________________
     # Other Methods
 
-    @constant_for_version_arg
     def lookup(self, w_selector):
+        self.space.pending_class_changes.flush()
+        return self._lookup(w_selector)
+
+    @constant_for_version_arg
+    def _lookup(self, w_selector):
+        method_cache = self.space.method_cache
+        w_method = method_cache.get(self, w_selector)
+        if w_method is None:
+            try:
+                w_method = self.lookup_in_hierarchy(w_selector)
+            except error.MethodNotFound:
+                method_cache.put(self, w_selector, None)
+                raise
+            method_cache.put(self, w_selector, w_method)
+        return w_method
+
+    @constant_for_version
+    def lookup_doesNotUnderstand(self):
+        # The doesNotUnderstand: method of this class, and the class of the Message
+        # passed to it. Proxies rely on doesNotUnderstand: for every forwarded message.
+        w_method = self.lookup(self.space.objtable["w_doesNotUnderstand"])
+        w_message_class = self.space.w_Message
+        assert isinstance(w_message_class, model.W_PointersObject)
+        return w_method, w_message_class.as_class_get_shadow(self.space)
+
+    def at_cache_primitive(self, index):
+        # The atCache of the at:, at:put: and size bytecodes: the primitive index of the
+        # method for AT_CACHE_SELECTORS[index] in this class, 0 if it is not a primitive.
+        self.space.pending_class_changes.flush()
+        return self._at_cache_primitive(index)
+
+    @constant_for_version_arg
+    def _at_cache_primitive(self, index):
+        if self._at_cache_version is not self.version:
+            self._at_cache_primitives = [-1] * len(AT_CACHE_SELECTORS)
+            self._at_cache_version = self.version
+        codes = self._at_cache_primitives
+        if codes[index] < 0:
+            codes[index] = 0
+            for i, selector in unrolling_at_cache_selectors:
+                if i == index:
+                    try:
+                        codes[i] = self.lookup(self.space.get_special_selector(selector)).primitive()
+                    except error.MethodNotFound:
+                        pass
+        return codes[index]
+
+    def lookup_in_hierarchy(self, w_selector):
         look_in_shadow = self
         while look_in_shadow is not None:
             w_method = look_in_shadow.s_methoddict().find_selector(w_selector)
@@ -255,17 +390,186 @@ class ClassShadow(AbstractCachingShadow):
         self.s_methoddict().methoddict[w_selector] = w_method
         if isinstance(w_method, model.W_CompiledMethod):
             w_method.compiledin_class = self.w_self()
+        self.changed()
+
+class PendingClassChanges(object):
+    """Classes whose methods changed, but whose subclasses were not given a new
+    version yet. The class itself gets a new version immediately. Its subclasses
+    get one before the next lookup, with one new version for all of them, so that
+    every subclass is visited only once, no matter how many methods were installed
+    in between.
+    The pending flag is quasi-immutable, so traces do not check it while no methods
+    are changed. It is only cleared after CLASS_CHANGES_QUIET_LOOKUPS lookups found
+    no new changes, so that a burst of changes (e.g. loading code) invalidates the
+    traces twice, instead of once per installed method."""
+
+    _attrs_ = ["classes_s", "pending", "quiet_lookups", "changes", "flushes"]
+    _immutable_fields_ = ["pending?"]
+
+    def __init__(self):
+        self.classes_s = []
+        self.pending = False
+        self.quiet_lookups = 0
+        self.changes = 0
+        self.flushes = 0
+
+    def add(self, s_class):
+        self.changes += 1
+        s_class.version = Version()
+        if not s_class._subclasses_pending:
+            s_class._subclasses_pending = True
+            self.classes_s.append(s_class)
+        self.quiet_lookups = 0
+        if not self.pending:
+            self.pending = True
+
+    def flush(self):
+        if self.pending:
+            self._flush()
+
+    def _flush(self):
+        if not self.classes_s:
+            self.quiet_lookups += 1
+            if self.quiet_lookups >= constants.CLASS_CHANGES_QUIET_LOOKUPS:
+                self.pending = False
+            return
+        classes_s = self.classes_s
+        self.classes_s = []
+        self.flushes += 1
+        version = Version()
+        for s_class in classes_s:
+            s_class._subclasses_pending = False
+            s_class.superclass_changed(version)
+
+    def print_stats(self):
+        print "Class changes: %d method dictionary changes in %d class hierarchy updates" % (
+            self.changes, self.flushes)
+
+class MethodCache(object):
+    """A global, fixed-size method lookup cache shared by all classes.
+    Entries are keyed on the selector and the class shadow. The version of the
+    class shadow is stored with each entry, so that entries become invalid
+    whenever the class or one of its superclasses is changed.
+    Failed lookups are cached as well, as entries without a method.
+    """
+
+    _attrs_ = ["size", "selectors_w", "classes_s", "versions", "methods_w",
+               "hits", "misses"]
+    _immutable_fields_ = ["size", "selectors_w", "classes_s", "versions", "methods_w"]
+
+    def __init__(self, size=constants.METHOD_CACHE_SIZE):
+        assert size > 0 and size & (size - 1) == 0, "Size must be a power of two"
+        self.size = size
+        self.selectors_w = [None] * size
+        self.classes_s = [None] * size
+        self.versions = [None] * size
+        self.methods_w = [None] * size
+        self.hits = 0
+        self.misses = 0
+
+    def index(self, s_class, w_selector):
+        hash = (objectmodel.compute_identity_hash(w_selector) ^
+                objectmodel.compute_identity_hash(s_class))
+        return hash & (self.size - 1)
+
+    def get(self, s_class, w_selector):
+        i = self.index(s_class, w_selector)
+        if (self.selectors_w[i] is w_selector and self.classes_s[i] is s_class
+                and self.versions[i] is s_class.version):
+            self.hits += 1
+            w_method = self.methods_w[i]
+            if w_method is None:
+                raise error.MethodNotFound()
+            return w_method
+        self.misses += 1
+        return None
+
+    def put(self, s_class, w_selector, w_method):
+        i = self.index(s_class, w_selector)
+        self.selectors_w[i] = w_selector
+        self.classes_s[i] = s_class
+        self.versions[i] = s_class.version
+        self.methods_w[i] = w_method
+
+    def flush(self):
+        for i in range(self.size):
+            self.selectors_w[i] = None
+            self.classes_s[i] = None
+            self.versions[i] = None
+            self.methods_w[i] = None
+
+    def print_stats(self):
+        lookups = self.hits + self.misses
+        percent = self.hits * 100 / lookups if lookups > 0 else 0
+        print "Method cache (%d entries): %d lookups, %d hits, %d misses (%d%% hits)" % (
+            self.size, lookups, self.hits, self.misses, percent)
+
+class InlineCache(object):
+    """A polymorphic inline cache for a single send site of a CompiledMethod.
+    It starts out monomorphic and remembers up to POLYMORPHIC_CACHE_SIZE
+    receiver classes. Each entry is validated against the version of the
+    class shadow. Entries without a method mean that the class does not
+    understand the selector. Megamorphic sites always use the global method cache.
+    """
+
+    _attrs_ = ["w_selector", "classes_s", "versions", "methods_w", "megamorphic"]
+    _immutable_fields_ = ["w_selector"]
+
+    def __init__(self, w_selector):
+        self.w_selector = w_selector
+        self.classes_s = []
+        self.versions = []
+        self.methods_w = []
+        self.megamorphic = False
+
+    def lookup(self, s_class):
+        s_class.space.pending_class_changes.flush()
+        if self.megamorphic:
+            return s_class.lookup(self.w_selector)
+        for i in range(len(self.classes_s)):
+            if self.classes_s[i] is s_class:
+                if self.versions[i] is not s_class.version:
+                    self.methods_w[i] = self._lookup_or_none(s_class)
+                    self.versions[i] = s_class.version
+                w_method = self.methods_w[i]
+                if w_method is None:
+                    raise error.MethodNotFound()
+                return w_method
+        w_method = self._lookup_or_none(s_class)
+        if len(self.classes_s) < constants.POLYMORPHIC_CACHE_SIZE:
+            self.classes_s.append(s_class)
+            self.versions.append(s_class.version)
+            self.methods_w.append(w_method)
+        else:
+            self.megamorphic = True
+            self.classes_s = []
+            self.versions = []
+            self.methods_w = []
+        if w_method is None:
+            raise error.MethodNotFound()
+        return w_method
+
+    def _lookup_or_none(self, s_class):
+        try:
+            return s_class.lookup(self.w_selector)
+        except error.MethodNotFound:
+            return None
 
 class MethodDictionaryShadow(ListStorageShadow):
 
     _immutable_fields_ = ['invalid?', 's_class']
-    _attrs_ = ['methoddict', 'invalid', 's_class']
+    _attrs_ = ['methoddict', 'invalid', 's_class', 'selectors_w', 'dirty']
     repr_classname = "MethodDictionaryShadow"
 
     def __init__(self, space, w_self, size):
         self.invalid = True
         self.s_class = None
         self.methoddict = {}
+        # The selector entered into methoddict for each slot, None for empty slots.
+        # Empty until the first full synchronization.
+        self.selectors_w = []
+        # Slots stored into since the last synchronization.
+        self.dirty = []
         ListStorageShadow.__init__(self, space, w_self, size)
 
     def s_become(self, w_self, w_other):
@@ -282,25 +586,38 @@ class MethodDictionaryShadow(ListStorageShadow):
         if self.s_class: self.s_class.store_s_methoddict(self)
         if s_other.s_class: s_other.s_class.store_s_methoddict(s_other)
 
-    def update(self):
-        self.sync_method_cache()
+    def update(self, index0):
+        # A method was stored into the values array.
+        self.mark_dirty(index0)
+        self.sync_changes()
 
     def find_selector(self, w_selector):
         if self.invalid:
             return None # we may be invalid if Smalltalk code did not call flushCache
         return self.methoddict.get(w_selector, None)
 
-    # We do not call update() after changes to ourselves:
+    # We do not synchronize after changes to ourselves:
     # Whenever a method is added, it's keyword is added to w_self, then the
     # w_compiled_method is added to our observee.
-    # sync_method_cache at this point would not have the desired effect, because in
+    # Synchronizing at this point would not have the desired effect, because in
     # the Smalltalk Implementation, the dictionary changes first. Afterwards
     # its contents array is filled with the value belonging to the new key.
     def store(self, n0, w_value):
         ListStorageShadow.store(self, n0, w_value)
         if n0 == constants.METHODDICT_VALUES_INDEX:
             self.setup_notification()
-        if n0 >= constants.METHODDICT_NAMES_INDEX:
+            self.selectors_w = []
+            self.mark_invalid()
+        elif n0 >= constants.METHODDICT_NAMES_INDEX:
+            self.mark_dirty(n0 - constants.METHODDICT_NAMES_INDEX)
+
+    def mark_dirty(self, index0):
+        self.dirty.append(index0)
+        self.mark_invalid()
+
+    def mark_invalid(self):
+        # invalid is quasi-immutable, only write it when it changes.
+        if not self.invalid:
             self.invalid = True
 
     def setup_notification(self):
@@ -311,37 +628,79 @@ class MethodDictionaryShadow(ListStorageShadow):
         assert isinstance(w_values, model.W_PointersObject)
         return w_values
 
+    def num_slots(self):
+        return self.size() - constants.METHODDICT_NAMES_INDEX
+
     def flush_method_cache(self):
         # Lazy synchronization: Only flush the cache, if we are already synchronized.
         if self.invalid:
+            self.sync_changes()
+
+    def sync_changes(self):
+        # Only synchronize the slots stored into since the last synchronization.
+        if self.size() == 0:
+            return
+        if len(self.selectors_w) != self.num_slots():
             self.sync_method_cache()
+            return
+        dirty = self.dirty
+        self.dirty = []
+        # Remove all old entries first, a selector might have moved to another dirty slot.
+        for index0 in dirty:
+            w_selector = self.selectors_w[index0]
+            if w_selector is not None:
+                self.selectors_w[index0] = None
+                if w_selector in self.methoddict:
+                    del self.methoddict[w_selector]
+        w_values = self.w_values()
+        for index0 in dirty:
+            w_selector = self.w_self().fetch(self.space, constants.METHODDICT_NAMES_INDEX + index0)
+            if w_selector.is_nil(self.space) or self.selectors_w[index0] is not None:
+                continue
+            if w_selector in self.methoddict:
+                # The same selector is in another slot, start over.
+                self.sync_method_cache()
+                return
+            self.enter_method(index0, w_selector, w_values.fetch(self.space, index0))
+        self.methods_changed()
 
     def sync_method_cache(self):
         if self.size() == 0:
             return
         self.methoddict = {}
-        size = self.size() - constants.METHODDICT_NAMES_INDEX
+        size = self.num_slots()
+        self.selectors_w = [None] * size
+        self.dirty = []
         w_values = self.w_values()
         for i in range(size):
             w_selector = self.w_self().fetch(self.space, constants.METHODDICT_NAMES_INDEX+i)
             if not w_selector.is_nil(self.space):
-                if isinstance(w_selector, model.W_BytesObject):
-                    selector = w_selector.as_string()
-                else:
-                    selector = "? (non-byteobject selector)"
-                    pass
-                    # TODO: Check if there's more assumptions about this.
-                    #       Putting any key in the methodDict and running with
-                    #       perform is actually supported in Squeak
-                    # raise ClassShadowError("bogus selector in method dict")
-                w_compiledmethod = w_values.fetch(self.space, i)
-                if not isinstance(w_compiledmethod, model.W_CompiledMethod):
-                    raise ClassShadowError("The methoddict must contain "
-                                       "CompiledMethods only, for now. "
-                                       "If the value observed is nil, our "
-                                       "invalidating mechanism may be broken.")
-                self.methoddict[w_selector] = w_compiledmethod
-                w_compiledmethod.set_lookup_class_and_name(self.s_class.w_self(), selector)
+                self.enter_method(i, w_selector, w_values.fetch(self.space, i))
+        self.methods_changed()
+
+    def enter_method(self, index0, w_selector, w_compiledmethod):
+        if isinstance(w_selector, model.W_BytesObject):
+            selector = w_selector.as_string()
+        else:
+            selector = "? (non-byteobject selector)"
+            pass
+            # TODO: Check if there's more assumptions about this.
+            #       Putting any key in the methodDict and running with
+            #       perform is actually supported in Squeak
+            # raise ClassShadowError("bogus selector in method dict")
+        if not isinstance(w_compiledmethod, model.W_CompiledMethod):
+            raise ClassShadowError("The methoddict must contain "
+                               "CompiledMethods only, for now. "
+                               "If the value observed is nil, our "
+                               "invalidating mechanism may be broken.")
+        self.methoddict[w_selector] = w_compiledmethod
+        self.selectors_w[index0] = w_selector
+        w_compiledmethod.set_lookup_class_and_name(self.s_class.w_self(), selector)
+
+    def methods_changed(self):
         if self.s_class:
-            self.s_class.changed()
-        self.invalid = False
+            # The versions of the subclasses are changed before the next lookup,
+            # so that loading many methods walks the subclasses only once.
+            self.space.pending_class_changes.add(self.s_class)
+        if self.invalid:
+            self.invalid = False
@@ -1,3 +1,4 @@
+import time
 
 from spyvm import model, constants, error, wrapper
 from spyvm.storage import AbstractRedirectingShadow
@@ -316,6 +317,53 @@ class ContextPartShadow(AbstractRedirectingShadow):
     def is_returned(self):
         return self.pc() == -1 and self.w_sender().is_nil(self.space)
 
+    # === Searching the sender chain ===
+    # These only follow the shadows, so the contexts on the way are not reified.
+
+    def is_unwind_context(self):
+        # Methods with primitive 198 are marked for unwinding, see BlockClosure >> ensure:
+        return self.is_BlockClosure_ensure()
+
+    def is_handler_context(self):
+        # Methods with primitive 199 are marked as exception handlers, see BlockClosure >> on:do:
+        return not self.is_block_context and self.w_method().primitive() == 199
+
+    def find_next_unwind_context_up_to(self, s_stop):
+        s_context = self.s_sender()
+        while s_context is not None and s_context is not s_stop:
+            if s_context.is_unwind_context():
+                return s_context
+            s_context = s_context.s_sender()
+        return None
+
+    def find_next_handler_context(self):
+        s_context = self
+        while s_context is not None:
+            if s_context.is_handler_context():
+                return s_context
+            s_context = s_context.s_sender()
+        return None
+
+    def has_sender(self, s_context):
+        if s_context is self:
+            return False
+        s_sender = self.s_sender()
+        while s_sender is not None:
+            if s_sender is s_context:
+                return True
+            s_sender = s_sender.s_sender()
+        return False
+
+    def terminate_to(self, s_previous):
+        # Terminate all contexts between this one and s_previous, if it is one of the senders.
+        if s_previous is not None and self.has_sender(s_previous):
+            s_context = self.s_sender()
+            while s_context is not s_previous:
+                s_sender = s_context.s_sender()
+                s_context.mark_returned()
+                s_context = s_sender
+        self.store_s_sender(s_previous)
+
     def external_stackpointer(self):
         return self.stackdepth() + self.stackstart()
 
@@ -333,6 +381,20 @@ class ContextPartShadow(AbstractRedirectingShadow):
         bytecode = self.w_method().fetch_bytecode(pc)
         return ord(bytecode)
 
+    def fetch_next_instruction(self):
+        # Return the bytecode at pc and its decoded operands, and move pc
+        # to the next instruction.
+        pc = jit.promote(self._pc)
+        assert pc >= 0
+        w_method = self.w_method()
+        start = pc * constants.INSTRUCTION_SIZE
+        space = self.space
+        self._pc = w_method.fetch_instruction(space, start + 4)
+        return (w_method.fetch_instruction(space, start),
+                w_method.fetch_instruction(space, start + 1),
+                w_method.fetch_instruction(space, start + 2),
+                w_method.fetch_instruction(space, start + 3))
+
     # ______________________________________________________________________
     # Temporary Variables
     #
@@ -637,7 +699,12 @@ class __extend__(ContextPartShadow):
         s_MethodContext = space.w_MethodContext.as_class_get_shadow(space)
         size = w_method.compute_frame_size() + s_MethodContext.instsize()
 
-        ctx = ContextPartShadow(space, None, size, is_block_context=False, w_method=w_method, closure=closure)
+        ctx = None
+        if not jit.we_are_jitted():
+            # In jitted code, contexts are virtual and do not need to be pooled.
+            ctx = space.context_pool.take(size, w_method, closure)
+        if ctx is None:
+            ctx = ContextPartShadow(space, None, size, is_block_context=False, w_method=w_method, closure=closure)
         ctx.store_w_receiver(w_receiver)
         ctx.store_w_method(w_method)
         ctx.closure = closure
@@ -645,6 +712,24 @@ class __extend__(ContextPartShadow):
         ctx.initialize_temps(arguments)
         return ctx
 
+    def reset_method_context(self, size):
+        # Prepare a context taken from the ContextPool for a new activation.
+        self._w_self_size = size
+        self.state = InactiveContext
+        self.store_pc(0)
+
+    def clear_method_context(self):
+        # Drop the references of a context that is put into the ContextPool.
+        self._s_sender = None
+        self._w_receiver = None
+        self._w_method = None
+        self.closure = None
+        if self.instances_w:
+            self.instances_w = {}
+        temps_and_stack = self._temps_and_stack
+        for i in range(len(temps_and_stack)):
+            temps_and_stack[i] = self.space.w_nil
+
     @jit.unroll_safe
     def initialize_temps(self, arguments):
         argc = len(arguments)
@@ -770,3 +855,94 @@ class __extend__(ContextPartShadow):
     def method_str_method_context(self):
         block = '[] in ' if self.is_closure_context() else ''
         return '%s%s' % (block, self.w_method().get_identifier_string())
+
+class ContextPool(object):
+    """Free lists of method contexts that were never reified, indexed by the
+    number of their temps and stack slots. A context is recycled when it returns
+    to its sender. Returned contexts are marked as such (see mark_returned), so
+    no other context can still refer to a context that was not reified.
+    The free lists share one capacity instead of having a fixed depth, so that
+    the contexts of a deep recursion are all reused by the next one."""
+
+    _attrs_ = ["free_lists", "pooled", "allocated", "reused", "recycled", "dropped"]
+
+    def __init__(self):
+        self.free_lists = [[] for i in range(constants.CONTEXT_POOL_STACK_SIZE)]
+        self.pooled = 0
+        self.allocated = 0
+        self.reused = 0
+        self.recycled = 0
+        self.dropped = 0
+
+    def take(self, size, w_method, closure):
+        # Return a pooled context for the given method or closure, or None if
+        # a new one has to be allocated.
+        if closure:
+            stacksize = size - constants.MTHDCTX_TEMP_FRAME_START + closure.tempsize()
+        else:
+            stacksize = w_method.compute_frame_size()
+        if 0 <= stacksize < len(self.free_lists):
+            free_list = self.free_lists[stacksize]
+            if free_list:
+                s_context = free_list.pop()
+                s_context.reset_method_context(size)
+                self.pooled -= 1
+                self.reused += 1
+                return s_context
+        self.allocated += 1
+        return None
+
+    def recycle(self, s_context):
+        if (s_context.is_block_context or s_context._w_self is not None
+                or s_context.is_BlockClosure_ensure()):
+            return
+        stacksize = len(s_context._temps_and_stack)
+        if stacksize < len(self.free_lists):
+            if self.pooled >= constants.CONTEXT_POOL_CAPACITY:
+                self.dropped += 1
+                return
+            s_context.clear_method_context()
+            self.free_lists[stacksize].append(s_context)
+            self.pooled += 1
+            self.recycled += 1
+
+    def print_stats(self):
+        print "Context pool: %d contexts allocated, %d reused, %d recycled, %d dropped" % (
+            self.allocated, self.reused, self.recycled, self.dropped)
+
+class ContextSwitchStats(object):
+    """Counts process switches and the stack overflows that unwind the
+    interpreter to Interpreter.loop. With --stats, process switches also
+    measure their latency, the time from the scheduler deciding to switch until
+    the suspended context of the new process is resumed. Stack overflows
+    continue the overflowing context from Interpreter.loop."""
+
+    _attrs_ = ["switches", "stack_overflows", "started", "total_latency", "max_latency"]
+
+    def __init__(self):
+        self.switches = 0
+        self.stack_overflows = 0
+        self.started = 0.0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def begin(self):
+        self.started = time.time()
+
+    def finish(self):
+        if self.started == 0.0:
+            return
+        latency = int((time.time() - self.started) * 1000000)
+        self.started = 0.0
+        self.switches += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def stack_overflow(self):
+        self.stack_overflows += 1
+
+    def print_stats(self):
+        average = self.total_latency / self.switches if self.switches > 0 else 0
+        print "Process switches: %d switches, %d us average latency, %d us max latency" % (
+            self.switches, average, self.max_latency)
+        print "Stack overflows: %d" % self.stack_overflows
@@ -1,8 +1,9 @@
 import py
 
-from .base import BaseJITTest
+from .base import BaseJITTest, stale_trace
 
 class TestBasic(BaseJITTest):
+    @stale_trace("the interrupt timer")
     def test_while_loop(self, spy, tmpdir):
         traces = self.run(spy, tmpdir, """
         0 to: 1000000000 do: [:t|nil].
@@ -42,6 +43,7 @@ class TestBasic(BaseJITTest):
          jump(p0, p1, i38, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, 9999, descr=TargetToken(48817488))
         """)
 
+    @stale_trace("the interrupt timer")
     def test_constant_string(self, spy, tmpdir):
         traces = self.run(spy, tmpdir, """
         | i |
@@ -62,6 +64,7 @@ class TestBasic(BaseJITTest):
          jump(p0, p3, i78, p12, p14, p16, p18, p20, p22, p24, p26, p28, p30, p32, p34, p36, p38, i68, i79, descr=TargetToken(16561632))
         """)
 
+    @stale_trace("the interrupt timer")
     def test_constant_string_equal2(self, spy, tmpdir):
         # This used to have a call to array comparison in it
         traces = self.run(spy, tmpdir, """
@@ -87,6 +90,7 @@ class TestBasic(BaseJITTest):
          jump(p0, p3, i80, p12, p14, p16, p18, p20, p22, p24, p26, p28, p30, p32, p34, p36, p38, i81, p65, p67, descr=TargetToken(57534304))
         """)
 
+    @stale_trace("the interrupt timer")
     def test_constant_string_var_equal(self, spy, tmpdir):
         # This used to have a call to array comparison in it
         traces = self.run(spy, tmpdir, """
@@ -114,6 +118,7 @@ class TestBasic(BaseJITTest):
          jump(p0, p3, i73, p8, p10, p12, p14, p20, p22, p24, p26, p28, p30, p32, p34, p36, p38, p40, p42, p44, p46, i74, descr=TargetToken(48821968))
         """)
 
+    @stale_trace("the interrupt timer")
     def test_bitblt_fillWhite(self, spy, tmpdir):
         # This used to have a call to array comparison in it
         traces = []
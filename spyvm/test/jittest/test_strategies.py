@@ -1,11 +1,12 @@
 import py
 
-from .base import BaseJITTest
+from .base import BaseJITTest, stale_trace
 
 class TestBasic(BaseJITTest):
 
      # TODO: there shouldnt be allocations in this
      # The cond_call operations should also not show up...
+    @stale_trace("the interrupt timer and the uncounted stack depth in jitted code")
     def test_range_asOrderedCollection(self, spy, tmpdir):
         traces = self.run(spy, tmpdir,
         """
@@ -88,6 +89,7 @@ class TestBasic(BaseJITTest):
              jump(p0, p3, p6, i225, p14, p16, p18, p20, p22, p24, p26, p28, p30, p32, p34, p36, p38, p40, p42, p54, i76, p68, i106, p92, p108, p80, i89, i91, i136, i85, i226, descr=TargetToken(48645456))
         """)
     
+    @stale_trace("the interrupt timer and the uncounted stack depth in jitted code")
     def test_indexOf(self, spy, tmpdir):
         traces = self.run(spy, tmpdir,
         """
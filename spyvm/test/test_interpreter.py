@@ -1,6 +1,6 @@
 import py, operator, sys
 from spyvm import model, interpreter, primitives, storage_classes, storage_contexts, wrapper, constants, error
-from .util import create_space_interp, copy_to_module, cleanup_module, import_bytecodes
+from .util import create_space_interp, copy_to_module, cleanup_module, import_bytecodes, TestInterpreter
 
 import_bytecodes(__name__)
 
@@ -27,6 +27,10 @@ def step_in_interp(ctxt): # due to missing resets in between tests
     interp._loop = False
     try:
         retval = interp.step(ctxt)
+        if isinstance(retval, model.W_Object):
+            # Local return to the sender
+            ctxt.s_sender().push(retval)
+            return ctxt.s_sender().w_self()
         if retval is not None:
             return retval.w_self()
     except interpreter.Return, nlr:
@@ -69,7 +73,7 @@ def run_with_faked_primitive_methods(methods, func, active_context=None):
         # Uninstall those methods:
         for (w_class, _, _, methname) in methods:
             s_class = w_class.as_class_get_shadow(space)
-            s_class.s_methoddict().update()
+            s_class.s_methoddict().sync_method_cache()
 
 def fakesymbol(s, _cache={}):
     try:
@@ -131,6 +135,15 @@ def test_unknownBytecode():
     w_frame, s_frame = new_frame(unknownBytecode)
     py.test.raises(error.MissingBytecode, step_in_interp, s_frame)
 
+def test_bytecode_dispatch_table():
+    from spyvm import interpreter_bytecodes
+    handlers = interpreter.BYTECODE_DISPATCH_TABLE.handlers
+    assert len(handlers) == 256 + len(interpreter_bytecodes.SUPERINSTRUCTIONS)
+    for bytecode in range(256):
+        methname = handlers[bytecode].func_name[len("handle_"):]
+        implementation = getattr(storage_contexts.ContextPartShadow, methname)
+        assert implementation.im_func is interpreter_bytecodes.BYTECODE_TABLE[bytecode].im_func
+
 # push bytecodes
 def test_pushReceiverBytecode():
     w_frame, s_frame = new_frame(pushReceiverBytecode)
@@ -182,6 +195,22 @@ def test_pushLiteralVariableBytecode(bytecode=pushLiteralVariableBytecode(0)):
     step_in_interp(s_frame)
     assert_list(s_frame.stack(), ["myvalue"])
 
+def test_pushLiteralVariableBytecode_rebinding():
+    w_association = bootstrap_class(2).as_class_get_shadow(space).new()
+    w_association.store(space, 0, w("mykey"))
+    w_association.store(space, 1, w("myvalue"))
+    w_frame, s_frame = new_frame(pushLiteralVariableBytecode(0) + pushConstantOneBytecode +
+                                 extendedStoreAndPopBytecode + chr((3<<6) + 0) +
+                                 pushLiteralVariableBytecode(0))
+    s_frame.w_method().setliterals(fakeliterals(space, w_association))
+    step_in_interp(s_frame)
+    s_association = w_association.as_cached_object_get_shadow(space)
+    version = s_association.version
+    for i in range(3):
+        step_in_interp(s_frame)
+    assert s_association.version is not version
+    assert_list(s_frame.stack(), ["myvalue", 1])
+
 def test_storeAndPopReceiverVariableBytecode(bytecode=storeAndPopReceiverVariableBytecode,
                                              popped=True):
     shadow = bootstrap_class(8).as_class_get_shadow(space)
@@ -435,7 +464,7 @@ def test_sendLiteralSelectorBytecode():
     w_object = w_class.as_class_get_shadow(space).new()
     sendBytecodesTest(w_class, w_object, sendLiteralSelectorBytecode(0))
 
-def test_fibWithArgument():
+def fib_frame():
     bytecode = ''.join(map(chr, [ 16, 119, 178, 154, 118, 164, 11, 112, 16, 118, 177, 224, 112, 16, 119, 177, 224, 176, 124 ]))
     shadow = bootstrap_class(0).as_class_get_shadow(space)
     method = model.W_CompiledMethod(space, len(bytecode))
@@ -451,8 +480,32 @@ def test_fibWithArgument():
     s_frame.w_method().setliterals(literals)
     s_frame.push(w_object)
     s_frame.push(space.wrap_int(8))
-    result = interp.interpret_toplevel(w_frame)
+    return w_frame
+
+def test_fibWithArgument():
+    result = interp.interpret_toplevel(fib_frame())
+    assert space.unwrap_int(result) == 34
+    assert not space.interrupt_timer.running
+
+def test_stack_depth_is_bounded():
+    from .util import TestInterpreter
+    shallow_interp = TestInterpreter(space, max_stack_depth=3)
+    stack_overflows = space.context_switches.stack_overflows
+    result = shallow_interp.interpret_toplevel(fib_frame())
+    assert space.unwrap_int(result) == 34
+    assert space.context_switches.stack_overflows > stack_overflows
+    assert shallow_interp.remaining_stack_depth == 3
+
+def test_stack_depth_is_not_counted_in_jitted_code(monkeypatch):
+    from rpython.rlib import jit
+    from .util import TestInterpreter
+    shallow_interp = TestInterpreter(space, max_stack_depth=3)
+    stack_overflows = space.context_switches.stack_overflows
+    monkeypatch.setattr(jit, "we_are_jitted", lambda: True)
+    result = shallow_interp.interpret_toplevel(fib_frame())
     assert space.unwrap_int(result) == 34
+    assert space.context_switches.stack_overflows == stack_overflows
+    assert shallow_interp.remaining_stack_depth == 3
 
 def test_send_to_primitive():
 
@@ -531,6 +584,50 @@ def test_shortConditionalJumpBytecode():
     step_in_interp(s_frame)
     assert s_frame.pc() == pc + 4
 
+def test_pushTemporaryLiteralAddSuperinstruction():
+    w_frame, s_frame = new_frame(pushTemporaryVariableBytecode(0) +
+                                 pushLiteralConstantBytecode(0) + bytecodePrimAdd)
+    s_frame.w_method().setliterals(fakeliterals(space, 4))
+    s_frame.settemp(0, w(3))
+    step_in_interp(s_frame)
+    assert s_frame.pc() == 3
+    assert s_frame.pop().value == 7
+
+def test_compareAndJumpSuperinstruction():
+    w_frame, s_frame = new_frame(pushConstantOneBytecode + pushConstantTwoBytecode +
+                                 bytecodePrimLessThan + shortConditionalJumpBytecode(3) +
+                                 pushConstantOneBytecode + pushConstantTwoBytecode +
+                                 bytecodePrimGreaterThan + longJumpIfFalseBytecode(0) + chr(15))
+    step_in_interp(s_frame)
+    step_in_interp(s_frame)
+    step_in_interp(s_frame)
+    assert s_frame.pc() == 4
+    step_in_interp(s_frame)
+    step_in_interp(s_frame)
+    step_in_interp(s_frame)
+    assert s_frame.pc() == 9 + 15
+    assert s_frame.stackdepth() == s_frame.tempsize()
+
+def test_no_superinstructions():
+    space.no_superinstructions.activate()
+    try:
+        w_frame, s_frame = new_frame(pushTemporaryVariableBytecode(0) +
+                                     pushLiteralConstantBytecode(0) + bytecodePrimAdd)
+        s_frame.w_method().setliterals(fakeliterals(space, 4))
+        s_frame.settemp(0, w(3))
+        step_in_interp(s_frame)
+        assert s_frame.pc() == 1
+    finally:
+        space.no_superinstructions.deactivate()
+
+def test_trace_bytecodes(capsys):
+    for trace, trace_bytecodes, printed in [(True, False, False), (False, True, True)]:
+        traced_interp = TestInterpreter(space, trace=trace, trace_bytecodes=trace_bytecodes)
+        w_frame, s_frame = new_frame(pushConstantTrueBytecode)
+        traced_interp.step(s_frame)
+        out, err = capsys.readouterr()
+        assert ("pushConstantTrueBytecode" in out) == printed
+
 def test_popStackBytecode():
     w_frame, s_frame = new_frame(pushConstantTrueBytecode +
                              popStackBytecode)
@@ -612,6 +709,21 @@ def test_bytecodePrimBool():
                                           space.w_true, space.w_false,
                                           space.w_false, space.w_true])
 
+def test_bytecodePrimArithmetic_floats():
+    w_frame, s_frame = new_frame(bytecodePrimAdd + bytecodePrimMultiply +
+                                 bytecodePrimSubtract + bytecodePrimLessThan)
+    s_frame.push(space.wrap_float(1.5))
+    s_frame.push(space.wrap_float(2.0))
+    step_in_interp(s_frame)
+    s_frame.push(space.w_two)
+    step_in_interp(s_frame)
+    assert s_frame.top().value == 7.0
+    s_frame.push(space.wrap_float(0.5))
+    step_in_interp(s_frame)
+    s_frame.push(space.wrap_int(7))
+    step_in_interp(s_frame)
+    assert s_frame.stack() == [space.w_true]
+
 def test_singleExtendedSendBytecode():
     w_class = bootstrap_class(0)
     w_object = w_class.as_class_get_shadow(space).new()
@@ -799,6 +911,25 @@ def test_bc_primBytecodeAt_with_instvars():
         [[w_fakeclass, primitives.AT, 1, "at:"]],
         test)
 
+def test_bc_primBytecodeAt_at_cache():
+    #   ^ self at: 2
+    w_fakeclass = bootstrap_class(0, name='fakeclass', varsized=True)
+    s_fakeclass = w_fakeclass.as_class_get_shadow(space)
+    w_fakeinst = s_fakeclass.new(2)
+    w_fakeinst.store(space, 1, space.w_true)
+    def test():
+        assert interpret_bc([112, 119, 192, 124], fakeliterals(space, ),
+                            receiver=w_fakeinst) is space.w_true
+        assert s_fakeclass.at_cache_primitive(storage_classes.AT_CACHE_AT) == primitives.AT
+        # The at: method is sent if the index is out of bounds
+        w_frame, s_frame = new_frame(bytecodePrimAt)
+        s_frame.push(w_fakeinst)
+        s_frame.push(space.wrap_int(3))
+        assert step_in_interp(s_frame) is not w_frame
+    run_with_faked_primitive_methods(
+        [[w_fakeclass, primitives.AT, 1, "at:"]],
+        test)
+
 def test_bc_primBytecodeAtPut_with_instvars():
     #   ^ self at: 1 put: #b
     w_fakeclass = bootstrap_class(1, name='fakeclass', varsized=True)
@@ -952,6 +1083,16 @@ def test_blockclosure_return():
             2, "value:value:"]],
         test)
 
+def test_context_pool():
+    pool = space.context_pool
+    recycled = pool.recycled
+    test_blockclosure_valuevalue()
+    # The context of the block returned to its sender
+    assert pool.recycled == recycled + 1
+    reused = pool.reused
+    test_blockclosure_valuevalue()
+    assert pool.reused == reused + 1
+
 def test_frame_dirty_if_active():
     bytes = reduce(operator.add, map(chr, [0x84, 0xc0, 0x00]))
     w_frame, s_frame = new_frame(bytes)
@@ -982,4 +1123,185 @@ def test_raise_NonVirtualReturn_on_dirty_frame():
     def do_test():
         interp.stack_frame(s_frame, None)
     py.test.raises(interpreter.NonVirtualReturn, do_test)
-    
\ No newline at end of file
+    
+def test_return_to_active_sender_unwinds_only_abandoned_frames():
+    # The child stores the grandparent as its own sender and returns.
+    bytes = reduce(operator.add, map(chr, [0x10, 0x81, 0x00])) + returnTopFromMethodBytecode
+    w_grandparent, s_grandparent = new_frame(pushConstantOneBytecode)
+    w_parent, s_parent = new_frame(pushConstantOneBytecode)
+    w_child, s_child = new_frame(bytes)
+    s_child.store_w_receiver(w_child)
+    s_child.settemp(0, w_grandparent)
+    s_child.store_s_sender(s_parent)
+    s_parent.store_s_sender(s_grandparent)
+    s_grandparent.state = storage_contexts.ActiveContext
+
+    loop_bytecodes = interp.loop_bytecodes
+    def parent_bytecodes(s_context, may_context_switch=True):
+        if s_context is not s_parent:
+            return loop_bytecodes(s_context, may_context_switch)
+        interp.stack_frame(s_child, s_parent)
+        assert False, "the parent was cut out of the sender chain"
+    interp.loop_bytecodes = parent_bytecodes
+    interp._loop = True
+    try:
+        assert interp.stack_frame(s_parent, s_grandparent) is None
+    finally:
+        del interp.loop_bytecodes
+        s_grandparent.state = storage_contexts.InactiveContext
+    assert s_grandparent.pop() is w_grandparent
+
+def test_local_return_does_not_raise():
+    w_frame, s_frame = new_frame(pushReceiverBytecode + returnTopFromMethodBytecode)
+    s_frame.store_w_receiver(w_frame)
+    w_sender, s_sender = new_frame(pushConstantOneBytecode)
+
+    interp._loop = True
+    assert interp.stack_frame(s_frame, s_sender) is None
+    assert s_sender.pop() is w_frame
+    w_frame, s_frame = new_frame(returnTrueBytecode)
+    assert interp.stack_frame(s_frame, None) is space.w_true
+
+def test_interrupt_timer():
+    import time
+    from spyvm.util.interrupt_timer import InterruptTimer
+    timer = InterruptTimer(period=1)
+    assert not timer.is_pending()
+    timer.start()
+    time.sleep(0.002)
+    assert timer.is_pending()
+    timer.acknowledge()
+    assert not timer.is_pending()
+    timer.stop()
+    timer.record_wakeup(3)
+    timer.record_wakeup(1)
+    assert timer.wakeups == 2
+    assert timer.max_latency == 3
+
+def test_process_switch_stats():
+    from spyvm.storage_contexts import ContextSwitchStats
+    stats = ContextSwitchStats()
+    stats.begin()
+    stats.finish()
+    stats.begin()
+    stats.finish()
+    assert stats.switches == 2
+    assert 0 <= stats.max_latency
+    assert stats.total_latency <= 2 * stats.max_latency
+    stats.finish()
+    assert stats.switches == 2
+    stats.stack_overflow()
+    assert stats.stack_overflows == 1
+
+def switching_interp(max_stack_depth, s_process_a, s_process_b):
+    # Process A switches to process B, which switches back to A.
+    from .util import TestInterpreter
+    calls = []
+    class SwitchingInterpreter(TestInterpreter):
+        def loop_bytecodes(self, s_context, may_context_switch=True):
+            calls.append((s_context, self.remaining_stack_depth))
+            if s_context is s_process_a and len(calls) == 1:
+                raise interpreter.ProcessSwitch(s_process_b)
+            if s_context is s_process_b:
+                raise interpreter.ProcessSwitch(s_process_a)
+            return space.w_true
+    switching = SwitchingInterpreter(space, max_stack_depth=max_stack_depth)
+    switching._loop = True
+    return switching, calls
+
+def test_process_switch_keeps_suspended_frames_on_stack():
+    w_process_a, s_process_a = new_frame(returnTrueBytecode)
+    w_process_b, s_process_b = new_frame(returnTrueBytecode)
+    switching, calls = switching_interp(10, s_process_a, s_process_b)
+    assert switching.stack_frame(s_process_a, None) is space.w_true
+    # B runs on top of A, then A is resumed in place.
+    assert calls == [(s_process_a, 9), (s_process_b, 8), (s_process_a, 9)]
+    assert switching.remaining_stack_depth == 10
+    assert s_process_a.state is storage_contexts.InactiveContext
+    assert s_process_b.state is storage_contexts.InactiveContext
+
+def test_process_switch_unwinds_without_stack_depth():
+    w_process_a, s_process_a = new_frame(returnTrueBytecode)
+    w_process_b, s_process_b = new_frame(returnTrueBytecode)
+    switching, calls = switching_interp(2, s_process_a, s_process_b)
+    with py.test.raises(interpreter.ProcessSwitch):
+        switching.stack_frame(s_process_a, None)
+    assert calls == [(s_process_a, 1)]
+    assert switching.remaining_stack_depth == 2
+
+def scripted_interp(monkeypatch, script):
+    # Runs the functions in script instead of the bytecodes of the contexts,
+    # and records the contexts run so far whenever a process switch is counted.
+    from .util import TestInterpreter
+    calls = []
+    switches = []
+    class ScriptedInterpreter(TestInterpreter):
+        def loop_bytecodes(self, s_context, may_context_switch=True):
+            runs = calls.count(s_context)
+            calls.append(s_context)
+            return script[s_context](runs)
+    class SwitchRecorder(object):
+        def finish(self):
+            switches.append(list(calls))
+    monkeypatch.setattr(space, "context_switches", SwitchRecorder())
+    scripted = ScriptedInterpreter(space, max_stack_depth=10)
+    scripted._loop = True
+    return scripted, calls, switches
+
+def test_debug_process_suspended_on_stack(monkeypatch):
+    w_process_a, s_process_a = new_frame(returnTrueBytecode)
+    w_callee_a, s_callee_a = new_frame(returnTrueBytecode)
+    w_debugger, s_debugger = new_frame(returnTrueBytecode)
+    def process_a(runs):
+        if runs == 0:
+            scripted.stack_frame(s_callee_a, s_process_a)
+            return space.w_true
+        return space.w_false
+    def callee_a(runs):
+        raise interpreter.ProcessSwitch(s_debugger)
+    def debugger(runs):
+        # Restart the suspended process at its first frame and resume it.
+        s_callee_a.mark_returned()
+        s_process_a.store_pc(0)
+        raise interpreter.ProcessSwitch(s_process_a)
+    scripted, calls, switches = scripted_interp(monkeypatch, {
+        s_process_a: process_a, s_callee_a: callee_a, s_debugger: debugger})
+    with py.test.raises(interpreter.ReturnFromTopLevel) as e:
+        scripted.loop(w_process_a)
+    assert e.value.object is space.w_false
+    # The restarted frame continues in place, the returned one is dropped.
+    assert calls == [s_process_a, s_callee_a, s_debugger, s_process_a]
+    assert switches == [calls[:2], calls[:3]]
+    assert scripted.remaining_stack_depth == 10
+    for s_context in [s_process_a, s_callee_a, s_debugger]:
+        assert s_context.state is storage_contexts.InactiveContext
+
+def test_terminate_process_suspended_on_stack(monkeypatch):
+    w_process_a, s_process_a = new_frame(returnTrueBytecode)
+    w_callee_a, s_callee_a = new_frame(returnTrueBytecode)
+    w_process_b, s_process_b = new_frame(returnTrueBytecode)
+    w_process_c, s_process_c = new_frame(returnTrueBytecode)
+    def process_a(runs):
+        scripted.stack_frame(s_callee_a, s_process_a)
+        return space.w_true
+    def callee_a(runs):
+        raise interpreter.ProcessSwitch(s_process_b)
+    def process_b(runs):
+        # Terminate the suspended process and switch to another one.
+        s_callee_a.mark_returned()
+        s_process_a.mark_returned()
+        raise interpreter.ProcessSwitch(s_process_c)
+    def process_c(runs):
+        return space.w_nil
+    scripted, calls, switches = scripted_interp(monkeypatch, {
+        s_process_a: process_a, s_callee_a: callee_a,
+        s_process_b: process_b, s_process_c: process_c})
+    with py.test.raises(interpreter.ReturnFromTopLevel) as e:
+        scripted.loop(w_process_a)
+    assert e.value.object is space.w_nil
+    # The frames of the terminated process are never continued.
+    assert calls == [s_process_a, s_callee_a, s_process_b, s_process_c]
+    assert switches == [calls[:2], calls[:3]]
+    assert scripted.remaining_stack_depth == 10
+    for s_context in [s_process_a, s_callee_a, s_process_b, s_process_c]:
+        assert s_context.state is storage_contexts.InactiveContext
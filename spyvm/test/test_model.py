@@ -54,20 +54,6 @@ def test_bytes_object():
     assert w_bytes.getchar(0) == "\x00"
     py.test.raises(IndexError, lambda: w_bytes.getchar(20))
 
-@py.test.mark.skipif("'removed interpreter proxy'")
-def test_c_bytes_object():
-    w_class = bootstrap_class(0, format=storage_classes.BYTES)
-    w_bytes = w_class.as_class_get_shadow(space).new(20)
-    w_bytes.convert_to_c_layout()
-    assert w_bytes.getclass(space).is_same_object(w_class)
-    assert w_bytes.size() == 20
-    assert w_class.as_class_get_shadow(space).instsize() == 0
-    assert w_bytes.getchar(3) == "\x00"
-    w_bytes.setchar(3, "\xAA")
-    assert w_bytes.getchar(3) == "\xAA"
-    assert w_bytes.getchar(0) == "\x00"
-    py.test.raises(IndexError, lambda: w_bytes.getchar(20))
-
 def test_word_object():
     w_class = bootstrap_class(0, format=storage_classes.WORDS)
     w_bytes = w_class.as_class_get_shadow(space).new(20)
@@ -80,19 +66,37 @@ def test_word_object():
     assert w_bytes.getword(0) == 0
     py.test.raises(AssertionError, lambda: w_bytes.getword(20))
 
-@py.test.mark.skipif("'removed interpreter proxy'")
-def test_c_word_object():
+def test_word_object_stores_32bit_words():
     w_class = bootstrap_class(0, format=storage_classes.WORDS)
-    w_bytes = w_class.as_class_get_shadow(space).new(20)
-    w_bytes.convert_to_c_layout()
-    assert w_bytes.getclass(space).is_same_object(w_class)
-    assert w_bytes.size() == 20
-    assert w_class.as_class_get_shadow(space).instsize() == 0
-    assert w_bytes.getword(3) == 0
-    w_bytes.setword(3, 42)
-    assert w_bytes.getword(3) == 42
-    assert w_bytes.getword(0) == 0
-    py.test.raises(AssertionError, lambda: w_bytes.getword(20))
+    w_words = w_class.as_class_get_shadow(space).new(2)
+    w_words.setword(0, r_uint(0xffffffff))
+    assert w_words.getword(0) == r_uint(0xffffffff)
+    w_clone = w_words.clone(space)
+    w_clone.setword(1, r_uint(7))
+    assert w_clone.getword(0) == r_uint(0xffffffff)
+    assert w_words.getword(1) == 0
+
+def test_bytes_replace_range_and_fill():
+    w_class = bootstrap_class(0, format=storage_classes.BYTES)
+    w_bytes = w_class.as_class_get_shadow(space).new(5)
+    w_bytes.fill(ord("a"))
+    assert "".join(w_bytes.bytes) == "aaaaa"
+    w_bytes.replace_range(space, 1, 3, space.wrap_string("xyz"), 0)
+    assert "".join(w_bytes.bytes) == "axyza"
+    # Overlapping ranges of the same object are copied forward, like in Smalltalk
+    w_bytes.replace_range(space, 1, 4, w_bytes, 0)
+    assert "".join(w_bytes.bytes) == "aaaaa"
+    w_bytes.replace_range(space, 0, 2, space.wrap_string("xyz"), 0)
+    w_bytes.replace_range(space, 0, 3, w_bytes, 1)
+    assert "".join(w_bytes.bytes) == "yzaaa"
+
+def test_words_replace_range_and_fill():
+    w_class = bootstrap_class(0, format=storage_classes.WORDS)
+    w_words = w_class.as_class_get_shadow(space).new(3)
+    w_other = w_class.as_class_get_shadow(space).new(3)
+    w_other.fill(0xffffffff)
+    w_words.replace_range(space, 1, 2, w_other, 0)
+    assert [w_words.getword(i) for i in range(3)] == [0, r_uint(0xffffffff), r_uint(0xffffffff)]
 
 def test_method_lookup():
     class mockmethod(object):
@@ -115,6 +119,31 @@ def test_method_lookup():
     assert subshadow.lookup(w_bar).val == 2
     py.test.raises(error.MethodNotFound, subshadow.lookup, "zork")
 
+def test_method_lookup_misses_are_cached():
+    w_dnu = space.wrap_string("doesNotUnderstand:")
+    dnu = model.W_CompiledMethod(space, 0)
+    w_class = bootstrap_class(0)
+    shadow = w_class.as_class_get_shadow(space)
+    shadow.installmethod(w_dnu, dnu)
+    w_subclass = bootstrap_class(0, w_superclass=w_class)
+    subshadow = w_subclass.as_class_get_shadow(space)
+    subshadow.installmethod(w_foo, dnu)
+    cache = space.method_cache
+
+    py.test.raises(error.MethodNotFound, subshadow.lookup, w_bar)
+    py.test.raises(error.MethodNotFound, cache.get, subshadow, w_bar)
+    subshadow.changed()
+    assert cache.get(subshadow, w_bar) is None
+
+    old_dnu = space.objtable["w_doesNotUnderstand"]
+    space.objtable["w_doesNotUnderstand"] = w_dnu
+    try:
+        w_method, s_message_class = subshadow.lookup_doesNotUnderstand()
+        assert w_method is dnu
+        assert s_message_class.w_self() is space.w_Message
+    finally:
+        space.objtable["w_doesNotUnderstand"] = old_dnu
+
 def test_compiledin_class():
     w_super = bootstrap_class(0)
     w_class = bootstrap_class(0, w_superclass=w_super)
@@ -189,6 +218,22 @@ def test_compiledmethod_atput0():
     assert space.unwrap_int(w_method.at0(space, 13)) == ord('b')
     assert space.unwrap_int(w_method.at0(space, 14)) == ord('c')
 
+def test_compiledmethod_instructions():
+    from spyvm.constants import INSTRUCTION_SIZE
+    # pushTemporaryVariable(1), extendedPush (literal 5), returnTop
+    w_method = model.W_CompiledMethod(space, 4)
+    w_method.setbytes([chr(17), chr(128), chr(0x85), chr(124)])
+    assert w_method.fetch_instruction(space, 0) == 17
+    assert w_method.fetch_instruction(space, 4) == 1
+    assert w_method.fetch_instruction(space, INSTRUCTION_SIZE) == 128
+    assert w_method.fetch_instruction(space, INSTRUCTION_SIZE + 1) == 2
+    assert w_method.fetch_instruction(space, INSTRUCTION_SIZE + 2) == 5
+    assert w_method.fetch_instruction(space, INSTRUCTION_SIZE + 4) == 3
+    # Storing into the bytecodes invalidates the decoded instructions
+    w_method.atput0(space, w_method.bytecodeoffset() + 2, space.wrap_int(0x47))
+    assert w_method.fetch_instruction(space, INSTRUCTION_SIZE + 1) == 1
+    assert w_method.fetch_instruction(space, INSTRUCTION_SIZE + 2) == 7
+
 def test_compiledmethod_atput0_not_aligned():
     header = joinbits([0,2,0,0,0,0],[9,8,1,6,4,1])
     w_method = model.W_CompiledMethod(space, 3, header)
@@ -430,8 +475,8 @@ def test_weak_pointers():
     s_cls.instance_kind = storage_classes.WEAK_POINTERS
 
     weak_object = s_cls.new()
-    referenced = model.W_SmallInteger(10)
-    referenced2 = model.W_SmallInteger(20)
+    referenced = model.W_PointersObject(space, space.w_Array, 1)
+    referenced2 = model.W_PointersObject(space, space.w_Array, 1)
     weak_object.store(space, 0, referenced)
     weak_object.store(space, 1, referenced2)
 
@@ -441,4 +486,18 @@ def test_weak_pointers():
     # Thus the reference may linger until the next gc...
     import gc; gc.collect()
     assert weak_object.fetch(space, 0).is_nil(space)
-    assert weak_object.fetch(space, 1).value == 20
+    assert weak_object.fetch(space, 1) is referenced2
+
+def test_weak_pointers_hold_small_integers():
+    # Tagged SmallIntegers cannot be referenced weakly.
+    w_cls = bootstrap_class(2)
+    s_cls = w_cls.as_class_get_shadow(space)
+    s_cls.instance_kind = storage_classes.WEAK_POINTERS
+
+    weak_object = s_cls.new()
+    weak_object.store(space, 0, space.wrap_int(10))
+    import gc; gc.collect()
+    assert weak_object.fetch(space, 0).value == 10
+    assert weak_object.fetch(space, 1).is_nil(space)
+    weak_object.store(space, 0, space.w_true)
+    assert weak_object.fetch(space, 0) is space.w_true
@@ -65,3 +65,14 @@ def test_wrap_int():
     for num in [2L, -5L]:
         with py.test.raises(AssertionError):
             space.wrap_int(num)
+
+def test_wrap_int_tagged_range():
+    # SmallIntegers must fit into a tagged pointer (one bit less than a word)
+    assert space.wrap_int(sys.maxint / 2).value == sys.maxint / 2
+    assert space.wrap_int(-(sys.maxint / 2) - 1).value == -(sys.maxint / 2) - 1
+    for num in [sys.maxint / 2 + 1, -(sys.maxint / 2) - 2, sys.maxint]:
+        with py.test.raises(objspace.WrappingError):
+            space.wrap_int(num)
+    w_boxed = space.wrap_positive_32bit_int(sys.maxint)
+    assert isinstance(w_boxed, model.W_LargePositiveInteger1Word)
+    assert space.unwrap_int(w_boxed) == sys.maxint
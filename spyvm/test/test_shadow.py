@@ -1,5 +1,5 @@
 import random
-from spyvm import model, storage_classes, constants, wrapper
+from spyvm import model, storage_classes, storage_contexts, constants, wrapper, primitives
 from .util import create_space, copy_to_module, cleanup_module
 
 def setup_module():
@@ -204,11 +204,35 @@ def test_cached_object_shadow():
     assert version is not s_o.version
     assert w_o.at0(space, 0) == 8
 
+def test_cached_object_shadow_stops_caching_after_changes():
+    w_o = space.wrap_list([space.w(0)])
+    s_o = w_o.as_cached_object_get_shadow(space)
+    for i in range(constants.CACHED_OBJECT_CHANGE_LIMIT):
+        w_o.atput0(space, 0, space.w(i))
+    assert not s_o.uncached
+    w_o.atput0(space, 0, space.w(42))
+    assert s_o.uncached
+    version = s_o.version
+    w_o.atput0(space, 0, space.w(43))
+    assert s_o.version is version
+    assert w_o.at0(space, 0).value == 43
+
+def test_cached_object_shadow_keeps_caching_rare_changes():
+    w_o = space.wrap_list([space.w(0)])
+    s_o = w_o.as_cached_object_get_shadow(space)
+    for i in range(constants.CACHED_OBJECT_CHANGE_LIMIT * 3):
+        s_o.last_change -= constants.CACHED_OBJECT_QUIET_PERIOD + 1
+        version = s_o.version
+        w_o.atput0(space, 0, space.w(i))
+        assert not s_o.uncached
+        assert s_o.version is not version
+        assert w_o.at0(space, 0).value == i
+
 def test_observee_shadow():
     notified = False
     class Observer():
         def __init__(self): self.notified = False
-        def update(self): self.notified = True
+        def update(self, n0): self.notified = True
     o = Observer()
     w_o = w_Array.as_class_get_shadow(space).new(1)
     w_o.as_observed_get_shadow(space).notify(o)
@@ -271,6 +295,121 @@ def test_updating_class_changes_subclasses():
     assert s_class.version is not version
     assert s_class.version is w_parent.as_class_get_shadow(space).version
 
+def test_methoddict_synchronizes_stored_slots():
+    foo = model.W_CompiledMethod(space, 0)
+    bar = model.W_CompiledMethod(space, 0)
+    baz = model.W_CompiledMethod(space, 0)
+    w_class = build_smalltalk_class("Demo", 0x90, methods={'foo': foo, 'baz': baz})
+    s_class = w_class.as_class_get_shadow(space)
+    s_md = s_class.s_methoddict()
+    w_foo, = [w_sel for w_sel in s_md.methoddict if s_md.methoddict[w_sel] is foo]
+    w_baz, = [w_sel for w_sel in s_md.methoddict if s_md.methoddict[w_sel] is baz]
+    index0 = s_md.selectors_w.index(w_foo)
+    empty0 = s_md.selectors_w.index(None)
+    w_bar = space.wrap_string('bar')
+
+    # Add a method the way MethodDictionary>>at:put: does
+    s_md.w_self().store(space, constants.METHODDICT_NAMES_INDEX + empty0, w_bar)
+    assert s_md.invalid
+    assert s_md.dirty == [empty0]
+    s_md.w_values().store(space, empty0, bar)
+    assert not s_md.invalid
+    assert s_md.dirty == []
+    assert s_md.methoddict == {w_foo: foo, w_bar: bar, w_baz: baz}
+    assert s_md.selectors_w[empty0] is w_bar
+
+    # Remove the old method
+    s_md.w_self().store(space, constants.METHODDICT_NAMES_INDEX + index0, space.w_nil)
+    s_md.w_values().store(space, index0, space.w_nil)
+    assert s_md.methoddict == {w_bar: bar, w_baz: baz}
+    assert s_class.lookup(w_bar) is bar
+
+def test_methoddict_changes_are_batched():
+    foo = model.W_CompiledMethod(space, 0)
+    w_parent = build_smalltalk_class("Demo", 0x90, methods={'foo': foo})
+    w_class = build_smalltalk_class("Demo", 0x90, w_superclass=w_parent)
+    s_parent = w_parent.as_class_get_shadow(space)
+    s_class = w_class.as_class_get_shadow(space)
+    w_foo = s_parent.s_methoddict().methoddict.keys()[0]
+    pending = space.pending_class_changes
+    pending.flush()
+    flushes = pending.flushes
+    version = s_class.version
+    parent_version = s_parent.version
+
+    s_parent.s_methoddict().sync_method_cache()
+    s_parent.s_methoddict().sync_method_cache()
+    assert pending.pending
+    assert pending.classes_s == [s_parent]
+    assert s_parent.version is not parent_version
+    assert s_class.version is version
+    # The next lookup changes the versions of the subclasses at once
+    assert s_class.lookup(w_foo) is foo
+    assert pending.classes_s == []
+    assert pending.flushes == flushes + 1
+    assert s_class.version is not version
+    assert s_class.version is s_parent.version
+    # The quasi-immutable flag is only cleared after a quiet period
+    assert pending.pending
+    for i in range(constants.CLASS_CHANGES_QUIET_LOOKUPS - 1):
+        s_class.lookup(w_foo)
+    assert pending.pending
+    s_class.lookup(w_foo)
+    assert not pending.pending
+    assert pending.flushes == flushes + 1
+
+def test_method_cache():
+    foo = model.W_CompiledMethod(space, 0)
+    w_parent = build_smalltalk_class("Demo", 0x90, methods={'foo': foo})
+    w_class = build_smalltalk_class("Demo", 0x90, w_superclass=w_parent)
+    s_parent = w_parent.as_class_get_shadow(space)
+    s_class = w_class.as_class_get_shadow(space)
+    w_foo = s_parent.s_methoddict().methoddict.keys()[0]
+    cache = space.method_cache
+    hits, misses = cache.hits, cache.misses
+
+    assert s_class.lookup(w_foo) is foo
+    assert cache.misses == misses + 1
+    assert s_class.lookup(w_foo) is foo
+    assert cache.hits == hits + 1
+    assert cache.get(s_class, w_foo) is foo
+
+    # Changing the superclass invalidates the entries of all subclasses
+    s_parent.changed()
+    assert cache.get(s_class, w_foo) is None
+    assert s_class.lookup(w_foo) is foo
+    cache.flush()
+    assert cache.get(s_class, w_foo) is None
+
+def test_inline_cache():
+    foo = model.W_CompiledMethod(space, 0)
+    w_class = build_smalltalk_class("Demo", 0x90, methods={'foo': foo})
+    s_class = w_class.as_class_get_shadow(space)
+    w_foo = s_class.s_methoddict().methoddict.keys()[0]
+    w_method = model.W_CompiledMethod(space, 2)
+    cache = w_method.inline_cache_at(1, w_foo)
+    assert cache is w_method.inline_cache_at(1, w_foo)
+    assert w_method.inline_cache_at(1, space.wrap_string("bar")) is None
+
+    assert cache.lookup(s_class) is foo
+    assert cache.classes_s == [s_class]
+    s_class.changed()
+    assert cache.lookup(s_class) is foo
+    assert cache.versions == [s_class.version]
+
+    for i in range(constants.POLYMORPHIC_CACHE_SIZE - 1):
+        w_subclass = build_smalltalk_class("Sub", 0x90, w_superclass=w_class)
+        assert cache.lookup(w_subclass.as_class_get_shadow(space)) is foo
+    assert len(cache.classes_s) == constants.POLYMORPHIC_CACHE_SIZE
+    assert not cache.megamorphic
+    w_subclass = build_smalltalk_class("Sub", 0x90, w_superclass=w_class)
+    assert cache.lookup(w_subclass.as_class_get_shadow(space)) is foo
+    assert cache.megamorphic
+    assert cache.lookup(s_class) is foo
+
+    w_method.setbytes(["\x00"] * 3)
+    assert w_method.inline_cache_at(1, w_foo) is not cache
+
 def test_returned_contexts_pc():
     w_context = methodcontext()
     s_context = w_context.as_methodcontext_get_shadow(space)
@@ -278,6 +417,73 @@ def test_returned_contexts_pc():
     s_context.mark_returned()
     assert w_context.fetch(space, constants.CTXPART_PC_INDEX).is_nil(space)
 
+def context_chain(*primitives):
+    # The first context is the bottom one, each following context is sent by the previous one.
+    w_context = None
+    contexts_s = []
+    for primitive in primitives:
+        w_method = create_method()
+        w_method._primitive = primitive
+        w_context = methodcontext(w_sender=w_context, method=w_method)
+        contexts_s.append(w_context.as_methodcontext_get_shadow(space))
+    return contexts_s
+
+def test_find_unwind_and_handler_contexts():
+    s_bottom, s_ensure, s_handler, s_middle, s_top = context_chain(0, 198, 199, 0, 0)
+    assert s_ensure.is_unwind_context() and not s_handler.is_unwind_context()
+    assert s_handler.is_handler_context() and not s_ensure.is_handler_context()
+    assert s_top.find_next_unwind_context_up_to(None) is s_ensure
+    assert s_top.find_next_unwind_context_up_to(s_ensure) is None
+    assert s_ensure.find_next_unwind_context_up_to(None) is None
+    assert s_top.find_next_handler_context() is s_handler
+    assert s_handler.find_next_handler_context() is s_handler
+    assert s_ensure.find_next_handler_context() is None
+
+def test_terminate_to():
+    s_bottom, s_ensure, s_middle, s_top = context_chain(0, 198, 0, 0)
+    assert s_top.has_sender(s_bottom)
+    assert not s_bottom.has_sender(s_top)
+    assert not s_top.has_sender(s_top)
+    s_top.terminate_to(s_ensure)
+    assert s_top.s_sender() is s_ensure
+    assert s_middle.is_returned()
+    assert not s_ensure.is_returned()
+    # Terminating to a context that is not a sender only changes the sender
+    s_other, = context_chain(0)
+    s_top.terminate_to(s_other)
+    assert s_top.s_sender() is s_other
+    assert not s_ensure.is_returned()
+
+def test_context_or_none():
+    s_context, = context_chain(0)
+    assert primitives.context_or_none(space, s_context.w_self()) is s_context
+    assert primitives.context_or_none(space, space.w_nil) is None
+    assert primitives.context_or_none(space, space.wrap_int(3)) is None
+    # Other objects are not converted to contexts
+    w_array = w_Array.as_class_get_shadow(space).new(3)
+    s_array = w_array.shadow
+    assert primitives.context_or_none(space, w_array) is None
+    assert w_array.shadow is s_array
+
+def test_context_pool_capacity(monkeypatch):
+    monkeypatch.setattr(constants, "CONTEXT_POOL_CAPACITY", 2)
+    pool = storage_contexts.ContextPool()
+    w_method = create_method()
+    contexts_s = [storage_contexts.ContextPartShadow.build_method_context(space, w_method, space.w_nil)
+                  for i in range(3)]
+    for s_context in contexts_s:
+        pool.recycle(s_context)
+    assert pool.recycled == 2
+    assert pool.dropped == 1
+    size = contexts_s[0].size()
+    assert pool.take(size, w_method, None) is contexts_s[1]
+    pool.recycle(contexts_s[2])
+    assert pool.dropped == 1
+    assert pool.take(size, w_method, None) is contexts_s[2]
+    assert pool.take(size, w_method, None) is contexts_s[0]
+    assert pool.take(size, w_method, None) is None
+    assert pool.pooled == 0
+
 def test_methodcontext_s_home():
     w_context = methodcontext()
     s_context = w_context.as_methodcontext_get_shadow(space)
@@ -1,16 +1,22 @@
 
-from spyvm import model, storage
+import py
+from spyvm import model, storage, constants
 from .util import create_space_interp, copy_to_module, cleanup_module
 
 def setup_module():
-    space, interp = create_space_interp()
-    class_Array = space.classtable["w_Array"]
+    space, interp = create_space_interp(bootstrap=True)
     w_nil = space.w_nil
     copy_to_module(locals(), __name__)
 
 def teardown_module():
     cleanup_module(__name__)
 
+def setup_function(function):
+    # Classes learn the strategies of their instances, so every test gets fresh ones.
+    global class_Array, class_Point3
+    class_Array = space.bootstrap_class(0, name="Array", varsized=True)
+    class_Point3 = space.bootstrap_class(3, name="Point3")
+
 def arr(size):
     return model.W_PointersObject(space, class_Array, size)
 
@@ -47,13 +53,29 @@ def check_arr(arr, expected):
 
 def test_ordered_strategies():
     strategies = space.strategy_factory.strategies
-    assert len(strategies) == 4
+    assert len(strategies) == 8
     index_nil = strategies.index(storage.AllNilStorageShadow)
     index_float = strategies.index(storage.FloatOrNilStorageShadow)
     index_int = strategies.index(storage.SmallIntegerOrNilStorageShadow)
     index_list = strategies.index(storage.ListStorageShadow)
     assert index_nil < index_float < index_list
     assert index_nil < index_int < index_list
+    assert strategies.index(storage.SmallIntegerStorageShadow) < index_int
+    assert strategies.index(storage.FloatStorageShadow) < index_float
+    assert strategies.index(storage.CharacterStorageShadow) < index_list
+    assert strategies.index(storage.BooleanStorageShadow) < index_list
+
+def test_strategy_type_for():
+    factory = space.strategy_factory
+    w_a = space.wrap_char('a')
+    w_t, w_f = space.w_true, space.w_false
+    assert factory.strategy_type_for([w_nil, w_nil]) is storage.AllNilStorageShadow
+    assert factory.strategy_type_for([space.wrap_int(1)]) is storage.SmallIntegerStorageShadow
+    assert factory.strategy_type_for([space.wrap_int(1), w_nil]) is storage.SmallIntegerOrNilStorageShadow
+    assert factory.strategy_type_for([space.wrap_float(1.0)]) is storage.FloatStorageShadow
+    assert factory.strategy_type_for([w_a, w_a]) is storage.CharacterStorageShadow
+    assert factory.strategy_type_for([w_t, w_f]) is storage.BooleanStorageShadow
+    assert factory.strategy_type_for([w_t, w_a]) is storage.ListStorageShadow
 
 def test_optimized_strategy_switch(monkeypatch):
     a = arr(5)
@@ -198,3 +220,269 @@ def test_Float_store_SmallInt_to_List():
     a.store(space, 1, space.wrap_int(2))
     assert isinstance(a.shadow, storage.ListStorageShadow)
     check_arr(a, [1.2, 2, w_nil, w_nil, w_nil])
+
+# ====== MapStorageShadow
+
+def map_obj():
+    return model.W_PointersObject(space, class_Point3, 3)
+
+def test_Map_initial():
+    a = map_obj()
+    assert isinstance(a.shadow, storage.MapStorageShadow)
+    assert a.shadow.layout is class_Point3.as_class_get_shadow(space).instance_layout()
+    check_arr(a, [w_nil, w_nil, w_nil])
+
+def test_Map_mixed_fields_are_unboxed():
+    a = map_obj()
+    w_other = arr(1)
+    a.store(space, 0, space.wrap_int(3))
+    a.store(space, 1, space.wrap_float(4.5))
+    a.store(space, 2, w_other)
+    assert space.unwrap_int(a.fetch(space, 0)) == 3
+    assert space.unwrap_float(a.fetch(space, 1)) == 4.5
+    assert a.fetch(space, 2) is w_other
+    assert a.shadow.int_storage == [3]
+    assert a.shadow.float_storage == [4.5]
+    assert a.shadow.object_storage == [w_other]
+    a.store(space, 0, w_nil)
+    assert a.fetch(space, 0).is_nil(space)
+    assert a.shadow.layout.field_types == [storage.INT_FIELD, storage.FLOAT_FIELD, storage.OBJECT_FIELD]
+
+def test_Map_layouts_are_shared():
+    a = map_obj()
+    b = map_obj()
+    for w_obj in [a, b]:
+        w_obj.store(space, 1, space.wrap_int(1))
+        w_obj.store(space, 2, space.wrap_float(1.0))
+    assert a.shadow.layout is b.shadow.layout
+    b.store(space, 1, w_nil)
+    assert a.shadow.layout is b.shadow.layout
+    b.store(space, 1, space.wrap_float(2.0))
+    assert a.shadow.layout is not b.shadow.layout
+    assert b.shadow.layout.field_types[1] == storage.OBJECT_FIELD
+    check_arr(a, [w_nil, 1, 1.0])
+    check_arr(b, [w_nil, 2.0, 1.0])
+
+def test_Map_become():
+    a = map_obj()
+    b = arr(3)
+    a.store(space, 0, space.wrap_int(1))
+    b.store(space, 0, space.wrap_float(2.0))
+    a.become(b)
+    assert isinstance(b.shadow, storage.MapStorageShadow)
+    assert b.shadow.w_self() is b
+    check_arr(b, [1, w_nil, w_nil])
+    check_arr(a, [2.0, w_nil, w_nil])
+
+def test_Map_generalize_from_homogeneous_strategy():
+    a = map_obj()
+    a.store_shadow(None)
+    space.strategy_factory.set_initial_strategy(a, storage.SmallIntegerOrNilStorageShadow, 3)
+    a.store(space, 0, space.wrap_int(1))
+    a.store(space, 1, arr(1))
+    assert isinstance(a.shadow, storage.MapStorageShadow)
+    assert a.shadow.int_storage == [1]
+
+def test_Map_predicts_layout():
+    a = map_obj()
+    a.store(space, 0, space.wrap_int(1))
+    a.store(space, 1, space.wrap_float(1.0))
+    b = map_obj()
+    assert b.shadow.layout is a.shadow.layout
+    check_arr(b, [w_nil, w_nil, w_nil])
+    b.store(space, 0, space.wrap_int(2))
+    assert b.shadow.layout is a.shadow.layout
+    assert b.shadow.int_storage == [2]
+
+def test_Map_learning_layout_is_no_misprediction(monkeypatch):
+    monkeypatch.setattr(class_Point3.as_class_get_shadow(space), "_instance_layout", None)
+    stats = space.strategy_factory.prediction_stats
+    mispredicted = stats.mispredicted
+    a = map_obj()
+    a.store(space, 0, space.wrap_int(1))
+    a.store(space, 1, space.wrap_float(1.0))
+    assert stats.mispredicted == mispredicted
+    b = map_obj()
+    assert b.shadow.layout is a.shadow.layout
+    b.store(space, 0, arr(1))
+    assert stats.mispredicted == mispredicted + 1
+
+# ====== Strategy prediction
+
+def int_arrays(count):
+    for i in range(count):
+        int_arr(3)
+
+def test_class_predicts_strategy():
+    stats = space.strategy_factory.prediction_stats
+    predicted = stats.predicted
+    int_arrays(constants.STRATEGY_PREDICTION_THRESHOLD - 1)
+    assert isinstance(arr(3).shadow, storage.AllNilStorageShadow)
+    int_arrays(1)
+    a = arr(3)
+    assert isinstance(a.shadow, storage.SmallIntegerOrNilStorageShadow)
+    check_arr(a, [w_nil, w_nil, w_nil])
+    a.store(space, 1, space.wrap_int(5))
+    assert isinstance(a.shadow, storage.SmallIntegerOrNilStorageShadow)
+    assert stats.predicted == predicted + 1
+
+def test_class_prediction_needs_consecutive_switches():
+    int_arrays(constants.STRATEGY_PREDICTION_THRESHOLD - 1)
+    float_arr(3)
+    int_arrays(constants.STRATEGY_PREDICTION_THRESHOLD - 1)
+    assert isinstance(arr(3).shadow, storage.AllNilStorageShadow)
+
+def test_class_misprediction_drops_prediction():
+    stats = space.strategy_factory.prediction_stats
+    mispredicted = stats.mispredicted
+    int_arrays(constants.STRATEGY_PREDICTION_THRESHOLD)
+    a = arr(3)
+    a.store(space, 0, arr(1))
+    assert isinstance(a.shadow, storage.ListStorageShadow)
+    assert stats.mispredicted == mispredicted + 1
+    assert isinstance(arr(3).shadow, storage.AllNilStorageShadow)
+
+def test_class_prediction_decays(monkeypatch):
+    monkeypatch.setattr(constants, "STRATEGY_PREDICTION_DECAY", 2)
+    stats = space.strategy_factory.prediction_stats
+    decayed = stats.decayed
+    int_arrays(constants.STRATEGY_PREDICTION_THRESHOLD)
+    assert isinstance(arr(3).shadow, storage.SmallIntegerOrNilStorageShadow)
+    assert isinstance(arr(3).shadow, storage.SmallIntegerOrNilStorageShadow)
+    assert stats.decayed == decayed + 1
+    assert isinstance(arr(3).shadow, storage.AllNilStorageShadow)
+
+def test_class_prediction_does_not_decay_in_jitted_code(monkeypatch):
+    from rpython.rlib import jit
+    monkeypatch.setattr(constants, "STRATEGY_PREDICTION_DECAY", 2)
+    stats = space.strategy_factory.prediction_stats
+    int_arrays(constants.STRATEGY_PREDICTION_THRESHOLD)
+    monkeypatch.setattr(jit, "we_are_jitted", lambda: True)
+    predicted = stats.predicted
+    for i in range(3):
+        assert isinstance(arr(3).shadow, storage.SmallIntegerOrNilStorageShadow)
+    assert stats.predicted == predicted
+
+def test_class_prediction_disabled_without_specialized_storage():
+    int_arrays(constants.STRATEGY_PREDICTION_THRESHOLD)
+    space.strategy_factory.no_specialized_storage.activate()
+    try:
+        assert isinstance(arr(3).shadow, storage.ListStorageShadow)
+    finally:
+        space.strategy_factory.no_specialized_storage.deactivate()
+
+# ====== Strategies without nil
+
+def filled_arr(strategy_type, elements):
+    a = arr(len(elements))
+    a.store_shadow(None)
+    space.strategy_factory.set_initial_strategy(a, strategy_type, len(elements), elements)
+    return a
+
+def test_SmallInteger_store_nil_to_SmallIntegerOrNil():
+    a = filled_arr(storage.SmallIntegerStorageShadow, [space.wrap_int(1), space.wrap_int(2)])
+    a.store(space, 1, space.wrap_int(3))
+    assert isinstance(a.shadow, storage.SmallIntegerStorageShadow)
+    a.store(space, 0, w_nil)
+    assert isinstance(a.shadow, storage.SmallIntegerOrNilStorageShadow)
+    check_arr(a, [w_nil, 3])
+
+def test_Float_store_nil_to_FloatOrNil():
+    a = filled_arr(storage.FloatStorageShadow, [space.wrap_float(1.5)])
+    a.store(space, 0, w_nil)
+    assert isinstance(a.shadow, storage.FloatOrNilStorageShadow)
+    check_arr(a, [w_nil])
+
+def test_Character_storage():
+    w_a, w_b = space.wrap_char('a'), space.wrap_char('b')
+    a = filled_arr(storage.CharacterStorageShadow, [w_a, w_a])
+    a.store(space, 1, w_b)
+    assert a.shadow.storage == ['a', 'b']
+    assert a.fetch(space, 0) is w_a
+    assert a.fetch(space, 1) is w_b
+    a.store(space, 0, space.wrap_int(1))
+    assert isinstance(a.shadow, storage.ListStorageShadow)
+    assert a.fetch(space, 1) is w_b
+
+def test_Character_storage_keeps_identity_of_other_characters():
+    w_a = space.wrap_char('a')
+    w_other_a = model.W_PointersObject(space, space.w_Character, 1)
+    w_other_a.store(space, constants.CHARACTER_VALUE_INDEX, space.wrap_int(ord('a')))
+    a = filled_arr(storage.CharacterStorageShadow, [w_a])
+    a.store(space, 0, w_other_a)
+    assert isinstance(a.shadow, storage.ListStorageShadow)
+    assert a.fetch(space, 0) is w_other_a
+
+def test_Boolean_storage():
+    w_t, w_f = space.w_true, space.w_false
+    a = filled_arr(storage.BooleanStorageShadow, [w_f] * 10)
+    a.store(space, 9, w_t)
+    a.store(space, 2, w_t)
+    a.store(space, 2, w_f)
+    assert len(a.shadow.bits) == 2
+    assert [a.fetch(space, i) for i in range(10)] == [w_f] * 9 + [w_t]
+    py.test.raises(IndexError, a.fetch, space, 10)
+    a.store(space, 0, w_nil)
+    assert isinstance(a.shadow, storage.ListStorageShadow)
+    assert [a.fetch(space, i) for i in range(10)] == [w_nil] + [w_f] * 8 + [w_t]
+
+# ====== Specializing after bulk stores
+
+def test_store_all_specializes():
+    a = list_arr(3)
+    a.store_all(space, [space.wrap_int(1), space.wrap_int(2), space.wrap_int(3)])
+    assert isinstance(a.shadow, storage.SmallIntegerStorageShadow)
+    check_arr(a, [1, 2, 3])
+    a.store_all(space, [space.wrap_float(1.0), w_nil, w_nil])
+    assert isinstance(a.shadow, storage.FloatOrNilStorageShadow)
+    check_arr(a, [1.0, w_nil, w_nil])
+
+def test_store_all_partial_does_not_specialize():
+    a = list_arr(3)
+    a.store_all(space, [space.wrap_int(1)])
+    assert isinstance(a.shadow, storage.ListStorageShadow)
+    check_arr(a, [1, w_nil, w_nil])
+
+def test_clone_keeps_specialized_strategy(monkeypatch):
+    a = filled_arr(storage.SmallIntegerStorageShadow, [space.wrap_int(i) for i in range(3)])
+    monkeypatch.setattr(space.strategy_factory, "strategy_type_for", None)
+    b = a.clone(space)
+    assert isinstance(b.shadow, storage.SmallIntegerStorageShadow)
+    assert b.shadow.storage is not a.shadow.storage
+    check_arr(b, [0, 1, 2])
+    b.store(space, 0, space.wrap_int(5))
+    check_arr(a, [0, 1, 2])
+    c = filled_arr(storage.AllNilStorageShadow, [w_nil] * 3)
+    assert isinstance(c.clone(space).shadow, storage.AllNilStorageShadow)
+
+def test_replace_range_same_strategy():
+    a = filled_arr(storage.SmallIntegerStorageShadow, [space.wrap_int(i) for i in range(4)])
+    b = int_arr(4)
+    b.replace_range(space, 1, 3, a, 0)
+    assert isinstance(b.shadow, storage.SmallIntegerOrNilStorageShadow)
+    check_arr(b, [12, 0, 1, 2])
+    assert b.shadow.copy_range_from(0, a.shadow, 0, 4) is False
+
+def test_replace_range_generalizes():
+    a = float_arr(2)
+    b = int_arr(3)
+    b.replace_range(space, 1, 2, a, 0)
+    assert isinstance(b.shadow, storage.ListStorageShadow)
+    check_arr(b, [12, 1.2, w_nil])
+
+def test_replace_range_all_nil():
+    a = arr(3)
+    b = arr(3)
+    b.replace_range(space, 0, 2, a, 0)
+    assert isinstance(b.shadow, storage.AllNilStorageShadow)
+    assert b.shadow.copy_range_from(0, int_arr(3).shadow, 0, 3) is False
+
+def test_bulk_stored_specializes_after_overwrite():
+    a = list_arr(4)
+    for i in range(4):
+        a.store(space, i, space.wrap_int(i))
+    space.strategy_factory.bulk_stored(a, 2)
+    assert isinstance(a.shadow, storage.ListStorageShadow)
+    space.strategy_factory.bulk_stored(a, 2)
+    assert isinstance(a.shadow, storage.SmallIntegerStorageShadow)
+    check_arr(a, [0, 1, 2, 3])
@@ -237,6 +237,33 @@ class TestScheduler(object):
         assert highest is old_process._w_self
         py.test.raises(FatalError, wrapper.scheduler(space).pop_highest_priority_process)
 
+    def test_run_queue_index(self):
+        process, old_process = self.make_processes(4, 2, space.w_false)
+        run_queue = wrapper.scheduler(space).run_queue()
+        assert run_queue.highest() == 4
+        old_process.put_to_sleep()
+        assert wrapper.scheduler(space).pop_highest_priority_process() is process._w_self
+        # The empty list is unmarked when it is found empty
+        assert run_queue.highest() == 4
+        assert wrapper.scheduler(space).highest_priority_process() is old_process._w_self
+        assert run_queue.highest() == 2
+
+    def test_run_queue_index_observes_lists_changed_by_image(self):
+        process, old_process = self.make_processes(4, 2, space.w_false)
+        run_queue = wrapper.scheduler(space).run_queue()
+        old_process.put_to_sleep()
+        assert wrapper.scheduler(space).pop_highest_priority_process() is process._w_self
+        # The image adds the process above the marked priority 2
+        wrapper.scheduler(space).get_process_list(3).add_process(process._w_self)
+        assert wrapper.scheduler(space).pop_highest_priority_process() is process._w_self
+        # The image replaces a list of the scheduler
+        w_lists = wrapper.scheduler(space).priority_list()
+        process_list = new_processlist()
+        w_lists.store(space, 3, process_list._w_self)
+        assert run_queue.w_lists is None
+        process_list.add_process(process._w_self)
+        assert wrapper.scheduler(space).highest_priority_process() is process._w_self
+
     def test_semaphore_wait(self):
         semaphore = new_semaphore()
         suspendedcontext = new_frame()
@@ -292,3 +319,32 @@ class TestScheduler(object):
 
         process_list = wrapper.scheduler(space).get_process_list(process.priority())
         assert process_list.first_link() is process._w_self
+
+def test_run_queue_index_bitmap():
+    index = wrapper.RunQueueIndex()
+    index.words = [wrapper.r_uint(0)] * 3
+    assert index.highest() == -1
+    for priority in [0, 31, 32, 80, 40]:
+        index.mark(priority)
+    assert index.highest() == 80
+    index.unmark(80)
+    assert index.highest() == 40
+    index.unmark(40)
+    index.unmark(32)
+    assert index.highest() == 31
+    index.unmark(31)
+    assert index.highest() == 0
+
+def test_scheduler_wrappers_are_cached(monkeypatch):
+    w_association = model.W_PointersObject(space, None, 2)
+    monkeypatch.setitem(space.objtable, "w_schedulerassociationpointer", w_association)
+    w_association.store(space, 1, new_scheduler()._w_self)
+    sched = wrapper.scheduler(space)
+    assert wrapper.scheduler(space) is sched
+    process_list = sched.get_process_list(2)
+    assert sched.get_process_list(2) is process_list
+    assert process_list._w_self is sched.priority_list().fetch(space, 2)
+    py.test.raises(WrapperException, sched.get_process_list, 5)
+    # Another scheduler gets its own wrapper
+    w_association.store(space, 1, new_scheduler()._w_self)
+    assert wrapper.scheduler(space) is not sched
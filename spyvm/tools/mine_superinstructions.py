@@ -0,0 +1,54 @@
+import sys, re
+
+# Counts the most frequent sequences of bytecodes executed in a run of the vm.
+# Create the input with: <vm> -t --no-superinstructions <image> ... > trace.txt
+# Without --no-superinstructions, already fused bytecodes show up as superinstructions.
+
+BYTECODE_LINE = re.compile(r"^( *)\.\. <0x[0-9a-f]+>([A-Za-z]+)")
+SEQUENCE_LENGTHS = [2, 3]
+
+def main(argv):
+    if len(argv) < 1:
+        print "Need trace file (output of a run with -t) as parameter. Optional: number of sequences to print."
+        return 1
+    tracefile = argv[0]
+    top = 20
+    if len(argv) > 1:
+        top = int(argv[1])
+    counts = mine_sequences(open(tracefile))
+    print_sequences(counts, top)
+
+def mine_sequences(lines):
+    # Bytecodes are only part of a sequence if they are executed in the same frame.
+    # The frame depth is the indentation of the trace lines.
+    counts = {}
+    windows = {}
+    for line in lines:
+        depth = len(line) - len(line.lstrip(" "))
+        for d in windows.keys():
+            if d > depth:
+                del windows[d]
+        match = BYTECODE_LINE.match(line)
+        if not match:
+            continue
+        window = windows.setdefault(depth, [])
+        window.append(match.group(2))
+        del window[:-max(SEQUENCE_LENGTHS)]
+        for length in SEQUENCE_LENGTHS:
+            if len(window) >= length:
+                sequence = tuple(window[-length:])
+                counts[sequence] = counts.get(sequence, 0) + 1
+    return counts
+
+def print_sequences(counts, top):
+    total = sum(count for sequence, count in counts.items() if len(sequence) == SEQUENCE_LENGTHS[0])
+    for length in SEQUENCE_LENGTHS:
+        sequences = [(count, sequence) for sequence, count in counts.items() if len(sequence) == length]
+        sequences.sort(reverse=True)
+        print "Most frequent sequences of %d bytecodes:" % length
+        for count, sequence in sequences[:top]:
+            print "%10d (%5.2f%%) %s" % (count, 100.0 * count / max(total, 1), " ".join(sequence))
+        print
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
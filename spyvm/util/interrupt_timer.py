@@ -0,0 +1,87 @@
+import time
+
+from spyvm import constants
+from spyvm.util import system
+from rpython.rlib.objectmodel import we_are_translated
+from rpython.rtyper.lltypesystem import lltype, rffi
+
+if system.IS_POSIX:
+    from rpython.rlib import rsignal
+
+def _set_timeval(timeval, milliseconds):
+    rffi.setintfield(timeval, 'c_tv_sec', milliseconds / 1000)
+    rffi.setintfield(timeval, 'c_tv_usec', (milliseconds % 1000) * 1000)
+
+class InterruptTimer(object):
+    """Raises an interrupt-pending flag every INTERRUPT_TIMER_PERIOD milliseconds,
+    independent of what the interpreter is executing. The flag is set
+    asynchronously by a SIGALRM interval timer and is cheap to poll at sends
+    and loop back-edges. The signal restarts interrupted system calls, so
+    file primitives do not fail with EINTR. Untranslated (or without POSIX signals) the timer is
+    emulated by comparing the clock at every poll.
+    The timer also records the latency of timer semaphore wakeups."""
+
+    _attrs_ = ["period", "running", "next_tick",
+               "wakeups", "total_latency", "max_latency"]
+
+    def __init__(self, period=constants.INTERRUPT_TIMER_PERIOD):
+        self.period = period
+        self.running = False
+        self.next_tick = 0.0
+        self.wakeups = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def _uses_signals(self):
+        return we_are_translated() and system.IS_POSIX
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        if self._uses_signals():
+            rsignal.pypysig_setflag(rsignal.SIGALRM)
+            # pypysig_setflag installs the handler without SA_RESTART.
+            rsignal.c_siginterrupt(rsignal.SIGALRM, 0)
+            self._set_itimer(self.period)
+        else:
+            self.acknowledge()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        if self._uses_signals():
+            self._set_itimer(0)
+            rsignal.pypysig_default(rsignal.SIGALRM)
+
+    def _set_itimer(self, period):
+        with lltype.scoped_alloc(rsignal.itimervalP.TO, 1) as new:
+            _set_timeval(new[0].c_it_value, period)
+            _set_timeval(new[0].c_it_interval, period)
+            rsignal.c_setitimer(rsignal.ITIMER_REAL, new,
+                                lltype.nullptr(rsignal.itimervalP.TO))
+
+    def is_pending(self):
+        if self._uses_signals():
+            # The signal handler sets the counter to -1.
+            return rsignal.pypysig_getaddr_occurred().c_value < 0
+        return self.running and time.time() >= self.next_tick
+
+    def acknowledge(self):
+        if self._uses_signals():
+            rsignal.pypysig_getaddr_occurred().c_value = 0
+            while rsignal.pypysig_poll() >= 0:
+                pass
+        else:
+            self.next_tick = time.time() + self.period / 1000.0
+
+    def record_wakeup(self, latency):
+        self.wakeups += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def print_stats(self):
+        average = self.total_latency / self.wakeups if self.wakeups > 0 else 0
+        print "Interrupt timer (%d ms): %d timer wakeups, %d ms average latency, %d ms max latency" % (
+            self.period, self.wakeups, average, self.max_latency)
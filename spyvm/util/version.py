@@ -37,6 +37,17 @@ def constant_for_version_arg(func):
     meth.func_name = "constant_meth_" + func.func_name
     return meth
 
+# Same as constant_for_version, but allows for two additional arguments.
+def constant_for_version_two_args(func):
+    def versioned_func(self, version, arg1, arg2):
+        return func(self, arg1, arg2)
+    versioned_func.func_name = "constant_" + func.func_name
+    elidable_func = jit.elidable_promote()(versioned_func)
+    def meth(self, arg1, arg2):
+        return elidable_func(self, self.version, arg1, arg2)
+    meth.func_name = "constant_meth_" + func.func_name
+    return meth
+
 class Version(object):
     pass
 
@@ -1,5 +1,6 @@
 from spyvm import model, model_display, constants
 from spyvm.error import FatalError, WrapperException, PrimitiveFailedError
+from rpython.rlib.rarithmetic import r_uint
 
 class Wrapper(object):
     def __init__(self, space, w_self):
@@ -80,6 +81,8 @@ class ProcessWrapper(LinkWrapper):
         self.store_suspended_context(self.space.w_nil)
         self.store_my_list(self.space.w_nil)
         assert isinstance(w_frame, model.W_PointersObject)
+        if self.space.print_statistics.is_set():
+            self.space.context_switches.begin()
         raise ProcessSwitch(w_frame.as_context_get_shadow(self.space))
 
     def deactivate(self, s_current_frame, put_to_sleep=True):
@@ -174,40 +177,130 @@ class SchedulerWrapper(Wrapper):
     active_process, store_active_process = make_getter_setter(1)
 
     def get_process_list(self, priority):
-        lists = Wrapper(self.space, self.priority_list())
-
-        return ProcessListWrapper(self.space, lists.read(priority))
+        lists = self.run_queue().lists
+        if not 0 <= priority < len(lists):
+            raise WrapperException("Unexpected instance layout. Too small")
+        return lists[priority]
 
-    def pop_highest_priority_process(self):
+    def run_queue(self):
         w_lists = self.priority_list()
-        # Asserts as W_PointersObjectonion in the varnish.
-        lists = Wrapper(self.space, w_lists)
-
-        for i in range(w_lists.size() - 1, -1, -1):
-            process_list = ProcessListWrapper(self.space, lists.read(i))
-            if not process_list.is_empty_list():
-                return process_list.remove_first_link_of_list()
+        assert isinstance(w_lists, model.W_PointersObject)
+        return self.space.run_queue.of(self.space, w_lists)
+
+    def highest_nonempty_priority(self, run_queue):
+        priority = self._highest_marked_priority(run_queue)
+        if priority < 0:
+            raise FatalError("Scheduler could not find a runnable process")
+        return priority
+
+    def _highest_marked_priority(self, run_queue):
+        # Unmarks the empty lists on the way down.
+        priority = run_queue.highest()
+        while priority >= 0:
+            if not run_queue.lists[priority].is_empty_list():
+                return priority
+            run_queue.unmark(priority)
+            priority = run_queue.highest()
+        return -1
 
-        raise FatalError("Scheduler could not find a runnable process")
+    def pop_highest_priority_process(self):
+        run_queue = self.run_queue()
+        priority = self.highest_nonempty_priority(run_queue)
+        return run_queue.lists[priority].remove_first_link_of_list()
 
     def highest_priority_process(self):
-        w_lists = self.priority_list()
-        # Asserts as W_PointersObjectonion in the varnish.
-        lists = Wrapper(self.space, w_lists)
-
-        for i in range(w_lists.size() - 1, -1, -1):
-            process_list = ProcessListWrapper(self.space, lists.read(i))
-            if not process_list.is_empty_list():
-                return process_list.first_link()
-
-        raise FatalError("Scheduler could not find a runnable process")
+        run_queue = self.run_queue()
+        priority = self.highest_nonempty_priority(run_queue)
+        return run_queue.lists[priority].first_link()
+
+class RunQueueIndex(object):
+    """Bitmap of the priorities whose process list may hold a runnable process,
+    so that the scheduler finds the highest one without scanning every list.
+    The index belongs to one array of priority lists and is rebuilt by a scan
+    when the scheduler uses another one, e.g. after an image was loaded.
+    The rebuild gives the lists a ProcessListShadow, which sets the bit of its
+    priority whenever a process is stored into its firstLink, by the VM or by
+    the image. Bits are cleared lazily when their list is found empty. The
+    array gets a PriorityListsShadow, which invalidates the index when one of
+    its lists is replaced.
+    The index also keeps a ProcessListWrapper for each list, so that scheduling
+    does not allocate wrappers."""
+
+    _attrs_ = ["w_lists", "words", "lists"]
+
+    def __init__(self):
+        self.w_lists = None
+        self.words = []
+        self.lists = []
+
+    def of(self, space, w_lists):
+        if w_lists is not self.w_lists:
+            self.rebuild(space, w_lists)
+        return self
+
+    def invalidate(self, w_lists):
+        if w_lists is self.w_lists:
+            self.w_lists = None
+
+    def rebuild(self, space, w_lists):
+        from spyvm.storage import PriorityListsShadow, ProcessListShadow
+        w_lists.as_special_get_shadow(space, PriorityListsShadow)
+        size = w_lists.size()
+        self.words = [r_uint(0)] * ((size + constants.LONG_BIT - 1) / constants.LONG_BIT)
+        self.lists = [None] * size
+        for priority in range(size):
+            w_list = w_lists.fetch(space, priority)
+            assert isinstance(w_list, model.W_PointersObject)
+            w_list.as_special_get_shadow(space, ProcessListShadow).priority = priority
+            self.lists[priority] = ProcessListWrapper(space, w_list)
+            if not w_list.fetch(space, 0).is_nil(space):
+                self.mark(priority)
+        self.w_lists = w_lists
+
+    def mark_list(self, space, priority, w_list):
+        # Lists of another array of priority lists are ignored.
+        w_lists = self.w_lists
+        if (w_lists is not None and priority < w_lists.size() and
+                w_lists.fetch(space, priority).is_same_object(w_list)):
+            self.mark(priority)
+
+    def mark(self, priority):
+        i = priority / constants.LONG_BIT
+        self.words[i] |= r_uint(1) << (priority % constants.LONG_BIT)
+
+    def unmark(self, priority):
+        i = priority / constants.LONG_BIT
+        self.words[i] &= ~(r_uint(1) << (priority % constants.LONG_BIT))
+
+    def highest(self):
+        # Returns the highest marked priority, or -1 if none is marked.
+        for i in range(len(self.words) - 1, -1, -1):
+            word = self.words[i]
+            if word:
+                return i * constants.LONG_BIT + highest_bit(word)
+        return -1
+
+def highest_bit(word):
+    bit = 0
+    shift = constants.LONG_BIT / 2
+    while shift > 0:
+        if word >> shift:
+            word >>= shift
+            bit += shift
+        shift /= 2
+    return bit
 
 def scheduler(space):
     w_association = space.objtable["w_schedulerassociationpointer"]
     assert w_association is not None
-    w_scheduler = AssociationWrapper(space, w_association).value()
+    w_scheduler = w_association.fetch(space, 1)
     assert isinstance(w_scheduler, model.W_PointersObject)
-    return SchedulerWrapper(space, w_scheduler)
+    # The wrapper is cached on the space, so that scheduling does not allocate it.
+    sched = space.scheduler_wrapper
+    if sched is None or sched._w_self is not w_scheduler:
+        sched = SchedulerWrapper(space, w_scheduler)
+        space.scheduler_wrapper = sched
+    return sched
 
 class SemaphoreWrapper(LinkedListWrapper):
 
@@ -2,7 +2,7 @@
 import sys, time, os
 
 from rpython.rlib import jit, rpath, objectmodel
-from spyvm import model, interpreter, squeakimage, objspace, wrapper, error
+from spyvm import model, interpreter, squeakimage, objspace, wrapper, error, constants
 
 def _usage(argv):
     print """
@@ -33,16 +33,21 @@ def _usage(argv):
             -p|--poll          - Actively poll for events. Try this if the image is not responding well.
             -i|--no-interrupts - Disable timer interrupt. Disables non-cooperative scheduling.
             -S                 - Disable specialized storage strategies; always use generic ListStorage
+            --stack-depth <n>  - Nested sends executed on the native stack before continuing from the heap.
+                                 Default: %d
             --hacks            - Enable Spy hacks. Set display color depth to 8.
+            --no-superinstructions - Execute every bytecode on its own, do not fuse frequent sequences.
             
           Logging parameters:
             -t|--trace                 - Output a trace of each message, primitive, return value and process switch.
+            --trace-bytecodes          - Like -t, and also output each executed bytecode.
             -T                         - Trace important events (Process switch, stack overflow, sender chain manipulation)
             -s|--safe-trace            - If tracing is active, omit printing contents of BytesObjects
             -l|--storage-log           - Output a log of storage operations.
             -L|--storage-log-aggregate - Output an aggregated storage log at the end of execution.
+            --stats                    - Output VM statistics (e.g. method cache hits) at the end of execution.
 
-    """ % argv[0]
+    """ % (argv[0], constants.MAX_STACK_DEPTH)
 
 def get_parameter(argv, idx, arg):
     if len(argv) < idx + 1:
@@ -79,6 +84,7 @@ def safe_entry_point(argv):
         return -1
     finally:
         prebuilt_space.strategy_factory.logger.print_aggregated_log()
+        prebuilt_space.print_stats()
 
 def entry_point(argv):
     # == Main execution parameters
@@ -93,7 +99,9 @@ def entry_point(argv):
     poll = False
     interrupts = True
     trace = False
+    trace_bytecodes = False
     trace_important = False
+    max_stack_depth = constants.MAX_STACK_DEPTH
     
     space = prebuilt_space
     idx = 1
@@ -114,6 +122,8 @@ def entry_point(argv):
                 selector, idx = get_parameter(argv, idx, arg)
             elif arg in ["-t", "--trace"]:
                 trace = True
+            elif arg in ["--trace-bytecodes"]:
+                trace_bytecodes = True
             elif arg in ["-T"]:
                 trace_important = True
             elif arg in ["-s", "--safe-trace"]:
@@ -130,6 +140,12 @@ def entry_point(argv):
                 headless = False
             elif arg in ["--hacks"]:
                 space.run_spy_hacks.activate()
+            elif arg in ["--no-superinstructions"]:
+                space.no_superinstructions.activate()
+            elif arg in ["--stack-depth"]:
+                max_stack_depth, idx = get_int_parameter(argv, idx, arg)
+                if max_stack_depth < 2:
+                    raise error.Exit("Stack depth must be at least 2.")
             elif arg in ["-S"]:
                 space.strategy_factory.no_specialized_storage.activate()
             elif arg in ["-u"]:
@@ -139,6 +155,8 @@ def entry_point(argv):
                 space.strategy_factory.logger.activate()
             elif arg in ["-L", "--storage-log-aggregate"]:
                 space.strategy_factory.logger.activate(aggregate=True)
+            elif arg in ["--stats"]:
+                space.print_statistics.activate()
             elif path is None:
                 path = arg
             else:
@@ -163,8 +181,9 @@ def entry_point(argv):
     # Load & prepare image and environment
     image = squeakimage.ImageReader(space, stream).create_image()
     interp = interpreter.Interpreter(space, image,
-                trace=trace, trace_important=trace_important,
-                evented=not poll, interrupts=interrupts)
+                trace=trace, trace_bytecodes=trace_bytecodes, trace_important=trace_important,
+                evented=not poll, interrupts=interrupts,
+                max_stack_depth=max_stack_depth)
     space.runtime_setup(argv[0], path)
     print_error("") # Line break after image-loading characters
     
@@ -269,6 +288,11 @@ def target(driver, *args):
     if hasattr(rgc, "stm_is_enabled"):
         driver.config.translation.stm = True
         driver.config.translation.thread = True
+    if not driver.config.translation.jit:
+        # SmallIntegers are tagged pointers, but the JIT codewriter rejects
+        # constructing an UnboxedValue: the int_add_ovf that tags the value is
+        # not the last operation of its block (see rtagged.new_instance).
+        driver.config.translation.taggedpointers = True
     driver.exe_name = "rsqueak"
     return safe_entry_point, None
 